@@ -1,10 +1,15 @@
 ﻿from __main__ import vtk, qt, ctk, slicer
 from array import array
 
-import math, time
+import collections, logging, math, os, tempfile, time
 import numpy as np
 import numpy as numpy
 import vtk.util.numpy_support as vtk_np
+from RegmaticLib import engine, metrics, multistart, optimizers, pose, pyramid, resultcache, roi, scheduler, series, stats, worker, workingcopy
+
+# debug messages of the optimizers; enable with
+# logging.getLogger('Regmatic').setLevel(logging.DEBUG)
+logger = logging.getLogger('Regmatic')
 #
 # Regmatic
 #
@@ -88,12 +93,23 @@ class RegmaticWidget:
     self.movingSelector.setMRMLScene(slicer.mrmlScene)
     self.parent.connect('mrmlSceneChanged(vtkMRMLScene*)',
                         self.movingSelector, 'setMRMLScene(vtkMRMLScene*)')
+
+    # Moving volumes registered together to the fixed volume
+    self.movingSeriesSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.movingSeriesSelector.objectName = 'movingSeriesSelector'
+    self.movingSeriesSelector.toolTip = "Moving volumes registered to the fixed volume by Register Series."
+    self.movingSeriesSelector.nodeTypes = ['vtkMRMLScalarVolumeNode']
+    ioFormLayout.addRow("Moving Series:", self.movingSeriesSelector)
+    self.movingSeriesSelector.setMRMLScene(slicer.mrmlScene)
+    self.parent.connect('mrmlSceneChanged(vtkMRMLScene*)',
+                        self.movingSeriesSelector, 'setMRMLScene(vtkMRMLScene*)')
                         
     # Fiducial node selector
     self.__fiducialSelector = slicer.qMRMLNodeComboBox()
     self.__fiducialSelector.objectName = 'fiducialSelector'
-    self.__fiducialSelector.toolTip = "The fiducial."
-    self.__fiducialSelector.nodeTypes = ['vtkMRMLAnnotationFiducialNode']
+    self.__fiducialSelector.toolTip = "The fiducial, or a list of fiducials."
+    self.__fiducialSelector.nodeTypes = ['vtkMRMLAnnotationFiducialNode', 'vtkMRMLAnnotationHierarchyNode',
+                                         'vtkMRMLMarkupsFiducialNode']
     self.__fiducialSelector.noneEnabled = False
     self.__fiducialSelector.addEnabled = False
     self.__fiducialSelector.removeEnabled = False
@@ -101,6 +117,19 @@ class RegmaticWidget:
     self.__fiducialSelector.setMRMLScene(slicer.mrmlScene)
     self.parent.connect('mrmlSceneChanged(vtkMRMLScene*)',
                         self.__fiducialSelector, 'setMRMLScene(vtkMRMLScene*)')
+
+    # Moving fiducials, paired in order with the fiducials above
+    self.movingFiducialSelector = slicer.qMRMLNodeComboBox()
+    self.movingFiducialSelector.objectName = 'movingFiducialSelector'
+    self.movingFiducialSelector.toolTip = "Fiducials on the moving volume, in the same order as the fixed fiducials."
+    self.movingFiducialSelector.nodeTypes = ['vtkMRMLAnnotationHierarchyNode', 'vtkMRMLMarkupsFiducialNode']
+    self.movingFiducialSelector.noneEnabled = True
+    self.movingFiducialSelector.addEnabled = False
+    self.movingFiducialSelector.removeEnabled = False
+    ioFormLayout.addRow("Moving Fiducials:", self.movingFiducialSelector)
+    self.movingFiducialSelector.setMRMLScene(slicer.mrmlScene)
+    self.parent.connect('mrmlSceneChanged(vtkMRMLScene*)',
+                        self.movingFiducialSelector, 'setMRMLScene(vtkMRMLScene*)')
                         
     #check button for moving rotation point
     self.__moverotCenterButton = qt.QCheckBox()
@@ -109,6 +138,23 @@ class RegmaticWidget:
     ioFormLayout.addRow(moverotLabel, self.__moverotCenterButton)
     self.__moverotCenterButton.connect('stateChanged(int)', self.updateLogicFromGUI)
 
+    # region of interest around the fiducials
+    self.roiComboBox = qt.QComboBox()
+    self.roiComboBox.addItems(['None', 'Box', 'Sphere'])
+    self.roiComboBox.toolTip = "Only evaluate the registration in a box or sphere around the fiducials."
+    ioFormLayout.addRow("Region of Interest:", self.roiComboBox)
+    self.roiComboBox.connect('currentIndexChanged(int)', self.updateLogicFromGUI)
+
+    self.roiRadiusSlider = ctk.ctkSliderWidget()
+    self.roiRadiusSlider.decimals = 1
+    self.roiRadiusSlider.singleStep = 1
+    self.roiRadiusSlider.minimum = 1
+    self.roiRadiusSlider.maximum = 200
+    self.roiRadiusSlider.value = 30
+    self.roiRadiusSlider.toolTip = "Half size of the box or radius of the sphere around each fiducial, in mm"
+    ioFormLayout.addRow("Region Radius:", self.roiRadiusSlider)
+    self.roiRadiusSlider.connect('valueChanged(double)', self.updateLogicFromGUI)
+
     # Transform node selector
     self.transformSelector = slicer.qMRMLNodeComboBox()
     self.transformSelector.objectName = 'transformSelector'
@@ -121,7 +167,8 @@ class RegmaticWidget:
     self.transformSelector.setMRMLScene(slicer.mrmlScene)
     self.parent.connect('mrmlSceneChanged(vtkMRMLScene*)',
                         self.transformSelector, 'setMRMLScene(vtkMRMLScene*)')
-    selectors = (self.fixedSelector, self.movingSelector, self.transformSelector,self.__fiducialSelector)
+    selectors = (self.fixedSelector, self.movingSelector, self.transformSelector,self.__fiducialSelector,
+                 self.movingFiducialSelector)
     for selector in selectors:
       selector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateLogicFromGUI)
 
@@ -144,6 +191,27 @@ class RegmaticWidget:
     self.sampleSpacingSlider.toolTip = "Multiple of spacing used when extracting pixels to evaluate objective function"
     optFormLayout.addRow("Sample Spacing:", self.sampleSpacingSlider)
 
+    # sample count slider
+    self.sampleCountSlider = ctk.ctkSliderWidget()
+    self.sampleCountSlider.decimals = 0
+    self.sampleCountSlider.singleStep = 1000
+    self.sampleCountSlider.minimum = 0
+    self.sampleCountSlider.maximum = 200000
+    self.sampleCountSlider.toolTip = "Number of fixed image points used to evaluate objective function (0 resamples the whole volume at Sample Spacing)"
+    optFormLayout.addRow("Sample Count:", self.sampleCountSlider)
+
+    # metric combo box
+    self.metricComboBox = qt.QComboBox()
+    self.metricComboBox.addItems(metrics.names())
+    self.metricComboBox.toolTip = "Similarity metric of the objective function: sum of absolute or squared differences, normalized cross correlation or mutual information"
+    optFormLayout.addRow("Metric:", self.metricComboBox)
+
+    # working precision combo box
+    self.precisionComboBox = qt.QComboBox()
+    self.precisionComboBox.addItems(workingcopy.PRECISIONS)
+    self.precisionComboBox.toolTip = "Storage of the volumes read by the sampled metric: full precision, or rescaled 16 or 8 bit copies that move less memory per evaluation"
+    optFormLayout.addRow("Working Precision:", self.precisionComboBox)
+
     # gradient window slider
     self.gradientWindowSlider = ctk.ctkSliderWidget()
     self.gradientWindowSlider.decimals = 2
@@ -164,32 +232,90 @@ class RegmaticWidget:
 
     # get default values from logic
     self.sampleSpacingSlider.value = self.logic.sampleSpacing
+    self.sampleCountSlider.value = self.logic.sampleCount
     self.gradientWindowSlider.value = self.logic.gradientWindow
     self.stepSizeSlider.value = self.logic.stepSize
+    self.metricComboBox.setCurrentIndex(metrics.names().index(self.logic.metricName))
+    self.metricComboBox.connect('currentIndexChanged(int)', self.updateLogicFromGUI)
+    self.precisionComboBox.setCurrentIndex(workingcopy.PRECISIONS.index(self.logic.precision))
+    self.precisionComboBox.connect('currentIndexChanged(int)', self.updateLogicFromGUI)
 
-    sliders = (self.sampleSpacingSlider, self.gradientWindowSlider, self.stepSizeSlider)
+    sliders = (self.sampleSpacingSlider, self.sampleCountSlider, self.gradientWindowSlider, self.stepSizeSlider)
     for slider in sliders:
       slider.connect('valueChanged(double)', self.updateLogicFromGUI)
    
 
+    # background check box
+    self.backgroundCheckBox = qt.QCheckBox()
+    self.backgroundCheckBox.toolTip = "Optimize on a worker thread, keeping the interface responsive."
+    optFormLayout.addRow("Run in background:", self.backgroundCheckBox)
+
+    # cached results check box
+    self.cachedResultsCheckBox = qt.QCheckBox()
+    self.cachedResultsCheckBox.checked = self.logic.returnCachedResults
+    self.cachedResultsCheckBox.toolTip = "Apply the stored result of an earlier registration of the same volumes and settings instead of searching from it again."
+    optFormLayout.addRow("Reuse cached results:", self.cachedResultsCheckBox)
+    self.cachedResultsCheckBox.connect('toggled(bool)', self.updateLogicFromGUI)
+
     # Run button
     self.runButton = qt.QPushButton("Interaction")
     self.runButton.toolTip = "Run registration bot."
     self.runButton.checkable = True
     optFormLayout.addRow(self.runButton)
     self.runButton.connect('toggled(bool)', self.onRunButtonToggled)
-     # Optimize button
-    self.optimizeButton = qt.QPushButton("Optimize Translation")
-    self.optimizeButton.toolTip = "Run optimization."
-    self.optimizeButton.checkable = True
-    optFormLayout.addRow(self.optimizeButton)
-    self.optimizeButton.connect('toggled(bool)', self.onOptimizeButtonToggled)
-    # Optimize Rotation button
-    self.optimizeRotationButton = qt.QPushButton("Optimize Rotation")
-    self.optimizeRotationButton.toolTip = "Run optimization."
-    self.optimizeRotationButton.checkable = True
-    optFormLayout.addRow(self.optimizeRotationButton)
-    self.optimizeRotationButton.connect('toggled(bool)', self.onOptimizeRotationButtonToggled)
+    # Fiducial initialization button
+    self.fiducialFitButton = qt.QPushButton("Initialize from Fiducials")
+    self.fiducialFitButton.toolTip = "Set the transform to the rigid fit of the moving fiducials onto the fixed ones."
+    optFormLayout.addRow(self.fiducialFitButton)
+    self.fiducialFitButton.connect('clicked()', self.onFiducialFitButtonClicked)
+    # Moment initialization
+    self.initializeButton = qt.QPushButton("Initialize")
+    self.initializeButton.toolTip = "Align the centers of mass and principal axes of the volumes."
+    optFormLayout.addRow(self.initializeButton)
+    self.initializeButton.connect('clicked()', self.onInitializeButtonClicked)
+    self.autoInitializeCheckBox = qt.QCheckBox()
+    self.autoInitializeCheckBox.checked = self.logic.initializeFromMoments
+    self.autoInitializeCheckBox.toolTip = "Initialize before optimizing while the transform is still the identity."
+    optFormLayout.addRow("Initialize automatically:", self.autoInitializeCheckBox)
+    self.autoInitializeCheckBox.connect('toggled(bool)', self.updateLogicFromGUI)
+    # Optimize button
+    self.optimizeRigidButton = qt.QPushButton("Optimize Rigid")
+    self.optimizeRigidButton.toolTip = "Optimize translation and rotation together until the metric converges."
+    self.optimizeRigidButton.checkable = True
+    optFormLayout.addRow(self.optimizeRigidButton)
+    self.optimizeRigidButton.connect('toggled(bool)', self.onOptimizeRigidButtonToggled)
+    self.convergenceLabel = qt.QLabel()
+    optFormLayout.addRow("Convergence:", self.convergenceLabel)
+    # Multi-start rotation
+    self.rotationStartsSpinBox = qt.QSpinBox()
+    self.rotationStartsSpinBox.minimum = 1
+    self.rotationStartsSpinBox.maximum = 256
+    self.rotationStartsSpinBox.value = self.logic.rotationStarts
+    self.rotationStartsSpinBox.toolTip = "Number of perturbed starting poses searched in parallel"
+    optFormLayout.addRow("Rotation Starts:", self.rotationStartsSpinBox)
+    self.rotationStartsSpinBox.connect('valueChanged(int)', self.updateLogicFromGUI)
+    self.multiStartButton = qt.QPushButton("Multi-start Rotation")
+    self.multiStartButton.toolTip = "Run the rotation search from several starting poses on all cores."
+    optFormLayout.addRow(self.multiStartButton)
+    self.multiStartButton.connect('clicked()', self.onMultiStartButtonClicked)
+    # Series registration button
+    self.seriesButton = qt.QPushButton("Register Series")
+    self.seriesButton.toolTip = "Register every volume of the moving series to the fixed volume, each into a new transform."
+    self.seriesButton.checkable = True
+    optFormLayout.addRow(self.seriesButton)
+    self.seriesButton.connect('toggled(bool)', self.onSeriesButtonToggled)
+    # Phase correlation translation button
+    self.optimizePhaseButton = qt.QPushButton("Optimize Translation")
+    self.optimizePhaseButton.toolTip = "Find the translation by FFT phase correlation, coarse to fine."
+    self.optimizePhaseButton.checkable = True
+    optFormLayout.addRow(self.optimizePhaseButton)
+    self.optimizePhaseButton.connect('toggled(bool)', self.onOptimizePhaseButtonToggled)
+    # Gradient descent button
+    self.optimizeGradientButton = qt.QPushButton("Optimize Gradient")
+    self.optimizeGradientButton.toolTip = "Run gradient descent over translation and rotation."
+    self.optimizeGradientButton.checkable = True
+    optFormLayout.addRow(self.optimizeGradientButton)
+    self.optimizeGradientButton.connect('toggled(bool)', self.onOptimizeGradientButtonToggled)
 
     # to support quicker development:
     import os
@@ -207,10 +333,19 @@ class RegmaticWidget:
     self.logic.moving = self.movingSelector.currentNode()
     self.logic.transform = self.transformSelector.currentNode()
     self.logic.fiducial = self.__fiducialSelector.currentNode()
+    self.logic.movingFiducial = self.movingFiducialSelector.currentNode()
     self.logic.checked = self.__moverotCenterButton
+    self.logic.roiShape = (None, 'box', 'sphere')[self.roiComboBox.currentIndex]
+    self.logic.roiRadius = self.roiRadiusSlider.value
     self.logic.sampleSpacing = self.sampleSpacingSlider.value
+    self.logic.sampleCount = int(self.sampleCountSlider.value)
+    self.logic.metricName = self.metricComboBox.currentText
+    self.logic.precision = self.precisionComboBox.currentText
     self.logic.gradientWindow = self.gradientWindowSlider.value
     self.logic.stepSize = self.stepSizeSlider.value
+    self.logic.rotationStarts = self.rotationStartsSpinBox.value
+    self.logic.returnCachedResults = self.cachedResultsCheckBox.checked
+    self.logic.initializeFromMoments = self.autoInitializeCheckBox.checked
 
   def onRunButtonToggled(self, checked):
     if checked:
@@ -220,22 +355,76 @@ class RegmaticWidget:
       self.logic.stop()
       self.runButton.text = "Interaction"
 
-  def onOptimizeButtonToggled(self,checked):
-    if checked:  
-      self.logic.startRegistration()
-      self.optimizeButton.text = "Processing"
+  def onOptimizeRigidButtonToggled(self,checked):
+    if checked:
+      self.optimizeRigidButton.text = "Processing"
+      self.convergenceLabel.text = ""
+      if self.backgroundCheckBox.checked:
+        self.logic.startBackgroundRegistration('rigid', lambda: self.optimizeRigidButton.setChecked(False))
+      else:
+        self.logic.startRegistrationRigid(self.onRegistrationConverged)
     else:
+      self.logic.stopBackgroundRegistration()
       self.logic.stopRegistration()
-      self.optimizeButton.text = "Translation Optimization"
+      self.optimizeRigidButton.text = "Optimize Rigid"
+
+  def onFiducialFitButtonClicked(self):
+    try:
+      residual = self.logic.fiducialRegistration()
+    except ValueError as error:
+      qt.QMessageBox.warning(slicer.util.mainWindow(), "Regmatic", str(error))
+      return
+    self.convergenceLabel.text = "fiducial fit: %.2f mm RMS" % residual
+
+  def onInitializeButtonClicked(self):
+    self.logic.momentInitialization()
+    self.convergenceLabel.text = "initialized from image moments"
+
+  def onRegistrationConverged(self):
+    self.convergenceLabel.text = self.logic.scheduler.summary()
+    self.optimizeRigidButton.setChecked(False)
       
-  def onOptimizeRotationButtonToggled(self,checked):
-    if checked:  
-      self.logic.startRegistrationRotation(self.logic.stepSize)
-      self.optimizeRotationButton.text = "Processing"
+  def onOptimizeGradientButtonToggled(self,checked):
+    if checked:
+      self.optimizeGradientButton.text = "Processing"
+      if self.backgroundCheckBox.checked:
+        self.logic.startBackgroundRegistration('gradient', lambda: self.optimizeGradientButton.setChecked(False))
+      else:
+        self.logic.gradientRegistration()
+        self.optimizeGradientButton.setChecked(False)
     else:
-      self.logic.stopRegistrationRotation()
-      self.optimizeRotationButton.text = "Rotation Optimization"
-      
+      self.logic.stopBackgroundRegistration()
+      self.optimizeGradientButton.text = "Optimize Gradient"
+
+  def onOptimizePhaseButtonToggled(self,checked):
+    if checked:
+      self.optimizePhaseButton.text = "Processing"
+      if self.backgroundCheckBox.checked:
+        self.logic.startBackgroundRegistration('phase', lambda: self.optimizePhaseButton.setChecked(False))
+      else:
+        self.logic.phaseRegistration()
+        self.optimizePhaseButton.setChecked(False)
+    else:
+      self.logic.stopBackgroundRegistration()
+      self.optimizePhaseButton.text = "Optimize Translation"
+
+  def onMultiStartButtonClicked(self):
+    self.logic.multiStartRotation()
+
+  def onSeriesButtonToggled(self, checked):
+    if checked:
+      self.seriesButton.text = "Cancel Series"
+      self.logic.startSeriesRegistration(self.movingSeriesSelector.checkedNodes(),
+                                         finished=self.onSeriesFinished)
+    else:
+      self.logic.stopSeriesRegistration()
+      self.seriesButton.text = "Register Series"
+
+  def onSeriesFinished(self):
+    seconds = sum(stats['totalSeconds'] for stats in self.logic.seriesStats)
+    self.convergenceLabel.text = "%d volumes registered, %.1f s of registration" % (len(self.logic.seriesStats), seconds)
+    self.seriesButton.setChecked(False)
+
   def onReload(self,moduleName="Regmatic"):
     """Generic reload method for any scripted module.
     ModuleWizard will subsitute correct default moduleName.
@@ -269,6 +458,185 @@ class RegmaticWidget:
         'globals()["%s"].%s(parent)' % (moduleName, widgetName))
     globals()[widgetName.lower()].setup()
 
+def arrayFromMatrix(matrix):
+  """Returns a vtkMatrix4x4 as a 4x4 numpy array"""
+  return numpy.array([[matrix.GetElement(i,j) for j in xrange(4)] for i in xrange(4)])
+
+def matrixFromArray(array):
+  """Returns a 4x4 numpy array as a vtkMatrix4x4"""
+  matrix = vtk.vtkMatrix4x4()
+  for i in xrange(4):
+    for j in xrange(4):
+      matrix.SetElement(i,j,array[i][j])
+  return matrix
+
+#
+# Sampling geometry
+#
+
+class SamplingGeometry(object):
+  """
+  RAS output grid of every resample: origin, isotropic spacing and
+  (i,j,k) dimensions. The fixed and moving volumes are resampled on the
+  same geometry, so their arrays line up voxel for voxel.
+  """
+
+  def __init__(self, origin, spacing, dimensions):
+    self.origin = tuple(float(value) for value in origin)
+    self.spacing = float(spacing)
+    self.dimensions = tuple(int(value) for value in dimensions)
+
+  @classmethod
+  def fromBounds(cls, lower, upper, spacing):
+    """Grid covering the RAS box from lower to upper at spacing"""
+    dimensions = [int((upper[axis]-lower[axis])/spacing)+1 for axis in range(3)]
+    return cls(lower, spacing, dimensions)
+
+  def key(self):
+    return self.origin + (self.spacing,) + self.dimensions
+
+  def voxelCount(self):
+    return self.dimensions[0]*self.dimensions[1]*self.dimensions[2]
+
+  def shape(self, first=0, last=None):
+    """(k,j,i) array shape of slices first to last-1"""
+    last = self.dimensions[2] if last is None else last
+    return (last-first, self.dimensions[1], self.dimensions[0])
+
+  def apply(self, reslice, first=0, last=None):
+    """Set the output grid of a vtkImageReslice to slices first to last-1"""
+    last = self.dimensions[2] if last is None else last
+    reslice.SetOutputOrigin(self.origin)
+    reslice.SetOutputSpacing([self.spacing,]*3)
+    reslice.SetOutputExtent(0, self.dimensions[0]-1, 0, self.dimensions[1]-1, first, last-1)
+
+  def points(self, first=0, last=None):
+    """RAS positions of the voxels of slices first to last-1, as an (N,3) array in array order"""
+    shape = self.shape(first, last)
+    k, j, i = numpy.mgrid[first:first+shape[0], 0:shape[1], 0:shape[2]]
+    return numpy.column_stack((i.ravel(), j.ravel(), k.ravel())) * self.spacing + self.origin
+
+#
+# Fixed image cache
+#
+
+class FixedImageCache(object):
+  """Holds the fixed volume resampled into RAS space so that it is
+  resliced once per (fixed node, sample spacing, bounds) instead of
+  once per metric evaluation.
+  Entries are dropped whenever the fixed node or its parent transform
+  fires a ModifiedEvent.
+  """
+
+  def __init__(self):
+    self.arrays = {}
+    self.hits = 0
+    self.misses = 0
+    self.generation = 0
+    self.node = None
+    self.transformNode = None
+    self.observerTags = []
+
+  def get(self, node, sampleSpacing, resample, streamed=False, bounds=None):
+    """Return the cached RAS array of node, calling resample(node)
+    to fill the cache on a miss. A streamed array is already owned by
+    the cache, typically a memmap, and is kept as is. bounds identifies
+    the resampled region, the RAS bounds of node by default.
+    """
+    self.watch(node)
+    if bounds is None:
+      bounds = [0,]*6
+      node.GetRASBounds(bounds)
+    key = (node.GetID(), sampleSpacing, tuple(bounds), streamed)
+    if key in self.arrays:
+      self.hits += 1
+    elif streamed:
+      self.misses += 1
+      self.arrays[key] = resample(node)
+    else:
+      self.misses += 1
+      # copy: the reslice output is reused by the next resample
+      self.arrays[key] = numpy.array(resample(node))
+    return self.arrays[key]
+
+  def watch(self, node):
+    """Observe node and its parent transform, replacing any previous observers"""
+    transformNode = node.GetParentTransformNode()
+    if node == self.node and transformNode == self.transformNode:
+      return
+    self.release()
+    self.node = node
+    self.transformNode = transformNode
+    for observee in (node, transformNode):
+      if observee:
+        tag = observee.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onNodeModified)
+        self.observerTags.append([observee,tag])
+
+  def onNodeModified(self, caller, event=None):
+    self.invalidate()
+
+  def invalidate(self):
+    self.arrays = {}
+    self.generation += 1
+
+  def release(self):
+    for observee,tag in self.observerTags:
+      observee.RemoveObserver(tag)
+    self.observerTags = []
+    self.node = None
+    self.transformNode = None
+    self.invalidate()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.arrays)}
+
+#
+# Metric cache
+#
+
+class MetricCache(object):
+  """Bounded LRU store of metric values keyed by pose and sampling parameters.
+  The sweeps and the color window feedback ask for the score of the
+  same pose several times; only the first request is computed.
+  """
+
+  def __init__(self, maxSize=256, quantum=1e-4):
+    self.maxSize = maxSize
+    self.quantum = quantum
+    self.values = collections.OrderedDict()
+    self.saved = 0
+    self.computed = 0
+
+  def matrixKey(self, matrix):
+    """Quantize a 4x4 numpy matrix so that poses closer than quantum share a key"""
+    return tuple(numpy.round(numpy.ravel(matrix)/self.quantum).astype(int))
+
+  def get(self, key, compute):
+    """Return the value stored for key, calling compute() on a miss"""
+    if key in self.values:
+      self.saved += 1
+      value = self.values.pop(key)
+    else:
+      self.computed += 1
+      value = compute()
+      if len(self.values) >= self.maxSize:
+        self.values.popitem(last=False)
+    self.values[key] = value
+    return value
+
+  def put(self, key, value):
+    """Store a value computed outside of get, such as by a batch evaluation"""
+    self.values.pop(key, None)
+    if len(self.values) >= self.maxSize:
+      self.values.popitem(last=False)
+    self.values[key] = value
+
+  def clear(self):
+    self.values.clear()
+
+  def stats(self):
+    return {'saved': self.saved, 'computed': self.computed, 'entries': len(self.values)}
+
 #
 # Regmatic logic
 #
@@ -277,6 +645,8 @@ class RegmaticLogic(object):
   """ Implement a template matching optimizer that is
   integrated with the slicer main loop.
   Note: currently depends on numpy/scipy installation in mac system
+  Timings of the reslice, conversion, metric, rendering and transform
+  update stages are collected in self.stats.
   """
 
   def __init__(self,fixed=None,moving=None,transform=None,fiducial=None,checked = None):
@@ -285,14 +655,23 @@ class RegmaticLogic(object):
 
     # parameter defaults
     self.sampleSpacing = 10
+    self.defaultSampleCount = 20000
+    self.sampleCount = self.defaultSampleCount
+    self.pyramidSize = 64
     self.gradientWindow = 1
     self.stepSize = 1
+    self.metricName = 'SAD'
+    # storage of the volumes read by the sampled metric, see workingcopy
+    self.precision = 'full'
+    self.roiShape = None
+    self.roiRadius = 30.
 
     # slicer nodes set by the GUI
     self.fixed = fixed
     self.moving = moving
     self.transform = transform
     self.fiducial = fiducial
+    self.movingFiducial = None
     self.checked = checked
 
     # optimizer state variables
@@ -312,18 +691,79 @@ class RegmaticLogic(object):
     self.sliceWidgetsPerStyle = {}
     self.tac=0
     self.WMAX = 0
-    self.L=[]
     self.divider = 1
     self.step = 1
+    # stopping criteria of the timer-driven optimizers
+    self.scheduler = None
+    self.registrationFinished = None
+    self.tickBudget = 0.04
+    self.relativeTolerance = 1e-3
+    self.translationTolerance = 0.05
+    self.rotationTolerance = 0.02
+    self.rigidTolerance = 0.05
+    self.rigidSimplexSize = 4.
+    self.rigidSearch = None
+    self.rigidApplied = None
+    # results of converged registrations, kept across sessions
+    self.resultCache = None
+    self.resultCacheDirectory = None
+    self.resultKey = None
+    self.returnCachedResults = True
+    self.contentDigests = {}
+    # start from the image moments while the transform is the identity
+    self.initializeFromMoments = True
+    self.momentRotation = True
+    # translate by phase correlation after each pass of the rotation search
+    self.phaseTranslationInRotation = True
 
     # helper objects
     self.scratchMatrix = vtk.vtkMatrix4x4()
     self.ijkToRAS = vtk.vtkMatrix4x4()
     self.rasToIJK = vtk.vtkMatrix4x4()
-    self.reslice = vtk.vtkImageReslice()
-    self.resliceTransform = vtk.vtkTransform()
+    self.reslicers = {}
+    self.currentGeometry = None
+    self.currentGeometryKey = None
+    self.slabVoxels = 2**22
+    self.slabMasks = {}
+    self.buffers = {}
+    # work buffer bytes allocated by the last bufferedMetric
+    self.bufferBytes = None
+    self.fixedImageCache = FixedImageCache()
+    self.metricCache = MetricCache()
+    self.movingToWorld = vtk.vtkMatrix4x4()
+    self.currentEngine = None
+    self.currentEngineKey = None
+    self.stats = stats.Stats()
+    self.pyramids = {}
+    self.level = 0
+    self.worker = None
+    self.workerTimer = None
+    self.workerFinished = None
+    self.series = None
+    self.seriesNodes = []
+    self.seriesTimer = None
+    self.seriesFinished = None
+    self.seriesThreads = None
+    self.seriesStats = []
+    self.pollInterval = 100
+    self.rotationStarts = 8
+    self.rotationSpread = 20.
     self.viewer = None
     self.render = None
+    self.feedbackInterval = 100
+    self.feedbackIdleDelay = 300
+    self.feedbackSampleCount = 2000
+    self.feedbackTimer = None
+    self.idleTimer = None
+    self.feedbackPending = False
+    self.currentResliceMetric = None
+    self.currentResliceMetricKey = None
+    # optimizer pose, written to the transform node every commitInterval seconds
+    self.pose = None
+    self.poseDirty = False
+    self.committedMatrix = None
+    self.commitInterval = 0.2
+    self.lastCommit = 0
     #self.weightmax = 400000
    
   def start(self):
@@ -345,38 +785,131 @@ class RegmaticLogic(object):
           tag = style.AddObserver(event, self.processEvent)
    
           self.styleObserverTags.append([style,tag])
-  def startRegistration(self):
-    """Create the subprocess and set up a polling timer"""
-    if self.timer:
-      self.stop()
-    self.timer = qt.QTimer()
-    self.timer.setInterval(self.interval)
-    self.timer.connect('timeout()', self.registration)
-    self.timer.start()
+  def startRegistration(self, finished=None):
+    """
+    Run the translation sweeps on a timer until they converge, then call
+    finished. No button starts the separate translation and rotation
+    sweeps since "Optimize Rigid" replaced them; they are kept for
+    scripts and as the baseline paths of RegmaticBenchmark.
+    """
+    self.startTimedRegistration(self.registration, 'translation', finished)
 
-  def startRegistrationRotation(self,step = None):
-    """Create the subprocess and set up a polling timer"""
+  def startRegistrationRotation(self,step = None, finished=None):
+    """Run the rotation sweeps on a timer until they converge, then call finished; see startRegistration"""
     self.step = step
+    self.startTimedRegistration(self.registrationRotation, 'rotation', finished)
+
+  def startRegistrationRigid(self, finished=None):
+    """Run the joint six parameter search on a timer until it converges, then call finished"""
+    self.startTimedRegistration(self.registrationRigid, 'rigid', finished)
+
+  def startTimedRegistration(self, method, mode, finished):
     if self.timer:
-      self.stop()
+      self.stopRegistration()
+    self.level = self.levelCount()-1
+    self.scheduler = self.newScheduler(mode)
+    self.registrationFinished = finished
+    self.resultKey = self.registrationResultKey(mode)
+    cached = self.registrationResultCache().get(self.resultKey)
+    if cached is None:
+      self.defaultInitialization()
+    else:
+      # return the cached result, or search again starting from it
+      self.setTransformMatrix(cached['matrix'])
+      if self.returnCachedResults:
+        self.scheduler.finish('cached', cached['value'])
+        self.finishRegistration()
+        return
     self.timer = qt.QTimer()
     self.timer.setInterval(self.interval)
-    self.timer.connect('timeout()', self.registrationRotation)
+    self.timer.connect('timeout()', method)
     self.timer.start()
-    
+
+  def newScheduler(self, mode):
+    """Returns the scheduler.ConvergenceScheduler of the 'translation', 'rotation' or 'rigid' optimizer"""
+    stepTolerance = {'translation': self.translationTolerance,
+                     'rotation': self.rotationTolerance,
+                     'rigid': self.rigidTolerance}[mode]
+    # a simplex iteration only replaces its worst vertex, so judge progress over more of them
+    patience = 12 if mode == 'rigid' else 2
+    result = scheduler.ConvergenceScheduler(stepTolerance, self.relativeTolerance, patience,
+                                            tickBudget=self.tickBudget)
+    result.start(self.evaluationCount())
+    return result
+
+  def registrationResultCache(self):
+    """The resultcache.ResultCache, under the Slicer temporary directory unless resultCacheDirectory is set"""
+    if self.resultCache is None:
+      directory = self.resultCacheDirectory or os.path.join(slicer.app.temporaryPath, 'RegmaticResults')
+      self.resultCache = resultcache.ResultCache(directory)
+    return self.resultCache
+
+  def registrationResultKey(self, mode):
+    """
+    Cache key of the result of the mode optimizer: the content and
+    frames of the volumes and every parameter the result depends on.
+    """
+    self.moving.GetIJKToRASMatrix(self.ijkToRAS)
+    region = self.regionOfInterest()
+    parameters = {'mode': mode, 'metric': self.metricName, 'roi': region.key() if region else None,
+                  'sampleSpacing': self.sampleSpacing, 'sampleCount': self.sampleCount,
+                  'pyramidSize': self.pyramidSize, 'stepSize': self.stepSize,
+                  'gradientWindow': self.gradientWindow, 'precision': self.precision}
+    return resultcache.resultKey(
+        [self.contentDigest(self.fixed), self.contentDigest(self.moving)],
+        [self.ijkToWorld(self.fixed), arrayFromMatrix(self.ijkToRAS), self.transformParentToWorld()],
+        parameters)
+
+  def contentDigest(self, volumeNode):
+    """resultcache.arrayDigest of the image data of volumeNode, hashed again only once it is modified"""
+    imageData = volumeNode.GetImageData()
+    modified = (imageData.GetMTime(), imageData.GetPointData().GetScalars().GetMTime())
+    cached = self.contentDigests.get(volumeNode.GetID())
+    if not cached or cached[0] != modified:
+      with self.stats.timer('contentDigest'):
+        cached = (modified, resultcache.arrayDigest(self.volumeArray(volumeNode)))
+      self.contentDigests[volumeNode.GetID()] = cached
+    return cached[1]
+
+  def evaluationCount(self):
+    """Metric evaluations so far, through the cache and in batches"""
+    return self.metricCache.computed + self.stats.get('candidates')['calls']
+
   def stopRegistration(self):
     if self.timer:
       self.timer.stop()
       self.timer = None
-      self.L=[]
-      self.divider= float(1)
+    self.divider= float(1)
+    self.level = 0
+    self.rigidSearch = None
+    self.commitPose(force=True)
       
   def stopRegistrationRotation(self):
-    if self.timer:
-      self.timer.stop()
-      self.timer = None
-      self.L=[]
-      self.divider= float(1)
+    self.stopRegistration()
+
+  def finishRegistration(self):
+    """Stop a converged timer-driven optimizer, log its report and call its finished callback"""
+    logger.info("registration converged: %s", self.scheduler.summary())
+    self.stopRegistration()
+    if self.resultKey and self.scheduler.reason != 'cached':
+      self.registrationResultCache().put(self.resultKey, arrayFromMatrix(self.transform.GetMatrixTransformToParent()),
+                                         self.scheduler.history[-1], self.scheduler.trace)
+    if self.registrationFinished:
+      self.registrationFinished()
+
+  def iterationConverged(self, step, value=None):
+    """
+    Report one optimizer iteration to the scheduler. A converged coarse
+    level hands over to the next finer one; returns whether the
+    registration converged on the finest level.
+    """
+    if value is None:
+      value = self.tick()
+    converged = self.scheduler.update(value, step, self.evaluationCount())
+    if converged and self.level > 0:
+      self.promoteLevel()
+      return False
+    return converged
           
   def processEvent(self,observee,event=None):
 
@@ -403,7 +936,7 @@ class RegmaticLogic(object):
       #if time.time() - self.oldtime > 0.120:
       #  self.actionState = "idle"
       #  self.before = 0
-      print(self.actionState)
+      logger.debug("action state %s", self.actionState)
 
       global fi, theta, psi
       
@@ -445,11 +978,10 @@ class RegmaticLogic(object):
           global center, new_rot_point, mouv_mouse
           center = [0,0,0]
           #################### rotation with fiducial point as center: translation ° rotation ° (-translation) ####################
-          print(self.checked)
           if self.fiducial and self.checked.isChecked() :
             # fiducialNode = slicer.util.getNode('vtkMRMLAnnotationFiducialNode1')
             # fiducialNode.GetFiducialCoordinates(center)
-            self.fiducial.GetFiducialCoordinates(center)
+            center = list(self.fiducialPoints().mean(axis=0))
             new_rot_point = [center[0]-self.tx0,center[1]-self.ty0,center[2]-self.tz0]
             translate_back = [k * -1 for k in new_rot_point]    
             mouv_mouse=[tx,ty,tz]
@@ -463,7 +995,7 @@ class RegmaticLogic(object):
               #self.r.RotateX(ty)
               self.r.RotateWXYZ(ty,1,0,0)
             self.r.Translate(translate_back)  
-            self.transform.ApplyTransformMatrix(self.r.GetMatrix())       
+            self.applyTransformMatrix(self.r.GetMatrix())
             self.x0 = x
             self.y0 = y
             self.z0 = z
@@ -482,7 +1014,7 @@ class RegmaticLogic(object):
               #self.r.RotateX(ty)
               self.r.RotateWXYZ(ty,1,0,0)
             self.r.Translate(translate_back)  
-            self.transform.ApplyTransformMatrix(self.r.GetMatrix())       
+            self.applyTransformMatrix(self.r.GetMatrix())
             self.x0 = x
             self.y0 = y
             self.z0 = z
@@ -513,30 +1045,379 @@ class RegmaticLogic(object):
           
           self.before += 1
        
-        self.colorWindow()
+        self.requestFeedback()
 
   def tick(self):
+    return self.metricCache.get(self.metricKey('tick'), self.computeTick)
 
-    movingRASArray = self.rasArray(self.moving, None, self.fixed)
-    fixedRASArray = self.rasArray(self.fixed, None, self.fixed)
-    weight = numpy.sum(numpy.abs(movingRASArray-fixedRASArray))
+  def weightMax(self):
+    return self.metricCache.get(self.metricKey('weightMax'), self.computeWeightMax)
+
+  def metricKey(self, name, movingToWorld=None):
+    """
+    Key a metric value on the moving volume pose, image and geometry and
+    the sampling parameters, including the pyramid size and working
+    precision that set the level arrays and the units of sampled values.
+    The pose is read from the moving volume's parent transform unless
+    movingToWorld gives it as a 4x4 numpy array.
+    """
+    if movingToWorld is None:
+      movingToWorld = self.movingParentToWorld()
+    region = self.regionOfInterest()
+    self.moving.GetIJKToRASMatrix(self.ijkToRAS)
+    movingImage = (self.moving.GetImageData().GetMTime(), tuple(arrayFromMatrix(self.ijkToRAS).ravel()))
+    return (name, self.metricName, region.key() if region else None,
+            self.fixed.GetID(), self.moving.GetID(), movingImage, self.sampleSpacing, self.sampleCount, self.level, self.fixedImageCache.generation,
+            self.pyramidSize, self.precision, self.metricCache.matrixKey(movingToWorld))
+
+  def computeTick(self):
+    with self.stats.timer('tick'):
+      return self.computeTickValue()
+
+  def computeWeightMax(self):
+    with self.stats.timer('weightMax'):
+      return self.computeWeightMaxValue()
+
+  def computeTickValue(self):
+    if self.sampleCount:
+      return self.registrationEngine().evaluate(self.movingPose()[numpy.newaxis], self.level)[0]
+
+    if self.streamed():
+      weight, wmax = self.streamedMetric()
+      self.metricCache.put(self.metricKey('weightMax'), wmax)
+      return weight
+
+    weight, wmax = self.bufferedMetric()
+    self.metricCache.put(self.metricKey('weightMax'), wmax)
   
     return(weight)
 
-  def weightMax(self):
+  def computeWeightMaxValue(self):
+    if self.sampleCount:
+      return self.registrationEngine().metric(self.level).normalizer(self.movingPose()[numpy.newaxis])[0]
+
+    if self.streamed():
+      weight, wmax = self.streamedMetric()
+      self.metricCache.put(self.metricKey('tick'), weight)
+      return wmax
   
-    movingRASArray = self.rasArray(self.moving, None, self.fixed)
-    fixedRASArray = self.rasArray(self.fixed, None, self.fixed)
-    wmax = numpy.max(([numpy.sum(movingRASArray),numpy.sum(fixedRASArray)]))
+    weight, wmax = self.bufferedMetric()
+    self.metricCache.put(self.metricKey('tick'), weight)
   
     return(wmax)
 
-  def rasArray(self, volumeNode, matrix=None, targetNode=None, debug=True):
+  def bufferedMetric(self, matrix=None):
+    """
+    Returns the (weight, wmax) of the current pose, or of its correction
+    by the RAS to RAS matrix, over the whole resampled volumes. The float
+    reslice output is read in place and every intermediate result goes to
+    the work buffers of the sampling geometry, so that after the first
+    call an evaluation allocates nothing the size of the volume.
+    """
+    if matrix is None:
+      matrix = self.poseCorrection()
+    fixedRASArray = self.fixedRASArray()
+    metric = self.resliceMetric(fixedRASArray)
+    buffers = self.workBuffers(fixedRASArray.shape)
+    allocatedBytes = buffers.allocatedBytes
+    with self.stats.timer('bufferedMetric'):
+      movingRASArray = self.rasArray(self.moving, matrix)
+      result = metric.evaluateBuffered(movingRASArray.ravel(), buffers)
+    self.bufferBytes = buffers.allocatedBytes - allocatedBytes
+    return result
+
+  def workBuffers(self, shape):
+    """Returns the metrics.WorkBuffers of a sampling geometry, allocated once"""
+    if shape not in self.buffers:
+      if len(self.buffers) > 2:
+        self.buffers = {}
+      self.buffers[shape] = metrics.WorkBuffers(int(numpy.prod(shape)))
+    return self.buffers[shape]
+
+  def allocatedBytesPerEvaluation(self):
+    """
+    Bytes of work buffers allocated by the last buffered metric
+    evaluation, or None before the first one; zero once the buffers of
+    the sampling geometry exist.
+    """
+    return self.bufferBytes
+
+  def resliceMetric(self, fixedRASArray):
+    """
+    Returns the metric of metricName prepared for the resampled fixed
+    volume, rebuilt only when that array, the intensity ranges or the
+    metric change.
+    """
+    fixedRange, movingRange = self.intensityRanges()
+    key = (id(fixedRASArray), fixedRange, movingRange, self.metricName)
+    if key != self.currentResliceMetricKey:
+      self.currentResliceMetric = metrics.create(self.metricName, fixedRASArray.ravel(),
+                                                 movingRange, fixedRange)
+      self.currentResliceMetricKey = key
+    return self.currentResliceMetric
+
+  def intensityRanges(self):
     """
-    Returns a numpy array of the given node resampled into RAS space
-    If given, use the passed matrix as a final RAS to RAS transform
+    Returns the (fixed, moving) scalar ranges of the volumes, the bin
+    edges of the binning metrics on both the buffered and the streamed
+    path, since both reslice the volumes' own image data.
     """
+    return (tuple(self.fixed.GetImageData().GetScalarRange()),
+            tuple(self.moving.GetImageData().GetScalarRange()))
 
+  def registrationEngine(self):
+    """
+    Returns the headless RegistrationEngine of the current nodes.
+    Its fixed frame is the parent frame of the transform node, so engine
+    matrices are matrices to parent of the transform node. The engine
+    and its sample sets are kept until the volumes, their placement,
+    the sample count, the metric, the region of interest or the working
+    precision change.
+    """
+    worldToParent = numpy.linalg.inv(self.transformParentToWorld())
+    fixedIJKToRAS = numpy.dot(worldToParent, self.ijkToWorld(self.fixed))
+    region = self.regionOfInterest()
+    if region:
+      region = region.transformed(worldToParent)
+    self.moving.GetIJKToRASMatrix(self.ijkToRAS)
+    movingIJKToRAS = arrayFromMatrix(self.ijkToRAS)
+    fixedPyramid = self.volumePyramid(self.fixed)
+    movingPyramid = self.volumePyramid(self.moving)
+    sampleCount = self.sampleCount or self.defaultSampleCount
+    key = (id(fixedPyramid), id(movingPyramid), tuple(fixedIJKToRAS.ravel()),
+           tuple(movingIJKToRAS.ravel()), sampleCount, self.metricName,
+           region.key() if region else None, self.precision)
+    if key != self.currentEngineKey:
+      self.currentEngine = engine.RegistrationEngine(fixedPyramid, fixedIJKToRAS,
+                                                     movingPyramid, movingIJKToRAS, sampleCount,
+                                                     metricName=self.metricName, roi=region,
+                                                     precision=self.precision)
+      self.currentEngineKey = key
+    self.currentEngine.stepSize = self.stepSize
+    self.currentEngine.gradientWindow = self.gradientWindow
+    self.currentEngine.phaseTranslationInRotation = self.phaseTranslationInRotation
+    return self.currentEngine
+
+  def fiducialPoints(self, fiducial=None):
+    """
+    Returns the (N,3) world RAS positions of fiducial, the fiducial node
+    by default: a single annotation fiducial, an annotation hierarchy
+    (fiducial list) or a markups fiducial node.
+    """
+    if fiducial is None:
+      fiducial = self.fiducial
+    points = []
+    position = [0,0,0]
+    if fiducial.IsA('vtkMRMLAnnotationHierarchyNode'):
+      children = vtk.vtkCollection()
+      fiducial.GetAllChildren(children)
+      for index in range(children.GetNumberOfItems()):
+        child = children.GetItemAsObject(index)
+        if child.IsA('vtkMRMLAnnotationFiducialNode'):
+          child.GetFiducialCoordinates(position)
+          points.append(pose.transformPoints(self.nodeToWorld(child), [position])[0])
+    elif fiducial.IsA('vtkMRMLMarkupsFiducialNode'):
+      for index in range(fiducial.GetNumberOfFiducials()):
+        fiducial.GetNthFiducialPosition(index, position)
+        points.append(list(position))
+      if points:
+        points = list(pose.transformPoints(self.nodeToWorld(fiducial), points))
+    else:
+      fiducial.GetFiducialCoordinates(position)
+      points.append(pose.transformPoints(self.nodeToWorld(fiducial), [position])[0])
+    return numpy.array(points, dtype=numpy.float64).reshape(-1,3)
+
+  def nodeToWorld(self, node):
+    """Returns the 4x4 numpy matrix of the parent transforms of a transformable node"""
+    self.scratchMatrix.Identity()
+    transformNode = node.GetParentTransformNode()
+    if transformNode:
+      transformNode.GetMatrixTransformToWorld(self.scratchMatrix)
+    return arrayFromMatrix(self.scratchMatrix)
+
+  def momentInitialization(self):
+    """
+    Set the transform node to the alignment of the centers of mass and,
+    with momentRotation, principal axes of the volumes, computed on the
+    coarsest pyramid level (see RegistrationEngine.momentMatrix).
+    """
+    with self.stats.timer('momentInitialization'):
+      matrix = self.registrationEngine().momentMatrix(self.momentRotation)
+    self.setTransformMatrix(matrix)
+    self.colorWindow()
+    return matrix
+
+  def defaultInitialization(self):
+    """Run the moment initialization if enabled and the transform node is still the identity"""
+    current = arrayFromMatrix(self.transform.GetMatrixTransformToParent())
+    if self.initializeFromMoments and numpy.allclose(current, numpy.eye(4)):
+      self.momentInitialization()
+
+  def fiducialRegistration(self):
+    """
+    Set the transform node to the least squares rigid fit of the moving
+    fiducials onto the fixed ones, paired in order, as the starting pose
+    of the optimizers. Returns the RMS distance of the pairs after the
+    fit in mm; raises ValueError when they cannot be paired.
+    """
+    if not (self.fiducial and self.movingFiducial):
+      raise ValueError("select fixed and moving fiducials")
+    # the moving fiducials mark the moving volume where it is displayed now
+    movingPoints = pose.transformPoints(numpy.linalg.inv(self.movingParentToWorld()),
+                                        self.fiducialPoints(self.movingFiducial))
+    fixedPoints = pose.transformPoints(numpy.linalg.inv(self.transformParentToWorld()),
+                                       self.fiducialPoints())
+    matrix = pose.rigidFit(movingPoints, fixedPoints)
+    self.setTransformMatrix(matrix)
+    residuals = pose.transformPoints(matrix, movingPoints) - fixedPoints
+    residual = numpy.sqrt(numpy.mean(numpy.sum(residuals**2, axis=1)))
+    logger.info("fiducial fit of %d pairs: %.2f mm RMS", len(fixedPoints), residual)
+    self.colorWindow()
+    return residual
+
+  def regionOfInterest(self):
+    """
+    Returns the roi.RegionOfInterest in world coordinates around the
+    fiducials, or None when no region is selected.
+    """
+    if not (self.roiShape and self.fiducial):
+      return None
+    points = self.fiducialPoints()
+    if not len(points):
+      return None
+    return roi.RegionOfInterest(points, self.roiRadius, self.roiShape)
+
+  def movingPose(self):
+    """Returns the moving volume pose in the engine frame"""
+    return numpy.dot(numpy.linalg.inv(self.transformParentToWorld()), self.movingParentToWorld())
+
+  def movingParentToWorld(self):
+    """
+    Returns the parent to world matrix of the moving volume as a numpy
+    array, including an optimizer pose not yet written to the transform node
+    """
+    if self.poseDirty and self.moving.GetParentTransformNode() == self.transform:
+      return numpy.dot(self.transformParentToWorld(), self.pose.matrix())
+    self.movingToWorld.Identity()
+    transformNode = self.moving.GetParentTransformNode()
+    if transformNode:
+      transformNode.GetMatrixTransformToWorld(self.movingToWorld)
+    return arrayFromMatrix(self.movingToWorld)
+
+  def optimizerPose(self):
+    """
+    Returns the pose.PoseState the optimizers move, with rotations about
+    the center of the fixed volume (or of the region of interest). It
+    starts again from the transform node whenever something else moved
+    the node since the last commit.
+    """
+    if not self.poseDirty:
+      nodeMatrix = arrayFromMatrix(self.transform.GetMatrixTransformToParent())
+      if self.pose is None or not numpy.allclose(nodeMatrix, self.committedMatrix):
+        self.pose = pose.PoseState(nodeMatrix, self.rotationCenter())
+        self.committedMatrix = nodeMatrix
+    return self.pose
+
+  def rotationCenter(self):
+    """Center of the region of interest, or of the fixed volume, in the parent frame of the transform node"""
+    region = self.regionOfInterest()
+    if region:
+      center = region.center()
+    else:
+      bounds = [0,]*6
+      self.fixed.GetRASBounds(bounds)
+      center = 0.5 * (numpy.array(bounds[0::2]) + numpy.array(bounds[1::2]))
+    return pose.transformPoints(numpy.linalg.inv(self.transformParentToWorld()), [center])[0]
+
+  def movePose(self, offset):
+    """Move the optimizer pose by the six parameter offset; the node follows at the next commit"""
+    self.optimizerPose().move(offset)
+    self.poseDirty = True
+
+  def commitPose(self, force=False):
+    """
+    Write the optimizer pose to the transform node, at most every
+    commitInterval seconds unless force is set.
+    """
+    if not self.poseDirty or (not force and time.time() - self.lastCommit < self.commitInterval):
+      return
+    self.writeTransformMatrix(self.pose.matrix())
+
+  def poseCorrection(self):
+    """
+    Returns the RAS to RAS vtkMatrix4x4 moving the volume from the pose
+    of the transform node to the uncommitted optimizer pose, or None
+    """
+    if not (self.poseDirty and self.moving.GetParentTransformNode() == self.transform):
+      return None
+    parentToWorld = self.transformParentToWorld()
+    nodeMatrix = arrayFromMatrix(self.transform.GetMatrixTransformToParent())
+    correction = numpy.dot(numpy.dot(parentToWorld, self.pose.matrix()),
+                           numpy.linalg.inv(numpy.dot(parentToWorld, nodeMatrix)))
+    return matrixFromArray(correction)
+
+  def volumePyramid(self, volumeNode):
+    """
+    Returns the gaussian pyramid of volumeNode, built once per node
+    and rebuilt only when its image data is modified.
+    """
+    key = (volumeNode.GetImageData().GetMTime(), self.pyramidSize)
+    cached = self.pyramids.get(volumeNode.GetID())
+    if not cached or cached[0] != key:
+      cached = (key, pyramid.Pyramid(self.volumeArray(volumeNode), self.pyramidSize or numpy.inf))
+      self.pyramids[volumeNode.GetID()] = cached
+    return cached[1]
+
+  def levelCount(self):
+    """Number of pyramid levels the optimizers go through; 1 without sample points"""
+    if not (self.sampleCount and self.pyramidSize):
+      return 1
+    return self.registrationEngine().levelCount()
+
+  def levelScale(self):
+    """Step size multiplier of the current level: its voxels are 2**level larger"""
+    return 2**self.level
+
+  def promoteLevel(self):
+    """Continue the search on the next finer pyramid level"""
+    self.level -= 1
+    self.rigidSearch = None
+    if self.scheduler:
+      self.scheduler.restart()
+    logger.debug("level %d", self.level)
+
+  def volumeArray(self, volumeNode):
+    """Returns the image data of volumeNode as a (k,j,i) numpy array, without copying"""
+    imageData = volumeNode.GetImageData()
+    shape = list(imageData.GetDimensions())
+    shape.reverse()
+    with self.stats.timer('conversion'):
+      return vtk.util.numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+
+  def ijkToWorld(self, volumeNode):
+    """Returns the IJK to world RAS matrix of volumeNode, including its parent transforms"""
+    volumeNode.GetIJKToRASMatrix(self.ijkToRAS)
+    transformNode = volumeNode.GetParentTransformNode()
+    if transformNode:
+      self.scratchMatrix.Identity()
+      transformNode.GetMatrixTransformToWorld(self.scratchMatrix)
+      self.ijkToRAS.Multiply4x4(self.scratchMatrix, self.ijkToRAS, self.ijkToRAS)
+    return arrayFromMatrix(self.ijkToRAS)
+
+  def fixedRASArray(self):
+    """
+    Returns the fixed volume resampled on the sampling geometry.
+    The fixed volume does not move during a search, so the
+    array is served from self.fixedImageCache.
+    """
+    return self.fixedImageCache.get(self.fixed, self.sampleSpacing, self.rasArray,
+                                    bounds=self.samplingGeometry().key())
+
+  def volumeRASToIJK(self, volumeNode, matrix=None):
+    """
+    Returns the world to IJK matrix of volumeNode, through its parent
+    transforms and, if given, the final RAS to RAS transform matrix.
+    """
     # get the transform from image space to world space
     volumeNode.GetIJKToRASMatrix(self.ijkToRAS)
     transformNode = volumeNode.GetParentTransformNode()
@@ -550,48 +1431,198 @@ class RegmaticLogic(object):
 
     self.rasToIJK.DeepCopy(self.ijkToRAS)
     self.rasToIJK.Invert()
+    return self.rasToIJK
 
-    # use the matrix to extract the volume and convert it to an array
-    self.reslice.SetInterpolationModeToLinear()
-    self.reslice.InterpolateOn()
-    self.resliceTransform.SetMatrix(self.rasToIJK)
-    self.reslice.SetResliceTransform(self.resliceTransform)
-    # TODO: set the dimensions and spacing
-    #self.reslice.SetInformationInput( nodes[template_name].GetImageData() )
-    self.reslice.SetInput( volumeNode.GetImageData() )
-    self.reslice.UpdateWholeExtent()
-    rasImage = self.reslice.GetOutput()
-    shape = list(rasImage.GetDimensions())
-    shape.reverse()
-    rasArray = vtk.util.numpy_support.vtk_to_numpy(rasImage.GetPointData().GetScalars()).reshape(shape)
-
-    if targetNode:
-      bounds = [0,]*6
-      targetNode.GetRASBounds(bounds)
-      self.reslice.SetOutputExtent(0, (bounds[1]-bounds[0])/self.sampleSpacing,
-                                   0, (bounds[3]-bounds[2])/self.sampleSpacing,
-                                   0, (bounds[5]-bounds[4])/self.sampleSpacing)
-      self.reslice.SetOutputOrigin(bounds[0],bounds[2],bounds[4])
-
-    self.reslice.SetOutputSpacing([self.sampleSpacing,]*3)
-
-    return rasArray
-
-  def colorWindow(self):
+  def samplingGeometry(self):
+    """
+    Returns the SamplingGeometry of the fixed RAS bounds, clipped to the
+    region of interest, at sampleSpacing. It is rebuilt only when one of
+    those changes, and every resample of either volume uses it.
+    """
+    bounds = [0,]*6
+    self.fixed.GetRASBounds(bounds)
+    region = self.regionOfInterest()
+    key = (tuple(bounds), self.sampleSpacing, region.key() if region else None)
+    if key != self.currentGeometryKey:
+      lower, upper = numpy.array(bounds[0::2]), numpy.array(bounds[1::2])
+      if region:
+        regionLower, regionUpper = region.bounds()
+        lower, upper = numpy.maximum(lower, regionLower), numpy.minimum(upper, regionUpper)
+        if numpy.any(upper < lower):
+          raise ValueError("region of interest is outside of the fixed volume")
+      self.currentGeometry = SamplingGeometry.fromBounds(lower, upper, self.sampleSpacing)
+      self.currentGeometryKey = key
+    return self.currentGeometry
+
+  def reslicer(self, volumeNode):
+    """
+    Returns the (vtkImageReslice, vtkTransform) pipeline of volumeNode.
+    Each volume has its own, so the output of one resample is never
+    overwritten by a resample of the other volume.
+    """
+    if volumeNode.GetID() not in self.reslicers:
+      reslice = vtk.vtkImageReslice()
+      reslice.SetOutputScalarTypeToFloat()
+      reslice.SetInterpolationModeToLinear()
+      reslice.InterpolateOn()
+      transform = vtk.vtkTransform()
+      reslice.SetResliceTransform(transform)
+      self.reslicers[volumeNode.GetID()] = (reslice, transform)
+    return self.reslicers[volumeNode.GetID()]
+
+  def rasArray(self, volumeNode, matrix=None, first=0, last=None):
+    """
+    Returns a numpy array of the given node resampled on the sampling
+    geometry, slices first to last-1 of it (all by default).
+    If given, use the passed matrix as a final RAS to RAS transform.
+    The array is a view of the reslice output, valid until the next
+    resample of the same node.
+    """
+    geometry = self.samplingGeometry()
+    reslice, transform = self.reslicer(volumeNode)
+    transform.SetMatrix(self.volumeRASToIJK(volumeNode, matrix))
+    reslice.SetInput(volumeNode.GetImageData())
+    geometry.apply(reslice, first, last)
+    with self.stats.timer('reslice'):
+      reslice.Update()
+    with self.stats.timer('conversion'):
+      scalars = reslice.GetOutput().GetPointData().GetScalars()
+      return vtk.util.numpy_support.vtk_to_numpy(scalars).reshape(geometry.shape(first, last))
+
+  def streamed(self):
+    """
+    Whether the metric without sample points is computed slab by slab:
+    for volumes larger than slabVoxels, and on the grid of the region
+    of interest when there is one
+    """
+    if self.sampleCount:
+      return False
+    if self.regionOfInterest():
+      return True
+    return self.samplingGeometry().voxelCount() > self.slabVoxels
+
+  def slabs(self, geometry):
+    """Yields the (first, last+1) slice ranges of slabs of at most about slabVoxels voxels"""
+    dims = geometry.dimensions
+    thickness = max(1, self.slabVoxels // (dims[0]*dims[1]))
+    for first in range(0, dims[2], thickness):
+      yield first, min(first + thickness, dims[2])
+
+  def fixedRASMemmap(self):
+    """
+    Returns the fixed volume resampled on the sampling geometry, written
+    slab by slab into a memory-mapped temporary file and kept in
+    self.fixedImageCache like fixedRASArray.
+    """
+    return self.fixedImageCache.get(self.fixed, self.sampleSpacing, self.streamFixed, streamed=True,
+                                    bounds=self.samplingGeometry().key())
+
+  def streamFixed(self, volumeNode):
+    geometry = self.samplingGeometry()
+    fixedArray = numpy.memmap(tempfile.TemporaryFile(), dtype=numpy.float32, mode='w+',
+                              shape=geometry.shape())
+    for first, last in self.slabs(geometry):
+      fixedArray[first:last] = self.rasArray(volumeNode, None, first, last)
+    fixedArray.flush()
+    return fixedArray
+
+  def streamedMetric(self, matrix=None):
+    """
+    Returns the (weight, wmax) of the current pose, or of its correction
+    by the RAS to RAS matrix, accumulated slab by slab so that memory
+    stays a small multiple of slabVoxels instead of several resampled
+    volumes. Only the voxels of the region of interest, if any, count.
+    """
+    if matrix is None:
+      matrix = self.poseCorrection()
+    with self.stats.timer('streamedMetric'):
+      fixedArray = self.fixedRASMemmap()
+      geometry = self.samplingGeometry()
+      region = self.regionOfInterest()
+      def slabs():
+        for first, last in self.slabs(geometry):
+          fixedSlab = fixedArray[first:last]
+          movingSlab = self.rasArray(self.moving, matrix, first, last)
+          if region:
+            inside = self.slabMask(region, geometry, first, last)
+            fixedSlab, movingSlab = fixedSlab[inside], movingSlab[inside]
+          yield fixedSlab, movingSlab
+      fixedRange, movingRange = self.intensityRanges()
+      return metrics.accumulate(self.metricName, slabs(), fixedRange, movingRange)
+
+  def slabMask(self, region, geometry, first, last):
+    """Returns whether each voxel of the slab of the sampling geometry lies in region"""
+    key = (region.key(), geometry.key(), first)
+    if key not in self.slabMasks:
+      if len(self.slabMasks) > 64:
+        self.slabMasks = {}
+      points = geometry.points(first, last)
+      self.slabMasks[key] = region.contains(points).reshape(geometry.shape(first, last))
+    return self.slabMasks[key]
+
+  def colorWindow(self, level=None):
+    """
+    Show the metric of the current pose as the background color of the
+    feedback window, from green (match) to red. With level, a quick
+    estimate on feedbackSampleCount points of that pyramid level is shown
+    instead of the full resolution value.
+    """
     if not self.viewer:
       self.viewer = vtk.vtkRenderWindow()
       self.render= vtk.vtkRenderer()
+      self.viewer.AddRenderer(self.render)
     ratio,red,green = 0,0,0
-    ratio = self.tick()/float(self.weightMax())
+    if level is None:
+      ratio = self.tick()/float(self.weightMax())
+    else:
+      with self.stats.timer('feedback'):
+        metric = self.registrationEngine().metric(level, self.feedbackSampleCount)
+        movingPose = self.movingPose()[numpy.newaxis]
+        ratio = metric.evaluate(movingPose)[0]/float(metric.normalizer(movingPose)[0])
+    ratio = min(max(ratio, 0.), 1.)
     red = ratio
     green = 1-ratio
-    self.render.SetBackground(red,green,0)   
-    self.viewer.AddRenderer(self.render)
-    self.viewer.Render()  
+    with self.stats.timer('colorWindow'):
+      self.render.SetBackground(red,green,0)
+      self.viewer.Render()
+
+  def requestFeedback(self):
+    """
+    Coalesce the metric feedback of interactive moves: while dragging,
+    a coarse estimate is shown at most every feedbackInterval ms, and the
+    full resolution metric once the pointer has been still for
+    feedbackIdleDelay ms.
+    """
+    if not self.feedbackTimer:
+      self.feedbackTimer = qt.QTimer()
+      self.feedbackTimer.singleShot = True
+      self.feedbackTimer.connect('timeout()', self.onFeedbackTimeout)
+      self.idleTimer = qt.QTimer()
+      self.idleTimer.singleShot = True
+      self.idleTimer.connect('timeout()', self.onIdleTimeout)
+    self.feedbackPending = True
+    if not self.feedbackTimer.isActive():
+      self.feedbackTimer.start(self.feedbackInterval)
+    self.idleTimer.start(self.feedbackIdleDelay)
+
+  def onFeedbackTimeout(self):
+    if self.feedbackPending:
+      self.feedbackPending = False
+      self.colorWindow(self.registrationEngine().levelCount()-1)
+
+  def onIdleTimeout(self):
+    self.feedbackPending = False
+    self.colorWindow()
+
+  def stopFeedback(self):
+    if self.feedbackTimer:
+      self.feedbackTimer.stop()
+      self.idleTimer.stop()
+    self.feedbackPending = False
 
   def stop(self):
     self.actionState = "idle"
-    print("here")
+    self.stopFeedback()
     self.removeObservers()   
 
   def removeObservers(self):
@@ -602,152 +1633,425 @@ class RegmaticLogic(object):
     self.sliceWidgetsPerStyle = {}
         
   def translate(self,x,y,z):
-    self.m.SetElement(0,3,x)
-    self.m.SetElement(1,3,y)
-    self.m.SetElement(2,3,z)
+    with self.stats.timer('transformUpdate'):
+      wasModifying = self.transform.StartModify()
+      self.m.SetElement(0,3,x)
+      self.m.SetElement(1,3,y)
+      self.m.SetElement(2,3,z)
+      self.transform.EndModify(wasModifying)
+
+  def applyTransformMatrix(self, matrix):
+    """Compose the vtkMatrix4x4 matrix onto the transform node"""
+    with self.stats.timer('transformUpdate'):
+      wasModifying = self.transform.StartModify()
+      self.transform.ApplyTransformMatrix(matrix)
+      self.transform.EndModify(wasModifying)
+
+  def setTransformMatrix(self, array):
+    """
+    Replace the matrix to parent of the transform node by a 4x4 numpy
+    array; the optimizer pose starts again from it.
+    """
+    self.pose = None
+    self.writeTransformMatrix(array)
+
+  def writeTransformMatrix(self, array):
+    """Write a 4x4 numpy array to the transform node as a single MRML modification"""
+    with self.stats.timer('transformUpdate'):
+      wasModifying = self.transform.StartModify()
+      self.transform.GetMatrixTransformToParent().DeepCopy(matrixFromArray(array))
+      self.transform.EndModify(wasModifying)
+    self.committedMatrix = numpy.array(array, dtype=numpy.float64)
+    self.poseDirty = False
+    self.lastCommit = time.time()
 
   def rotate(self,fi,theta,psi):
-    self.tx0 = self.m.GetElement(0,3)
-    self.ty0 = self.m.GetElement(1,3)
-    self.tz0 = self.m.GetElement(2,3)
-    self.r = vtk.vtkTransform()
-    self.r.Translate([self.tx0,self.ty0,self.tz0])
-    #self.r.Translate(new_rot_point)
-    self.r.RotateWXYZ(theta,0,1,0)         
-    self.r.RotateWXYZ(psi,0,0,1)  
-    self.r.RotateWXYZ(fi,1,0,0)
-    self.r.Translate([-self.tx0,-self.ty0,-self.tz0])  
-    self.transform.ApplyTransformMatrix(self.r.GetMatrix()) 
+    self.movePose([0,0,0,fi,theta,psi])
   
   def rotateRegistrationX(self,fiStep,nbIteration):
     ######################## rotation X axis ############################################
-    #print("before iteration" , self.tick())
-    fiBestValue,fiBestMove = self.tick(), 0
-    for fi in xrange(1,nbIteration+1):
-      self.rotate(fiStep,0,0)
-      if self.tick() < fiBestValue:
-        fiBestValue = self.tick()
-        fiBestMove = fi
-        self.colorWindow()
-        print("fi", fi , fiBestValue)
-    if fiBestMove == 0:                         
-      self.rotate(-fiStep*(nbIteration),0,0)
-    else:
-      self.rotate(fiStep*(fiBestMove - nbIteration),0,0)
-    #print("after iteration",self.tick())
-    print("fi", fiBestMove , fiBestValue)
+    fiBestAngle, fiBestValue = self.rotateRegistrationAxis(0,fiStep,nbIteration)
+    if fiBestAngle:
+      self.rotate(fiBestAngle,0,0)
+    logger.debug("fi %s %s", fiBestAngle, fiBestValue)
     
   def rotateRegistrationY(self,thetaStep,nbIteration):  
     #################### rotation Y axis #########################################
-    #print("before iteration" , self.tick())
-    thetaBestValue,thetaBestMove = self.tick(), 0
-    for theta in xrange(1,nbIteration+1):
-      self.rotate(0,thetaStep,0)
-      if self.tick() < thetaBestValue:
-        thetaBestValue = self.tick()
-        thetaBestMove = theta
-        self.colorWindow()
-        print("theta", theta , thetaBestValue)
-    if thetaBestMove == 0:                         
-      self.rotate(0,-thetaStep*(nbIteration),0)
-    else:
-      self.rotate(0,thetaStep*(thetaBestMove - nbIteration),0)
-    #print("after iteration",self.tick())
-    print("theta", thetaBestMove , thetaBestValue)
+    thetaBestAngle, thetaBestValue = self.rotateRegistrationAxis(1,thetaStep,nbIteration)
+    if thetaBestAngle:
+      self.rotate(0,thetaBestAngle,0)
+    logger.debug("theta %s %s", thetaBestAngle, thetaBestValue)
   
   def rotateRegistrationZ(self,psiStep,nbIteration): 
     #################### rotation Z axis ########################################
-    #print("before iteration" , self.tick())
-    psiBestValue,psiBestMove = self.tick(), 0
-    for psi in xrange(1,nbIteration+1):
-      self.rotate(0,0,psiStep)
-      if self.tick() < psiBestValue:
-        psiBestValue = self.tick()
-        psiBestMove = psi
-        self.colorWindow()
-        print("psi", psi , psiBestValue)
-    if psiBestMove == 0:                         
-      self.rotate(0,0,-psiStep*(nbIteration))
-    else:
-      self.rotate(0,0,psiStep*(psiBestMove - nbIteration))
-    #print("after iteration",self.tick())
-    print("psi", psiBestMove , psiBestValue)
-      
+    psiBestAngle, psiBestValue = self.rotateRegistrationAxis(2,psiStep,nbIteration)
+    if psiBestAngle:
+      self.rotate(0,0,psiBestAngle)
+    logger.debug("psi %s %s", psiBestAngle, psiBestValue)
+
+  def rotateRegistrationAxis(self,axis,step,nbIteration):
+    """
+    Line search of the rotation of the optimizer pose about axis (0, 1
+    or 2 for X, Y or Z), within nbIteration steps either way. Returns the
+    best angle in degrees (0 when no rotation improves on the current
+    pose) and its value.
+    """
+    return self.lineSearchPose(3+axis, step, nbIteration)
+
   def translateRegistration(self,iMax,jMax,kMax,iStep,jStep,kStep):
-    self.tx0 = self.m.GetElement(0,3)
-    self.ty0 = self.m.GetElement(1,3)
-    self.tz0 = self.m.GetElement(2,3)
-    self.WMAX = self.weightMax()
-    iBestValue,iBestMove = 2*self.WMAX,0
-    jBestValue,jBestMove = 2*self.WMAX,0
-    kBestValue,kBestMove = 2*self.WMAX,0
-    fiBestValue,fiBestMove = 2*self.WMAX,0
-    theta_bestValue,theta_bestMove = 2*self.WMAX,0
-    psiBestValue,psiBestMove = 2*self.WMAX,0
-    
-    total = 2*(iMax+jMax+kMax)-6
-    for i in xrange(-iMax,iMax):
-      self.translate(self.tx0+i*iStep,self.ty0,self.tz0)
-      if self.tick() <= iBestValue:
-        iBestValue = self.tick()
-        iBestMove = i*iStep
-        self.colorWindow()
-    for j in xrange(-jMax,jMax):
-      self.translate(self.tx0+ iBestMove,self.ty0+j*jStep,self.tz0)
-      if self.tick() <= jBestValue:
-        jBestValue = self.tick()
-        jBestMove = j*jStep
-        self.colorWindow()
-    for k in xrange(-kMax,kMax):
-      self.translate(self.tx0 + iBestMove , self.ty0 + jBestMove , self.tz0 + k*kStep)
-      if self.tick() <= kBestValue:
-        kBestValue = self.tick()
-        kBestMove = k*kStep
-        self.colorWindow()
-    self.translate(-iMax*iStep + self.tx0,-jMax*jStep + self.ty0,-kMax*kStep + self.tz0)
-    self.translate(iBestMove + self.tx0 , jBestMove + self.ty0 , kBestMove + self.tz0)
-    print(self.tick())
-    
+    bestMove = numpy.zeros(6)
+    for axis,(count,step) in enumerate(((iMax,iStep),(jMax,jStep),(kMax,kStep))):
+      if count == 0:
+        continue
+      bestMove[axis] = self.lineSearchPose(axis, step, count)[0]
+    self.movePose(bestMove)
+    self.colorWindow()
 
+  def lineSearchPose(self, index, step, count):
+    """
+    optimizers.lineSearch of the optimizer pose along its rigid parameter
+    index, within count steps either way, until the bracket is narrower
+    than lineSearchTolerance. Returns the best offset (0 when nothing
+    improves) and its value.
+    """
+    state = self.optimizerPose()
+    def evaluate(offsets):
+      params = numpy.zeros((len(offsets),6))
+      params[:,index] = offsets
+      return self.evaluateBatch(state.candidates(params))
+    offset, value, evaluations = optimizers.lineSearch(evaluate, step, self.lineSearchTolerance(index),
+                                                       maxDistance=abs(step)*count, value=self.tick())
+    logger.debug("line search %d: %d evaluations", index, evaluations)
+    return offset, value
+
+  def lineSearchTolerance(self, index):
+    """
+    Resolution of rigid parameter index: the sample spacing, or with
+    sample points the voxel size of the current level, in mm, and for
+    rotations the angle that moves the fixed volume corners by as much.
+    """
+    if self.sampleCount:
+      resolution = min(self.fixed.GetSpacing()) * self.levelScale()
+    else:
+      resolution = self.sampleSpacing
+    scales = self.rigidScales()
+    return resolution * scales[index] / scales[0]
+    
+  def evaluateBatch(self, candidates):
+    """
+    Returns the metric values of a (K,4,4) stack of candidate matrices
+    for the transform node, which the moving volume observes.
+    With sample points the K values come from one vectorized pass;
+    either way the transform node itself is not modified.
+    """
+    with self.stats.timer('evaluateBatch'):
+      values = self.computeBatch(numpy.asarray(candidates, dtype=numpy.float64))
+    self.stats.count('candidates', len(candidates))
+    return values
+
+  def computeBatch(self, candidates):
+    movingToWorld = numpy.einsum('ab,kbc->kac', self.transformParentToWorld(), candidates)
+    if self.sampleCount:
+      values = self.registrationEngine().evaluate(candidates, self.level)
+    else:
+      # resample through a RAS to RAS correction of the current pose
+      worldToCurrent = numpy.linalg.inv(self.ijkToWorld(self.moving))
+      self.moving.GetIJKToRASMatrix(self.ijkToRAS)
+      ijkToRAS = arrayFromMatrix(self.ijkToRAS)
+      evaluate = self.streamedMetric if self.streamed() else self.bufferedMetric
+      values = numpy.empty(len(candidates))
+      for index, candidate in enumerate(movingToWorld):
+        correction = matrixFromArray(numpy.dot(numpy.dot(candidate, ijkToRAS), worldToCurrent))
+        values[index] = evaluate(correction)[0]
+    for candidate, value in zip(movingToWorld, values):
+      self.metricCache.put(self.metricKey('tick', candidate), value)
+    return values
+
+  def transformParentToWorld(self):
+    """Returns the parent to world matrix of the transform node as a numpy array"""
+    self.scratchMatrix.Identity()
+    parentNode = self.transform.GetParentTransformNode() if self.transform else None
+    if parentNode:
+      parentNode.GetMatrixTransformToWorld(self.scratchMatrix)
+    return arrayFromMatrix(self.scratchMatrix)
+
+  def candidatesPerSecond(self):
+    """Throughput of evaluateBatch since the logic was created"""
+    seconds = self.stats.get('evaluateBatch')['seconds']
+    if not seconds:
+      return 0.
+    return self.stats.get('candidates')['calls'] / seconds
 
   def registration(self):
-    self.L.append(self.tick())
-    #print("L",self.L)
-    if self.L[-1] == self.L[-2]:
+    """One timer tick of translation sweeps: as many passes as fit in the tick budget"""
+    self.scheduler.startTick()
+    converged = False
+    while not (converged or self.scheduler.expired()):
+      converged = self.iterationConverged(self.translationPass())
+    self.colorWindow()
+    self.commitPose()
+    if converged:
+      self.finishRegistration()
+
+  def translationPass(self):
+    """
+    Sweep the three translation axes once; returns the largest step in
+    mm. Level changes are left to iterationConverged.
+    """
+    history = self.scheduler.history
+    if self.level == 0 and len(history) > 1 and history[-1] == history[-2]:
+      # a pass without progress on the finest level refines the sweep steps
       self.divider *= float(2)
-    else:
-      self.divider *= float(1)
     self.WMAX = self.weightMax()
-    iStep = max([int((self.tick()/float(self.WMAX))**2*15),0.1])
-    print("istep",iStep)
+    scale = self.levelScale()
+    iStep = max([int((self.tick()/float(self.WMAX))**2*15),0.1])*scale
+    logger.debug("istep %s", iStep)
     self.translateRegistration(10,0,0,iStep/self.divider,1,1)
-    jStep = max([int((self.tick()/float(self.WMAX))**2*15),0.1])
-    print("jstep",jStep)
+    jStep = max([int((self.tick()/float(self.WMAX))**2*15),0.1])*scale
+    logger.debug("jstep %s", jStep)
     self.translateRegistration(0,10,0,1,jStep/self.divider,1)
-    kStep = max([int((self.tick()/float(self.WMAX))**2*15),0.1])
-    print("kstep",kStep)
+    kStep = max([int((self.tick()/float(self.WMAX))**2*15),0.1])*scale
+    logger.debug("kstep %s", kStep)
     self.translateRegistration(0,0,10,1,1,kStep/self.divider)
-
-    print(self.tick())
-    self.colorWindow()
+    logger.debug("registration %s", self.tick())
+    return max(iStep, jStep, kStep)/self.divider
     
   def registrationRotation(self):
+    """One timer tick of rotation sweeps: as many passes as fit in the tick budget"""
+    self.scheduler.startTick()
+    converged = False
+    while not (converged or self.scheduler.expired()):
+      converged = self.iterationConverged(self.rotationPass())
+    self.commitPose()
+    if converged:
+      self.finishRegistration()
+
+  def rotationPass(self):
+    """
+    Search the three rotation axes once; returns the step in degrees.
+    Level changes are left to iterationConverged.
+    """
     self.WMAX = self.weightMax()
     
     self.step = min([max([(self.tick()/float(self.WMAX))**2*15,0.01]),self.step])
-    print("stepsize",self.step)
-    self.rotateRegistrationX( self.step,10)
-    self.rotateRegistrationX(-self.step,10)
-    self.rotateRegistrationY( self.step,10)
-    self.rotateRegistrationY( -self.step,10)
-    self.rotateRegistrationZ( self.step,10)
-    self.rotateRegistrationZ( -self.step,10)
-    print(self.tick())   
+    step = self.step*self.levelScale()
+    logger.debug("stepsize %s", step)
+    self.rotateRegistrationX(step,10)
+    self.rotateRegistrationY(step,10)
+    self.rotateRegistrationZ(step,10)
+    if self.phaseTranslationInRotation:
+      self.phaseTranslationStep()
+    logger.debug("rotation %s", self.tick())
     #self.colorWindow()  
+    return step
+
+  def registrationRigid(self):
+    """One timer tick of the simplex search over the six rigid parameters, within the tick budget"""
+    self.scheduler.startTick()
+    converged = False
+    while not (converged or self.scheduler.expired()):
+      search = self.rigidSearch or self.startRigidLevel()
+      search.iterate()
+      self.movePose(search.params() - self.rigidApplied)
+      self.rigidApplied = search.params()
+      converged = self.iterationConverged(search.size(), search.value())
+    self.colorWindow()
+    self.commitPose()
+    if converged:
+      self.finishRegistration()
+
+  def startRigidLevel(self):
+    """Returns a new optimizers.NelderMead search of the current level around the optimizer pose"""
+    state = self.optimizerPose()
+    start = numpy.array(state.params)
+    self.rigidApplied = numpy.zeros(6)
+    # simplex points are offsets from the parameters at the start of the
+    # level, so they score the very poses registrationRigid commits
+    evaluate = lambda params: self.evaluateBatch(state.candidates(start + params - state.params))
+    self.rigidSearch = optimizers.NelderMead(evaluate, self.rigidScales(), self.rigidSimplexSize)
+    return self.rigidSearch
+
+  def rigidScales(self):
+    """Units of the six rigid parameters (mm, degrees) at the current level, see pose.parameterScales"""
+    if self.sampleCount:
+      return self.registrationEngine().parameterScales(self.level)
+    bounds = [0,]*6
+    self.fixed.GetRASBounds(bounds)
+    extent = numpy.array(bounds[1::2]) - numpy.array(bounds[0::2])
+    window = min(self.fixed.GetSpacing()) * self.levelScale() * self.gradientWindow
+    return pose.parameterScales(window, 0.5 * numpy.linalg.norm(extent))
   
+  def gradientRegistration(self):
+    """
+    Minimize the metric over the six rigid parameters by gradient
+    descent, from the coarsest pyramid level down to full resolution.
+    """
+    self.defaultInitialization()
+    registrationEngine = self.registrationEngine()
+    for level in reversed(xrange(self.levelCount())):
+      self.level = level
+      state = self.optimizerPose()
+      evaluate = lambda params: self.evaluateBatch(state.candidates(params))
+      params, value, evaluations = registrationEngine.optimize(evaluate, 'gradient', level)
+      self.movePose(params)
+      logger.debug("gradient level %d: %d evaluations, %s", level, evaluations, value)
+    self.level = 0
+    self.commitPose(force=True)
+    self.colorWindow()
+
+  def phaseRegistration(self):
+    """
+    Translate the moving volume by phase correlation from the coarsest
+    pyramid level down to full resolution, with a sub-voxel polish of
+    the metric on each level (engine mode 'phase').
+    """
+    self.defaultInitialization()
+    self.commitPose(force=True)
+    matrix = arrayFromMatrix(self.transform.GetMatrixTransformToParent())
+    with self.stats.timer('phaseRegistration'):
+      matrix, stats = self.registrationEngine().register(matrix, 'phase')
+    self.setTransformMatrix(matrix)
+    logger.debug("phase: %s", stats)
+    self.colorWindow()
+
+  def phaseTranslationStep(self):
+    """Translate the optimizer pose by phase correlation on the current level, when it improves the metric"""
+    current = self.optimizerPose().matrix()
+    matrix, value, evaluations = self.registrationEngine().phaseTranslation(current, self.level)
+    self.movePose(numpy.concatenate((matrix[:3,3] - current[:3,3], numpy.zeros(3))))
+
+  def startBackgroundRegistration(self, mode, finished=None):
+    """
+    Run the 'translation', 'rotation', 'gradient', 'rigid' or 'phase' optimizer of a
+    snapshot of the registration engine on a worker thread. The best
+    transform found so far is applied every pollInterval milliseconds
+    and finished is called once the worker is done or cancelled.
+    """
+    self.stopBackgroundRegistration()
+    self.commitPose(force=True)
+    self.defaultInitialization()
+    matrix = arrayFromMatrix(self.transform.GetMatrixTransformToParent())
+    self.worker = worker.RegistrationThread(self.registrationEngine().snapshot(), matrix, mode)
+    self.workerFinished = finished
+    self.worker.start()
+    self.workerTimer = qt.QTimer()
+    self.workerTimer.setInterval(self.pollInterval)
+    self.workerTimer.connect('timeout()', self.pollBackgroundRegistration)
+    self.workerTimer.start()
+
+  def pollBackgroundRegistration(self):
+    matrix = self.worker.poll()
+    if matrix is not None:
+      self.setTransformMatrix(matrix)
+    if self.worker.is_alive():
+      return
+    self.workerTimer.stop()
+    self.workerTimer = None
+    if self.worker.error:
+      logger.error("background registration failed: %s", self.worker.error)
+      qt.QMessageBox.warning(slicer.util.mainWindow(), "Regmatic",
+                             "Background registration failed: %s" % self.worker.error)
+    elif not self.worker.cancelled.is_set():
+      self.setTransformMatrix(self.worker.matrix)
+    logger.debug("background: %d evaluations, %s", self.worker.evaluations, self.worker.stats)
+    self.worker = None
+    self.colorWindow()
+    if self.workerFinished:
+      self.workerFinished()
+
+  def stopBackgroundRegistration(self):
+    """Request cancellation; the worker stops before its next evaluation"""
+    if self.worker:
+      self.worker.cancel()
+
+  def multiStartRotation(self, processes=None):
+    """
+    Search rotations from rotationStarts perturbations of the current pose
+    (within rotationSpread degrees) on a thread pool, since worker
+    processes cannot be spawned from Slicer, at the coarsest pyramid
+    level, and apply the best pose. Returns the per-start scores.
+    """
+    self.commitPose(force=True)
+    registrationEngine = self.registrationEngine()
+    level = registrationEngine.levelCount()-1
+    fixedArray, fixedIJKToRAS = registrationEngine.fixedLevel(level)
+    movingArray, movingIJKToRAS = registrationEngine.movingLevel(level)
+    matrix, scores = multistart.multiStartSearch(
+        fixedArray, fixedIJKToRAS, movingArray, movingIJKToRAS,
+        arrayFromMatrix(self.transform.GetMatrixTransformToParent()),
+        starts=self.rotationStarts, spread=self.rotationSpread, step=self.stepSize*2**level,
+        sampleCount=registrationEngine.sampleCount, processes=processes,
+        metricName=self.metricName, roi=registrationEngine.roi, center=registrationEngine.center)
+    self.setTransformMatrix(matrix)
+    logger.debug("multi-start %s", scores)
+    self.colorWindow()
+    return scores
+
+  def startSeriesRegistration(self, movingNodes, mode='rigid', finished=None):
+    """
+    Register each volume of movingNodes to the fixed volume with a
+    series.SeriesRegistration: the fixed pyramid and sample points are
+    prepared once and the moving volumes run on seriesThreads threads.
+    Each volume is then placed under a new linear transform holding its
+    result, seriesStats receives the per-volume timings and finished is
+    called once all are done or cancelled.
+    """
+    self.stopSeriesRegistration()
+    if self.seriesTimer:
+      # drop the results of a cancelled series still running
+      self.seriesTimer.stop()
+    movings = []
+    for node in movingNodes:
+      node.GetIJKToRASMatrix(self.ijkToRAS)
+      movings.append((numpy.array(self.volumeArray(node)), arrayFromMatrix(self.ijkToRAS)))
+    # the new transforms are at the root of the scene, so results are in world RAS
+    self.series = series.SeriesRegistration(
+        self.volumePyramid(self.fixed).copy(), self.ijkToWorld(self.fixed), movings, mode,
+        initialize=self.initializeFromMoments, threads=self.seriesThreads,
+        sampleCount=self.sampleCount or self.defaultSampleCount, pyramidSize=self.pyramidSize,
+        stepSize=self.stepSize, gradientWindow=self.gradientWindow,
+        metricName=self.metricName, roi=self.regionOfInterest(), precision=self.precision)
+    self.seriesNodes = list(movingNodes)
+    self.seriesFinished = finished
+    with self.stats.timer('seriesPreparation'):
+      self.series.start()
+    self.seriesTimer = qt.QTimer()
+    self.seriesTimer.setInterval(self.pollInterval)
+    self.seriesTimer.connect('timeout()', self.pollSeriesRegistration)
+    self.seriesTimer.start()
+
+  def pollSeriesRegistration(self):
+    if not self.series.done():
+      return
+    self.seriesTimer.stop()
+    self.seriesTimer = None
+    try:
+      results = self.series.results()
+    except worker.Cancelled:
+      results = []
+    self.seriesStats = []
+    for node, (matrix, stats) in zip(self.seriesNodes, results):
+      transformNode = slicer.vtkMRMLLinearTransformNode()
+      transformNode.SetName(slicer.mrmlScene.GenerateUniqueName(node.GetName() + 'ToFixed'))
+      slicer.mrmlScene.AddNode(transformNode)
+      transformNode.SetMatrixTransformToParent(matrixFromArray(matrix))
+      node.SetAndObserveTransformNodeID(transformNode.GetID())
+      stats.update({'volume': node.GetName(), 'transform': transformNode.GetID()})
+      self.seriesStats.append(stats)
+      logger.info("series %s: %.2f s, %d evaluations, metric %s", node.GetName(),
+                  stats['totalSeconds'], stats['evaluations'], stats['value'])
+    self.series = None
+    if self.seriesFinished:
+      self.seriesFinished()
+
+  def stopSeriesRegistration(self):
+    """Request cancellation; the registrations stop before their next evaluation"""
+    if self.series:
+      self.series.cancel()
+
   def step(self):
     alpha = int(cmp(self.tac-self.tick(),0)*self.tick()/float(self.WMAX)*50)
-    print(alpha)
+    logger.debug("alpha %s", alpha)
     return alpha
 
   def testingData(self):
@@ -0,0 +1,129 @@
+"""
+Command line batch registration of NRRD volume pairs.
+
+  python -m RegmaticLib.batch fixedDirectory movingDirectory outputDirectory
+  python -m RegmaticLib.batch fixed.nrrd movingDirectory outputDirectory
+
+Every NRRD file of movingDirectory is registered to the file of the same
+name in fixedDirectory, one pair per process. Given a single fixed file,
+every moving file is registered to it instead, with the fixed volume
+prepared once and shared by a pool of threads (see series). The
+moving-to-fixed RAS matrix of each pair is written to
+outputDirectory/<name>.txt and the timing statistics of all pairs to
+outputDirectory/stats.json, where a pair that failed has its error
+instead; the exit status is then 1.
+"""
+
+import argparse, json, multiprocessing, os, sys, time
+
+import numpy
+
+if __package__ is None:
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RegmaticLib import engine, metrics, nrrdio, series, workingcopy
+
+def registerPair(task):
+  """
+  Register one pair and write its matrix; returns its statistics. A
+  pair that cannot be read or registered gets an error entry instead,
+  so that it does not abort the rest of the batch.
+  """
+  fixedPath, movingPath, outputPath, options = task
+  startTime = time.time()
+  try:
+    fixedArray, fixedIJKToRAS = nrrdio.readNrrd(fixedPath)
+    movingArray, movingIJKToRAS = nrrdio.readNrrd(movingPath)
+    loaded = time.time()
+    registrationEngine = engine.RegistrationEngine(
+        fixedArray, fixedIJKToRAS, movingArray, movingIJKToRAS,
+        sampleCount=options['sampleCount'], pyramidSize=options['pyramidSize'],
+        stepSize=options['stepSize'], gradientWindow=options['gradientWindow'],
+        metricName=options['metric'], precision=options['precision'])
+    matrix, stats = registrationEngine.register(mode=options['mode'])
+    numpy.savetxt(outputPath, matrix)
+  except Exception as error:
+    return {'fixed': fixedPath, 'moving': movingPath, 'transform': None,
+            'error': '%s: %s' % (type(error).__name__, error),
+            'totalSeconds': time.time() - startTime}
+  stats.update({'fixed': fixedPath, 'moving': movingPath, 'transform': outputPath,
+                'loadSeconds': loaded - startTime, 'totalSeconds': time.time() - startTime})
+  return stats
+
+def registerSeries(fixedPath, movingDirectory, outputDirectory, options, threads=None):
+  """Register every NRRD file of movingDirectory to fixedPath; returns their statistics"""
+  startTime = time.time()
+  fixedArray, fixedIJKToRAS = nrrdio.readNrrd(fixedPath)
+  names = sorted(name for name in os.listdir(movingDirectory) if name.endswith('.nrrd'))
+  movingPaths = [os.path.join(movingDirectory, name) for name in names]
+  movings = [nrrdio.readNrrd(path) for path in movingPaths]
+  loaded = time.time()
+  registration = series.SeriesRegistration(
+      fixedArray, fixedIJKToRAS, movings, options['mode'], initialize=False, threads=threads,
+      sampleCount=options['sampleCount'], pyramidSize=options['pyramidSize'],
+      stepSize=options['stepSize'], gradientWindow=options['gradientWindow'],
+      metricName=options['metric'], precision=options['precision'])
+  results = []
+  for name, movingPath, (matrix, stats) in zip(names, movingPaths, registration.run()):
+    outputPath = os.path.join(outputDirectory, name[:-len('.nrrd')] + '.txt')
+    numpy.savetxt(outputPath, matrix)
+    stats.update({'fixed': fixedPath, 'moving': movingPath, 'transform': outputPath,
+                  'loadSeconds': (loaded - startTime) / len(names)})
+    results.append(stats)
+  return results
+
+def pairs(fixedDirectory, movingDirectory, outputDirectory):
+  """Yields (fixed, moving, output) paths for the NRRD files present in both directories"""
+  for name in sorted(os.listdir(movingDirectory)):
+    if name.endswith('.nrrd') and os.path.exists(os.path.join(fixedDirectory, name)):
+      yield (os.path.join(fixedDirectory, name), os.path.join(movingDirectory, name),
+             os.path.join(outputDirectory, name[:-len('.nrrd')] + '.txt'))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Rigid registration of NRRD volume pairs.")
+  parser.add_argument('fixedDirectory', help="directory of fixed volumes, or a single fixed NRRD file")
+  parser.add_argument('movingDirectory')
+  parser.add_argument('outputDirectory')
+  parser.add_argument('--mode', choices=engine.MODES, default='gradient')
+  parser.add_argument('--metric', choices=metrics.names(), default='SAD')
+  parser.add_argument('--sample-count', dest='sampleCount', type=int, default=20000)
+  parser.add_argument('--pyramid-size', dest='pyramidSize', type=int, default=64)
+  parser.add_argument('--step-size', dest='stepSize', type=float, default=1.)
+  parser.add_argument('--gradient-window', dest='gradientWindow', type=float, default=1.)
+  parser.add_argument('--precision', choices=workingcopy.PRECISIONS, default='full',
+                      help="storage of the volumes read by the metric")
+  parser.add_argument('--processes', type=int, default=None,
+                      help="number of pairs registered concurrently (default: one per core)")
+  parser.add_argument('--threads', type=int, default=None,
+                      help="threads registering to a single fixed file (default: one per core)")
+  args = parser.parse_args(argv)
+
+  if not os.path.isdir(args.outputDirectory):
+    os.makedirs(args.outputDirectory)
+  options = dict((key, getattr(args, key)) for key in
+                 ('mode', 'metric', 'sampleCount', 'pyramidSize', 'stepSize', 'gradientWindow',
+                  'precision'))
+  startTime = time.time()
+  if os.path.isfile(args.fixedDirectory):
+    results = registerSeries(args.fixedDirectory, args.movingDirectory, args.outputDirectory,
+                             options, args.threads)
+  else:
+    tasks = [paths + (options,) for paths in
+             pairs(args.fixedDirectory, args.movingDirectory, args.outputDirectory)]
+    pool = multiprocessing.Pool(args.processes)
+    try:
+      results = pool.map(registerPair, tasks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  summary = {'pairs': results, 'seconds': time.time() - startTime}
+  with open(os.path.join(args.outputDirectory, 'stats.json'), 'w') as stream:
+    json.dump(summary, stream, indent=2)
+  failed = [result for result in results if result.get('error')]
+  for result in failed:
+    print("%s: %s" % (result['moving'], result['error']))
+  print("registered %d pairs in %.1f s, %d failed" % (len(results) - len(failed), summary['seconds'], len(failed)))
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
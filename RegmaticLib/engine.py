@@ -0,0 +1,234 @@
+"""
+Headless rigid registration engine.
+It works on plain numpy volumes in (k,j,i) order with their 4x4 IJK to
+RAS matrices, and returns moving-to-fixed 4x4 matrices, so it runs
+without slicer or VTK. RegmaticLogic is a thin adapter over it.
+"""
+
+import time
+
+import numpy
+
+from RegmaticLib import moments, optimizers, phasecorrelation, pose, pyramid, sampling, workingcopy
+
+MODES = ('translation', 'rotation', 'gradient', 'rigid', 'phase')
+
+class RegistrationEngine(object):
+  """
+  Registers a moving volume to a fixed one. fixed and moving are numpy
+  arrays or prebuilt pyramid.Pyramid objects; candidate matrices map
+  moving RAS to fixed RAS. An optional roi.RegionOfInterest in fixed RAS
+  restricts the sample points to the region. With a precision other
+  than 'full', the metric reads working copies of the pyramid levels
+  rescaled over the intensity range of both volumes, and its values are
+  in the units of those copies.
+  """
+
+  def __init__(self, fixed, fixedIJKToRAS, moving, movingIJKToRAS,
+               sampleCount=20000, pyramidSize=64, stepSize=1., gradientWindow=1.,
+               metricName='SAD', roi=None, precision='full'):
+    if not isinstance(fixed, pyramid.Pyramid):
+      fixed = pyramid.Pyramid(fixed, pyramidSize or numpy.inf)
+    if not isinstance(moving, pyramid.Pyramid):
+      moving = pyramid.Pyramid(moving, pyramidSize or numpy.inf)
+    if precision != 'full':
+      intensityRange = workingcopy.valueRange([fixed.array(0), moving.array(0)])
+      convert = lambda array: workingcopy.workingCopy(array, precision, intensityRange)[0]
+      fixed, moving = fixed.map(convert), moving.map(convert)
+    self.fixedPyramid = fixed
+    self.movingPyramid = moving
+    self.fixedIJKToRAS = numpy.asarray(fixedIJKToRAS, dtype=numpy.float64)
+    self.movingIJKToRAS = numpy.asarray(movingIJKToRAS, dtype=numpy.float64)
+    self.sampleCount = sampleCount
+    self.stepSize = stepSize
+    self.gradientWindow = gradientWindow
+    self.metricName = metricName
+    self.roi = roi
+    self.precision = precision
+    self.sampleSets = {}
+    self.metrics = {}
+    # largest level, in voxels, translated by phase correlation
+    self.phaseVoxels = 2**21
+    # whether the 'rotation' mode ends each level with a phase correlation translation
+    self.phaseTranslationInRotation = True
+    columns = numpy.sqrt(numpy.sum(self.fixedIJKToRAS[:3,:3]**2, axis=0))
+    self.spacing = columns.min()
+    extent = numpy.dot(self.fixedIJKToRAS[:3,:3], numpy.array(fixed.array(0).shape[::-1]) - 1)
+    self.radius = 0.5 * numpy.linalg.norm(extent)
+    # rotations are parameterized about the center of the fixed volume
+    self.center = self.fixedIJKToRAS[:3,3] + 0.5 * extent
+    if roi is not None:
+      # or of the region of interest
+      lower, upper = roi.bounds()
+      self.radius = min(self.radius, 0.5 * numpy.linalg.norm(upper - lower))
+      self.center = roi.center()
+
+  def levelCount(self):
+    return min(len(self.fixedPyramid), len(self.movingPyramid))
+
+  def fixedLevel(self, level):
+    """Returns the fixed array of level and its IJK to RAS matrix"""
+    return (self.fixedPyramid.array(level),
+            numpy.dot(self.fixedIJKToRAS, self.fixedPyramid.ijkScale(level)))
+
+  def movingLevel(self, level):
+    """Returns the moving array of level and its IJK to RAS matrix"""
+    return (self.movingPyramid.array(level),
+            numpy.dot(self.movingIJKToRAS, self.movingPyramid.ijkScale(level)))
+
+  def sampleSet(self, level, sampleCount=None):
+    """Fixed sample points of level, drawn once; sampleCount overrides the engine's"""
+    key = (level, sampleCount or self.sampleCount)
+    if key not in self.sampleSets:
+      fixedArray, ijkToRAS = self.fixedLevel(level)
+      self.sampleSets[key] = sampling.SampleSet(fixedArray, ijkToRAS, key[1], roi=self.roi)
+    return self.sampleSets[key]
+
+  def metric(self, level, sampleCount=None):
+    """SampledMetric of level, with its fixed part prepared once"""
+    key = (level, sampleCount or self.sampleCount)
+    if key not in self.metrics:
+      movingArray, ijkToRAS = self.movingLevel(level)
+      self.metrics[key] = sampling.SampledMetric(self.sampleSet(level, sampleCount),
+                                                 movingArray, ijkToRAS, self.metricName)
+    return self.metrics[key]
+
+  def momentMatrix(self, rotate=True):
+    """
+    Returns the moving-to-fixed matrix aligning the centers of mass of
+    the coarsest levels and, when rotate is set and the metric there is
+    better for it, their principal axes. Cropped or truncated volumes
+    can mislead the principal axes, hence the comparison.
+    """
+    level = self.levelCount()-1
+    fixedMoments = moments.imageMoments(*self.fixedLevel(level))
+    movingMoments = moments.imageMoments(*self.movingLevel(level))
+    candidates = [moments.momentAlignment(fixedMoments, movingMoments, False)]
+    if rotate:
+      candidates.append(moments.momentAlignment(fixedMoments, movingMoments, True))
+    return candidates[numpy.argmin(self.evaluate(numpy.array(candidates), level))]
+
+  def resampledMoving(self, matrix, level, first=None, last=None):
+    """
+    Returns the moving array of level resampled on the fixed grid of
+    level at the moving-to-fixed matrix, or on its voxels from the
+    (i,j,k) indices first to last inclusive.
+    """
+    fixedArray, fixedIJKToRAS = self.fixedLevel(level)
+    movingArray, movingIJKToRAS = self.movingLevel(level)
+    if first is None:
+      first, last = numpy.zeros(3, dtype=int), numpy.array(fixedArray.shape[::-1]) - 1
+    shape = tuple((numpy.asarray(last) - first + 1)[::-1])
+    ijk = numpy.indices(shape, dtype=numpy.float64)[::-1].reshape(3,-1).T + first
+    fixedToMovingIJK = numpy.dot(numpy.linalg.inv(numpy.dot(matrix, movingIJKToRAS)), fixedIJKToRAS)
+    movingIJK = numpy.dot(sampling.homogeneous(ijk), fixedToMovingIJK.T)[:,:3]
+    return sampling.trilinear(movingArray, movingIJK).reshape(shape)
+
+  def phaseTranslation(self, matrix, level, callback=None, value=None):
+    """
+    Translate the moving-to-fixed matrix by the phase correlation shift
+    between the fixed level and the moving level resampled on its grid,
+    both cropped to the box of the region of interest if there is one.
+    value is the metric of matrix on level, when already known.
+    Returns the matrix, translated only if that lowers the metric, its
+    value and the number of evaluations; levels larger than phaseVoxels
+    are left as they are, with a value of None.
+    """
+    fixedArray, fixedIJKToRAS = self.fixedLevel(level)
+    first, last = numpy.zeros(3, dtype=int), numpy.array(fixedArray.shape[::-1]) - 1
+    if self.roi is not None:
+      first, last = self.roi.ijkBox(fixedIJKToRAS, fixedArray.shape)
+      fixedArray = fixedArray[first[2]:last[2]+1, first[1]:last[1]+1, first[0]:last[0]+1]
+    if fixedArray.size > self.phaseVoxels:
+      return matrix, None, 0
+    shift = phasecorrelation.phaseShift(fixedArray, self.resampledMoving(matrix, level, first, last))
+    candidates = numpy.array([matrix, numpy.dot(pose.translationMatrix(numpy.dot(fixedIJKToRAS[:3,:3], shift)), matrix)])
+    if value is None:
+      values, evaluations = self.evaluate(candidates, level), 2
+    else:
+      values, evaluations = numpy.array([value, self.evaluate(candidates[1:], level)[0]]), 1
+    if callback:
+      callback(candidates, values, level)
+    if values[1] < values[0]:
+      return candidates[1], values[1], evaluations
+    return matrix, values[0], evaluations
+
+  def evaluate(self, matrices, level=0):
+    """Returns the metric of each moving-to-fixed matrix of the (K,4,4) stack"""
+    return self.metric(level).evaluate(numpy.asarray(matrices, dtype=numpy.float64))
+
+  def parameterScales(self, level):
+    """
+    Finite difference windows of the six rigid parameters: gradientWindow
+    voxels of level in mm, and in degrees the rotation that moves the
+    corners of the fixed volume by as much.
+    """
+    return pose.parameterScales(self.spacing * 2**level * self.gradientWindow, self.radius)
+
+  def optimize(self, evaluate, mode, level):
+    """
+    Run the optimizer of mode on evaluate, a function of (K,6) rigid
+    parameters. Returns (params, value, evaluations).
+    """
+    if mode == 'translation':
+      return optimizers.coordinateSearch(evaluate, (0,1,2), self.spacing*2**level)
+    if mode == 'rotation':
+      return optimizers.coordinateSearch(evaluate, (3,4,5), self.stepSize*2**level)
+    if mode == 'gradient':
+      return optimizers.gradientDescent(evaluate, self.parameterScales(level))
+    if mode == 'rigid':
+      return optimizers.nelderMead(evaluate, self.parameterScales(level))
+    if mode == 'phase':
+      # polish the phase correlation shift below the voxel size
+      step = self.spacing*2**level/4.
+      return optimizers.coordinateSearch(evaluate, (0,1,2), step, count=4, minStep=step/4.)
+    raise ValueError("unknown optimizer mode %s" % mode)
+
+  def register(self, matrix=None, mode='gradient', callback=None):
+    """
+    Optimize from matrix (identity by default) coarse to fine.
+    callback(candidates, values, level) is called after every batch.
+    Returns the final matrix and a dictionary of statistics.
+    """
+    startTime = time.time()
+    matrix = numpy.eye(4) if matrix is None else numpy.array(matrix, dtype=numpy.float64)
+    evaluations = 0
+    value = None
+    for level in reversed(range(self.levelCount())):
+      metric = self.metric(level)
+      if mode == 'phase':
+        matrix, phaseValue, count = self.phaseTranslation(matrix, level, callback)
+        evaluations += count
+      base = matrix.copy()
+      def evaluate(params):
+        candidates = numpy.einsum('kab,bc->kac', pose.rigidMatrices(params, self.center), base)
+        values = metric.evaluate(candidates)
+        if callback:
+          callback(candidates, values, level)
+        return values
+      params, value, count = self.optimize(evaluate, mode, level)
+      matrix = numpy.dot(pose.rigidMatrices(params, self.center)[0], base)
+      evaluations += count
+      if mode == 'rotation' and self.phaseTranslationInRotation:
+        # the translation step of the rotation search
+        matrix, phaseValue, count = self.phaseTranslation(matrix, level, callback, value)
+        evaluations += count
+        if phaseValue is not None:
+          value = phaseValue
+    stats = {'mode': mode, 'metric': self.metricName, 'levels': self.levelCount(), 'evaluations': evaluations,
+             'value': float(value), 'seconds': time.time() - startTime}
+    return matrix, stats
+
+  def snapshot(self):
+    """Returns an engine over copies of the volumes, safe to use from another thread"""
+    result = RegistrationEngine(self.fixedPyramid.copy(), self.fixedIJKToRAS,
+                                self.movingPyramid.copy(), self.movingIJKToRAS,
+                                self.sampleCount, stepSize=self.stepSize,
+                                gradientWindow=self.gradientWindow,
+                                metricName=self.metricName, roi=self.roi)
+    result.phaseVoxels = self.phaseVoxels
+    result.phaseTranslationInRotation = self.phaseTranslationInRotation
+    # the copied levels already are working copies
+    result.precision = self.precision
+    result.sampleSets = dict(self.sampleSets)
+    return result
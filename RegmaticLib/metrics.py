@@ -0,0 +1,329 @@
+"""
+Similarity metrics between fixed and moving intensity samples.
+Each metric is built once from the fixed values, so everything that only
+depends on the fixed image is precomputed, and then evaluates a (K,N)
+stack of moving samples into K costs in one vectorized pass. Costs are
+minimized by the optimizers; normalizer bounds them for display.
+Volumes too large to hold resampled in memory are compared slab by slab
+with accumulate(), from additive sums that each metric knows how to
+reduce to its cost. Whole resampled volumes are compared with
+evaluateBuffered, which works in preallocated WorkBuffers and allocates
+nothing proportional to the volume size.
+"""
+
+import collections
+
+import numpy
+
+class WorkBuffers(object):
+  """
+  Work arrays for flat volumes of size values, allocated on first use
+  and reused by every evaluation. allocatedBytes counts what they
+  allocated, so an evaluation that leaves it unchanged allocated no
+  buffer the size of the volume.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.arrays = {}
+    self.allocatedBytes = 0
+
+  def array(self, name, dtype):
+    """Returns the work array called name, allocating it the first time"""
+    if name not in self.arrays:
+      self.arrays[name] = numpy.empty(self.size, dtype=dtype)
+      self.allocatedBytes += self.arrays[name].nbytes
+    return self.arrays[name]
+
+  @property
+  def values(self):
+    return self.array('values', numpy.float32)
+
+  @property
+  def weights(self):
+    return self.array('weights', numpy.float64)
+
+  @property
+  def indices(self):
+    return self.array('indices', numpy.intp)
+
+class Metric(object):
+  """
+  Base class of the metrics. movingRange and fixedRange are the
+  (min, max) intensities of the moving and fixed volumes, for metrics
+  that need to bin their values.
+  """
+
+  def __init__(self, fixedValues, movingRange=None, fixedRange=None):
+    self.fixedValues = numpy.asarray(fixedValues, dtype=numpy.float64)
+    self.bufferedValues = None
+
+  def bufferedFixedValues(self, buffers):
+    """
+    Returns the fixed values in the dtype of the WorkBuffers values,
+    converted once, so that evaluateBuffered mixes no wider type.
+    """
+    dtype = buffers.values.dtype
+    if self.bufferedValues is None or self.bufferedValues.dtype != dtype:
+      self.bufferedValues = self.fixedValues.astype(dtype)
+    return self.bufferedValues
+
+  def evaluate(self, movingValues):
+    """Returns the K costs of the (K,N) moving samples"""
+    raise NotImplementedError
+
+  def normalizer(self, movingValues):
+    """Returns K upper bounds of the costs of the (K,N) moving samples"""
+    raise NotImplementedError
+
+  def evaluateBuffered(self, movingValues, buffers):
+    """
+    Returns the (cost, normalizer) of the flat moving values, which may be
+    a zero-copy view of a reslice output, using the WorkBuffers of their
+    size for every intermediate result.
+    """
+    movingValues = movingValues[numpy.newaxis]
+    return self.evaluate(movingValues)[0], self.normalizer(movingValues)[0]
+
+  @classmethod
+  def slabSums(cls, fixedValues, movingValues, fixedRange, movingRange):
+    """Returns the additive sums of one slab of flat fixed and moving values"""
+    raise NotImplementedError
+
+  @classmethod
+  def fromSums(cls, sums):
+    """Returns (cost, normalizer) from the sums of all slabs"""
+    raise NotImplementedError
+
+class SumOfAbsoluteDifferences(Metric):
+
+  def __init__(self, fixedValues, movingRange=None, fixedRange=None):
+    Metric.__init__(self, fixedValues)
+    self.fixedSum = numpy.sum(self.fixedValues)
+
+  def evaluate(self, movingValues):
+    return numpy.sum(numpy.abs(movingValues - self.fixedValues), axis=1)
+
+  def normalizer(self, movingValues):
+    return numpy.maximum(numpy.sum(movingValues, axis=1), self.fixedSum)
+
+  def evaluateBuffered(self, movingValues, buffers):
+    work = buffers.values
+    numpy.subtract(movingValues, self.bufferedFixedValues(buffers), out=work)
+    numpy.abs(work, out=work)
+    return work.sum(dtype=numpy.float64), max(movingValues.sum(dtype=numpy.float64), self.fixedSum)
+
+  @classmethod
+  def slabSums(cls, fixedValues, movingValues, fixedRange, movingRange):
+    return numpy.array([numpy.sum(numpy.abs(movingValues - fixedValues)),
+                        numpy.sum(movingValues), numpy.sum(fixedValues)])
+
+  @classmethod
+  def fromSums(cls, sums):
+    return sums[0], max(sums[1], sums[2])
+
+class SumOfSquaredDifferences(Metric):
+
+  def __init__(self, fixedValues, movingRange=None, fixedRange=None):
+    Metric.__init__(self, fixedValues)
+    self.fixedSquares = numpy.dot(self.fixedValues, self.fixedValues)
+
+  def evaluate(self, movingValues):
+    differences = movingValues - self.fixedValues
+    return numpy.einsum('kn,kn->k', differences, differences)
+
+  def normalizer(self, movingValues):
+    return numpy.einsum('kn,kn->k', movingValues, movingValues) + self.fixedSquares
+
+  def evaluateBuffered(self, movingValues, buffers):
+    work = buffers.values
+    numpy.subtract(movingValues, self.bufferedFixedValues(buffers), out=work)
+    numpy.multiply(work, work, out=work)
+    cost = work.sum(dtype=numpy.float64)
+    numpy.multiply(movingValues, movingValues, out=work)
+    return cost, work.sum(dtype=numpy.float64) + self.fixedSquares
+
+  @classmethod
+  def slabSums(cls, fixedValues, movingValues, fixedRange, movingRange):
+    differences = movingValues - fixedValues
+    return numpy.array([numpy.dot(differences, differences),
+                        numpy.dot(movingValues, movingValues), numpy.dot(fixedValues, fixedValues)])
+
+  @classmethod
+  def fromSums(cls, sums):
+    return sums[0], sums[1] + sums[2]
+
+class NormalizedCrossCorrelation(Metric):
+  """Cost 1 - NCC, from 0 for a perfect linear match to 2"""
+
+  def __init__(self, fixedValues, movingRange=None, fixedRange=None):
+    Metric.__init__(self, fixedValues)
+    centered = self.fixedValues - self.fixedValues.mean()
+    self.fixedNormalized = centered / max(numpy.linalg.norm(centered), 1e-12)
+    self.fixedSums = (len(self.fixedValues), self.fixedValues.sum(),
+                      numpy.dot(self.fixedValues, self.fixedValues))
+
+  def evaluate(self, movingValues):
+    centered = movingValues - movingValues.mean(axis=1)[:,numpy.newaxis]
+    norms = numpy.maximum(numpy.sqrt(numpy.einsum('kn,kn->k', centered, centered)), 1e-12)
+    return 1. - numpy.dot(centered, self.fixedNormalized) / norms
+
+  def normalizer(self, movingValues):
+    return numpy.full(len(movingValues), 2.)
+
+  def evaluateBuffered(self, movingValues, buffers):
+    work = buffers.values
+    count, fixedSum, fixedSquares = self.fixedSums
+    numpy.multiply(movingValues, movingValues, out=work)
+    movingSquares = work.sum(dtype=numpy.float64)
+    numpy.multiply(movingValues, self.bufferedFixedValues(buffers), out=work)
+    products = work.sum(dtype=numpy.float64)
+    return self.fromSums(numpy.array([count, fixedSum, movingValues.sum(dtype=numpy.float64),
+                                      fixedSquares, movingSquares, products]))
+
+  @classmethod
+  def slabSums(cls, fixedValues, movingValues, fixedRange, movingRange):
+    return numpy.array([len(fixedValues), numpy.sum(fixedValues), numpy.sum(movingValues),
+                        numpy.dot(fixedValues, fixedValues), numpy.dot(movingValues, movingValues),
+                        numpy.dot(fixedValues, movingValues)], dtype=numpy.float64)
+
+  @classmethod
+  def fromSums(cls, sums):
+    count, fixedSum, movingSum, fixedSquares, movingSquares, products = sums
+    covariance = products - fixedSum * movingSum / count
+    variances = (fixedSquares - fixedSum**2 / count) * (movingSquares - movingSum**2 / count)
+    return 1. - covariance / max(numpy.sqrt(max(variances, 0.)), 1e-12), 2.
+
+class MutualInformation(Metric):
+  """
+  Mattes-style mutual information: the fixed samples fall in hard bins,
+  computed once, and the moving samples are spread over their two
+  nearest bins with linear Parzen weights. The joint histograms of all
+  K candidates are accumulated by one numpy.bincount call.
+  The cost is the conditional entropy H(F|M) = H(F) - MI, which is
+  minimized where the mutual information is maximal and bounded by H(F).
+  """
+
+  bins = 32
+
+  def __init__(self, fixedValues, movingRange=None, fixedRange=None):
+    Metric.__init__(self, fixedValues)
+    if fixedRange is None:
+      fixedRange = (self.fixedValues.min(), self.fixedValues.max())
+    self.fixedBins = self.binFixed(self.fixedValues, fixedRange)
+    fixedProbabilities = numpy.bincount(self.fixedBins, minlength=self.bins) / float(len(self.fixedBins))
+    self.fixedEntropy = self.entropy(fixedProbabilities[numpy.newaxis])[0]
+    self.movingRange = fixedRange if movingRange is None else movingRange
+    self.fixedOffsets = self.fixedBins * self.bins
+
+  @classmethod
+  def binFixed(cls, fixedValues, fixedRange):
+    """Hard bin indices of the fixed values"""
+    low, high = float(fixedRange[0]), float(fixedRange[1])
+    scaled = (fixedValues - low) * (cls.bins / max(high - low, 1e-12))
+    return numpy.clip(scaled.astype(numpy.intp), 0, cls.bins - 1)
+
+  @classmethod
+  def jointHistograms(cls, fixedBins, movingValues, movingRange):
+    """Returns the (K,bins,bins) joint counts of the fixed bins and the (K,N) moving values"""
+    bins = cls.bins
+    count = len(movingValues)
+    low = float(movingRange[0])
+    scale = (bins - 1) / max(float(movingRange[1]) - low, 1e-12)
+    position = numpy.clip((movingValues - low) * scale, 0, bins - 1)
+    lower = numpy.minimum(position.astype(numpy.intp), bins - 2)
+    upperWeight = position - lower
+    # flat index of (candidate, fixed bin, lower moving bin)
+    index = (numpy.arange(count)[:,numpy.newaxis] * bins + fixedBins) * bins + lower
+    joint = numpy.bincount(numpy.concatenate((index.ravel(), index.ravel() + 1)),
+                           numpy.concatenate(((1 - upperWeight).ravel(), upperWeight.ravel())),
+                           minlength=count * bins * bins)
+    return joint.reshape(count, bins, bins)
+
+  @staticmethod
+  def entropy(probabilities):
+    """Entropies of the rows of the (K,...) probabilities"""
+    flat = probabilities.reshape(len(probabilities), -1)
+    logs = numpy.log(numpy.where(flat > 0, flat, 1.))
+    return -numpy.sum(flat * logs, axis=1)
+
+  @classmethod
+  def conditionalEntropy(cls, joint):
+    """H(F|M) = H(F,M) - H(M) of the (K,bins,bins) joint probabilities"""
+    return numpy.maximum(cls.entropy(joint) - cls.entropy(joint.sum(axis=1)), 0.)
+
+  def evaluate(self, movingValues):
+    joint = self.jointHistograms(self.fixedBins, movingValues, self.movingRange)
+    return self.conditionalEntropy(joint / float(movingValues.shape[1]))
+
+  def normalizer(self, movingValues):
+    return numpy.full(len(movingValues), max(self.fixedEntropy, 1e-12))
+
+  def evaluateBuffered(self, movingValues, buffers):
+    bins = self.bins
+    position, index = buffers.weights, buffers.indices
+    low = float(self.movingRange[0])
+    numpy.subtract(movingValues, low, out=position)
+    numpy.multiply(position, (bins - 1) / max(float(self.movingRange[1]) - low, 1e-12), out=position)
+    numpy.clip(position, 0, bins - 1, out=position)
+    numpy.copyto(index, position, casting='unsafe')
+    numpy.minimum(index, bins - 2, out=index)
+    # position becomes the weight of the upper bin, then of the lower bin
+    numpy.subtract(position, index, out=position)
+    numpy.add(index, self.fixedOffsets, out=index)
+    upper = numpy.bincount(index, position, minlength=bins * bins)
+    numpy.subtract(1., position, out=position)
+    joint = numpy.bincount(index, position, minlength=bins * bins)
+    joint[1:] += upper[:-1]
+    return self.fromSums(joint)
+
+  @classmethod
+  def slabSums(cls, fixedValues, movingValues, fixedRange, movingRange):
+    return cls.jointHistograms(cls.binFixed(fixedValues, fixedRange),
+                               movingValues[numpy.newaxis], movingRange).ravel()
+
+  @classmethod
+  def fromSums(cls, sums):
+    joint = sums.reshape(1, cls.bins, cls.bins) / max(sums.sum(), 1e-12)
+    fixedEntropy = cls.entropy(joint.sum(axis=2))[0]
+    return cls.conditionalEntropy(joint)[0], max(fixedEntropy, 1e-12)
+
+# registry of the metrics by name; register more with register()
+METRICS = collections.OrderedDict()
+
+def register(name, metricClass):
+  """Make metricClass available under name"""
+  METRICS[name] = metricClass
+
+def names():
+  return list(METRICS.keys())
+
+def create(name, fixedValues, movingRange=None, fixedRange=None):
+  """
+  Returns the metric called name, prepared for fixedValues. The binning
+  metrics use the range of fixedValues unless fixedRange is given.
+  """
+  if name not in METRICS:
+    raise ValueError("Unknown metric %s, expected one of %s" % (name, ', '.join(names())))
+  return METRICS[name](fixedValues, movingRange, fixedRange)
+
+register('SAD', SumOfAbsoluteDifferences)
+register('SSD', SumOfSquaredDifferences)
+register('NCC', NormalizedCrossCorrelation)
+register('MI', MutualInformation)
+
+def accumulate(name, slabs, fixedRange=None, movingRange=None):
+  """
+  Returns the (cost, normalizer) of the metric called name over slabs,
+  an iterable of (fixedValues, movingValues) array pairs. Only one slab
+  is held at a time; the ranges are the intensity ranges of the whole
+  volumes, needed by the metrics that bin intensities.
+  """
+  metricClass = METRICS[name]
+  total = None
+  for fixedValues, movingValues in slabs:
+    sums = metricClass.slabSums(numpy.ravel(fixedValues).astype(numpy.float64),
+                                numpy.ravel(movingValues).astype(numpy.float64),
+                                fixedRange, movingRange)
+    total = sums if total is None else total + sums
+  return metricClass.fromSums(total)
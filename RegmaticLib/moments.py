@@ -0,0 +1,58 @@
+"""
+Intensity moments of volumes, and the rigid transform aligning the
+centers of mass and principal axes of two volumes, to start the
+optimizers close to the solution when there are no landmarks.
+"""
+
+import itertools
+
+import numpy
+
+def imageMoments(array, ijkToRAS):
+  """
+  Returns the intensity weighted RAS centroid (3,) and covariance (3,3)
+  of the (k,j,i) array, in one vectorized pass. Intensities are taken
+  above the volume minimum so that the background weighs nothing.
+  """
+  weights = numpy.asarray(array, dtype=numpy.float64)
+  weights = weights - weights.min()
+  total = weights.sum()
+  if total == 0:
+    raise ValueError("a volume of uniform intensity has no center of mass")
+  # (i,j,k) index of every voxel
+  ijk = numpy.indices(weights.shape, dtype=numpy.float64)[::-1].reshape(3,-1)
+  weights = weights.ravel() / total
+  mean = numpy.dot(ijk, weights)
+  centered = ijk - mean[:,numpy.newaxis]
+  covariance = numpy.einsum('an,bn,n->ab', centered, centered, weights)
+  ijkToRAS = numpy.asarray(ijkToRAS, dtype=numpy.float64)
+  return (numpy.dot(ijkToRAS[:3,:3], mean) + ijkToRAS[:3,3],
+          numpy.dot(numpy.dot(ijkToRAS[:3,:3], covariance), ijkToRAS[:3,:3].T))
+
+def distinctAxes(values, tolerance):
+  """Whether the sorted eigenvalues differ enough for their axes to be well defined"""
+  return numpy.min(numpy.diff(values)) > tolerance * values[-1]
+
+def momentAlignment(fixedMoments, movingMoments, rotate=True, tolerance=0.1):
+  """
+  Returns the 4x4 moving-to-fixed matrix mapping the moving centroid
+  onto the fixed one and, when rotate is set, the moving principal axes
+  onto the fixed ones. The axis signs are ambiguous, so the smallest of
+  the candidate rotations is kept. The rotation is skipped when either
+  volume's eigenvalues are within tolerance of each other.
+  """
+  fixedCenter, fixedCovariance = fixedMoments
+  movingCenter, movingCovariance = movingMoments
+  rotation = numpy.eye(3)
+  if rotate:
+    fixedValues, fixedAxes = numpy.linalg.eigh(fixedCovariance)
+    movingValues, movingAxes = numpy.linalg.eigh(movingCovariance)
+    if distinctAxes(fixedValues, tolerance) and distinctAxes(movingValues, tolerance):
+      candidates = [numpy.dot(fixedAxes * signs, movingAxes.T)
+                    for signs in itertools.product((1., -1.), repeat=3)]
+      candidates = [candidate for candidate in candidates if numpy.linalg.det(candidate) > 0]
+      rotation = max(candidates, key=numpy.trace)
+  matrix = numpy.eye(4)
+  matrix[:3,:3] = rotation
+  matrix[:3,3] = fixedCenter - numpy.dot(rotation, movingCenter)
+  return matrix
@@ -0,0 +1,94 @@
+"""
+Multi-start rotation search on a process pool.
+The fixed and moving arrays are written once to memory-mapped .npy files
+that every worker maps read-only, so only file names, matrices and start
+poses are pickled between processes.
+Inside Slicer's embedded interpreter sys.executable is the application
+rather than a Python, so there the search runs on a thread pool instead.
+"""
+
+import multiprocessing, multiprocessing.pool, os, shutil, sys, tempfile, threading
+
+import numpy
+
+from RegmaticLib import optimizers, pose, sampling
+
+# metric of the worker process or thread, set up by initializeWorker
+workerState = threading.local()
+
+def embedded():
+  """True inside Slicer, where worker processes cannot be spawned from sys.executable"""
+  return 'slicer' in sys.modules
+
+def shareArray(array, directory, name):
+  """Copy array into a memory-mapped .npy file of directory and return its path"""
+  path = os.path.join(directory, name + '.npy')
+  shared = numpy.lib.format.open_memmap(path, mode='w+', dtype=array.dtype, shape=array.shape)
+  shared[...] = array
+  shared.flush()
+  del shared
+  return path
+
+def initializeWorker(fixedPath, fixedIJKToRAS, sampleCount, movingPath, movingIJKToRAS,
+                     metricName='SAD', roi=None):
+  """Map the shared volumes and draw the sample set once per worker process"""
+  sampleSet = sampling.SampleSet(numpy.load(fixedPath, mmap_mode='r'), fixedIJKToRAS,
+                                 sampleCount, roi=roi)
+  workerState.metric = sampling.SampledMetric(sampleSet, numpy.load(movingPath, mmap_mode='r'),
+                                        movingIJKToRAS, metricName)
+
+def searchFromStart(task):
+  """Rotation coordinate search from one perturbed start; returns (matrix, value, evaluations)"""
+  start, matrix, center, step, count = task
+  base = numpy.dot(pose.rigidMatrices(start, center)[0], matrix)
+  def evaluate(params):
+    candidates = numpy.einsum('kab,bc->kac', pose.rigidMatrices(params, center), base)
+    return workerState.metric.evaluate(candidates)
+  params, value, evaluations = optimizers.coordinateSearch(evaluate, (3,4,5), step, count)
+  return numpy.dot(pose.rigidMatrices(params, center)[0], base), value, evaluations
+
+def perturbations(starts, spread, seed=0):
+  """
+  Returns (starts,6) rigid parameter offsets: the unperturbed pose
+  first, then random rotations within spread degrees about each axis.
+  """
+  random = numpy.random.RandomState(seed)
+  offsets = numpy.zeros((starts,6))
+  offsets[1:,3:] = random.uniform(-spread, spread, size=(starts-1,3))
+  return offsets
+
+def multiStartSearch(fixedArray, fixedIJKToRAS, movingArray, movingIJKToRAS, matrix,
+                     starts=8, spread=20., step=2., count=5, sampleCount=20000,
+                     processes=None, metricName='SAD', roi=None, center=None, threads=None):
+  """
+  Run a rotation search from each of starts perturbations of the
+  moving-to-fixed matrix on a pool of processes (one per core by
+  default), or of threads if threads is True (the default inside
+  Slicer). roi optionally restricts the sample points to a region of
+  interest. Rotations are about center, the center of the fixed volume
+  by default, as for the RegistrationEngine. Returns the best matrix and
+  the list of per-start scores.
+  """
+  matrix = numpy.asarray(matrix, dtype=numpy.float64)
+  if center is None:
+    fixedIJKToRAS = numpy.asarray(fixedIJKToRAS, dtype=numpy.float64)
+    extent = numpy.dot(fixedIJKToRAS[:3,:3], numpy.array(fixedArray.shape[::-1]) - 1)
+    center = fixedIJKToRAS[:3,3] + 0.5 * extent
+  directory = tempfile.mkdtemp(prefix='Regmatic')
+  try:
+    initargs = (shareArray(fixedArray, directory, 'fixed'), fixedIJKToRAS, sampleCount,
+                shareArray(movingArray, directory, 'moving'), movingIJKToRAS, metricName, roi)
+    if threads is None:
+      threads = embedded()
+    poolClass = multiprocessing.pool.ThreadPool if threads else multiprocessing.Pool
+    pool = poolClass(processes, initializeWorker, initargs)
+    try:
+      tasks = [(start, matrix, center, step, count) for start in perturbations(starts, spread)]
+      results = pool.map(searchFromStart, tasks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  scores = [value for matrix, value, evaluations in results]
+  return results[int(numpy.argmin(scores))][0], scores
@@ -0,0 +1,76 @@
+"""
+Minimal NRRD reader for the batch command line, so that headless runs
+do not need slicer. Only attached raw or gzip data is supported.
+"""
+
+import gzip, io
+
+import numpy
+
+TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2',
+  'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2',
+  'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+}
+
+def parseVector(text):
+  """Parse a NRRD vector such as (1,0,0)"""
+  return [float(value) for value in text.strip().strip('()').split(',')]
+
+def readNrrd(path):
+  """
+  Returns the (k,j,i) array of a 3D scalar NRRD file and its 4x4
+  IJK to RAS matrix.
+  """
+  with open(path, 'rb') as stream:
+    magic = stream.readline()
+    if not magic.startswith(b'NRRD'):
+      raise ValueError("%s is not a NRRD file" % path)
+    fields = {}
+    while True:
+      line = stream.readline().decode('ascii').rstrip('\r\n')
+      if not line:
+        break
+      if line.startswith('#') or ':=' in line:
+        continue
+      key, value = line.split(':', 1)
+      fields[key.strip().lower()] = value.strip()
+    data = stream.read()
+
+  if 'data file' in fields or 'datafile' in fields:
+    raise ValueError("%s: detached NRRD data is not supported" % path)
+  sizes = [int(size) for size in fields['sizes'].split()]
+  if len(sizes) != 3:
+    raise ValueError("%s: only 3D scalar volumes are supported" % path)
+  encoding = fields.get('encoding', 'raw')
+  if encoding in ('gz', 'gzip'):
+    data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+  elif encoding != 'raw':
+    raise ValueError("%s: unsupported encoding %s" % (path, encoding))
+  dtype = numpy.dtype(TYPES[fields['type']])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('>' if fields.get('endian') == 'big' else '<')
+  count = sizes[0]*sizes[1]*sizes[2]
+  array = numpy.frombuffer(data[len(data)-count*dtype.itemsize:], dtype=dtype)
+  array = array.reshape(sizes[::-1]).astype(dtype.newbyteorder('='))
+
+  ijkToRAS = numpy.eye(4)
+  if 'space directions' in fields:
+    directions = fields['space directions'].split(')')
+    ijkToRAS[:3,:3] = numpy.array([parseVector(d) for d in directions if d.strip()]).T
+  elif 'spacings' in fields:
+    ijkToRAS[:3,:3] = numpy.diag([float(s) for s in fields['spacings'].split()])
+  if 'space origin' in fields:
+    ijkToRAS[:3,3] = parseVector(fields['space origin'])
+  space = fields.get('space', 'right-anterior-superior')
+  if space in ('left-posterior-superior', 'LPS'):
+    ijkToRAS = numpy.dot(numpy.diag([-1,-1,1,1]), ijkToRAS)
+  return array, ijkToRAS
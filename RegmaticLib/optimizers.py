@@ -0,0 +1,226 @@
+"""
+Optimizers over the six rigid parameters of RegmaticLib.pose.rigidMatrices.
+They only see a vectorized cost function evaluate(params) taking a (K,6)
+array and returning K values, so candidates can be scored as one batch.
+"""
+
+import numpy
+
+def gradientDescent(evaluate, scales, step=2., maxEvaluations=None, tolerance=0.1,
+                    grow=1.5, shrink=0.5):
+  """
+  Minimize evaluate starting from zero parameters. The gradient is
+  estimated by central differences of one window per parameter, given
+  in parameter units by scales, and the step length (in windows) grows
+  after a successful move and shrinks after a failed one, until it is
+  below tolerance. The default maxEvaluations allows four times the
+  iterations needed to shrink step down to tolerance, so it only stops
+  searches that do not converge.
+  Returns (params, value, evaluations).
+  """
+  scales = numpy.asarray(scales, dtype=numpy.float64)
+  dimension = len(scales)
+  if maxEvaluations is None:
+    shrinks = max(1, int(numpy.ceil(numpy.log(step / tolerance) / numpy.log(1. / shrink))))
+    maxEvaluations = 1 + 4 * (shrinks + 1) * (2*dimension + 1)
+  x = numpy.zeros(dimension)
+  value = evaluate(x[numpy.newaxis])[0]
+  evaluations = 1
+  probes = numpy.vstack((numpy.eye(dimension), -numpy.eye(dimension)))
+  while step > tolerance and evaluations + 2*dimension + 1 <= maxEvaluations:
+    probeValues = evaluate((x + probes) * scales)
+    evaluations += 2*dimension
+    gradient = (probeValues[:dimension] - probeValues[dimension:]) / 2.
+    norm = numpy.linalg.norm(gradient)
+    if norm == 0:
+      break
+    candidate = x - step * gradient / norm
+    candidateValue = evaluate(candidate[numpy.newaxis] * scales)[0]
+    evaluations += 1
+    if candidateValue < value:
+      x, value = candidate, candidateValue
+      step *= grow
+    else:
+      step *= shrink
+      best = numpy.argmin(probeValues)
+      if probeValues[best] < value:
+        x, value = x + probes[best], probeValues[best]
+  return x * scales, value, evaluations
+
+# golden section fraction and bracket growth factor
+GOLDEN = (3 - numpy.sqrt(5)) / 2
+GROW = (1 + numpy.sqrt(5)) / 2
+
+def parabolicMinimum(a, b, c, fa, fb, fc):
+  """Returns the vertex of the parabola through (a,fa), (b,fb), (c,fc), or None when they are aligned"""
+  numerator = (b-a)**2 * (fb-fc) - (b-c)**2 * (fb-fa)
+  denominator = (b-a) * (fb-fc) - (b-c) * (fb-fa)
+  if denominator == 0:
+    return None
+  return b - 0.5 * numerator / denominator
+
+def lineSearch(evaluate, step, tolerance=None, maxDistance=numpy.inf, value=None, maxEvaluations=40):
+  """
+  Minimize a function of one offset around 0. evaluate takes an array
+  of offsets and returns their values. The minimum is bracketed by
+  probing step on both sides and growing the step downhill, no further
+  than maxDistance, then refined by parabolic interpolation with a
+  golden section fallback until the bracket is narrower than tolerance
+  (step by default). value is the value at 0 when already known.
+  Returns (offset, value, evaluations).
+  """
+  step = abs(step)
+  if tolerance is None:
+    tolerance = step
+  evaluations = 0
+  if value is None:
+    value = evaluate(numpy.zeros(1))[0]
+    evaluations += 1
+  below, above = evaluate(numpy.array([-step, step]))
+  evaluations += 2
+  a, b, c, fa, fb, fc = -step, 0., step, below, value, above
+  if min(below, above) < value:
+    # walk downhill until the values rise again
+    direction = 1. if above < below else -1.
+    previous, fprevious = 0., value
+    b, fb = direction*step, min(below, above)
+    while True:
+      trial = b + direction * GROW * abs(b - previous)
+      if abs(trial) > maxDistance:
+        trial = direction * maxDistance
+      if trial == b or evaluations >= maxEvaluations:
+        return b, fb, evaluations
+      ftrial = evaluate(numpy.array([trial]))[0]
+      evaluations += 1
+      if ftrial >= fb:
+        break
+      previous, fprevious, b, fb = b, fb, trial, ftrial
+    a, fa, c, fc = previous, fprevious, trial, ftrial
+    if a > c:
+      a, fa, c, fc = c, fc, a, fa
+  while c - a > tolerance and evaluations < maxEvaluations:
+    x = parabolicMinimum(a, b, c, fa, fb, fc)
+    if x is None or not (a < x < c) or abs(x - b) < tolerance / 2.:
+      if c - b > b - a:
+        x = b + GOLDEN * (c - b)
+      else:
+        x = b - GOLDEN * (b - a)
+    fx = evaluate(numpy.array([x]))[0]
+    evaluations += 1
+    if fx < fb:
+      if x > b:
+        a, fa = b, fb
+      else:
+        c, fc = b, fb
+      b, fb = x, fx
+    elif x > b:
+      c, fc = x, fx
+    else:
+      a, fa = x, fx
+  return b, fb, evaluations
+
+def coordinateSearch(evaluate, axes, step, count=10, minStep=None, maxPasses=20):
+  """
+  Minimize evaluate by a lineSearch along each parameter of axes in
+  turn, within count steps of the current point, as the translation and
+  rotation sweeps of RegmaticLogic do. The step is halved after a pass
+  without improvement.
+  Returns (params, value, evaluations).
+  """
+  if minStep is None:
+    minStep = step / 16.
+  x = numpy.zeros(6)
+  value = evaluate(x[numpy.newaxis])[0]
+  evaluations = 1
+  passes = 0
+  while step >= minStep and passes < maxPasses:
+    passes += 1
+    improved = False
+    for axis in axes:
+      def along(offsets):
+        candidates = numpy.repeat(x[numpy.newaxis], len(offsets), axis=0)
+        candidates[:,axis] += offsets
+        return evaluate(candidates)
+      offset, candidateValue, count_ = lineSearch(along, step, maxDistance=count*step, value=value)
+      evaluations += count_
+      if candidateValue < value:
+        x = x.copy()
+        x[axis] += offset
+        value = candidateValue
+        improved = True
+    if not improved:
+      step /= 2.
+  return x, value, evaluations
+
+class NelderMead(object):
+  """
+  Nelder-Mead simplex search over all six rigid parameters at once.
+  Parameters are measured in units of scales (typically millimetres for
+  translations and the degrees that move the volume by as much), so a
+  simplex of the given size is balanced between them. Each iteration
+  scores the reflection, expansion and both contractions of the worst
+  vertex as one batch; iterate() runs one iteration so that callers can
+  spread the search over several timer ticks.
+  """
+
+  # reflection, expansion, outside and inside contraction
+  COEFFICIENTS = numpy.array([1., 2., .5, -.5])
+
+  def __init__(self, evaluate, scales, size=4.):
+    self.evaluate = evaluate
+    self.scales = numpy.asarray(scales, dtype=numpy.float64)
+    dimension = len(self.scales)
+    self.simplex = numpy.vstack((numpy.zeros(dimension), size*numpy.eye(dimension)))
+    self.values = numpy.asarray(evaluate(self.simplex * self.scales), dtype=numpy.float64)
+    self.evaluations = dimension + 1
+    self.order()
+
+  def order(self):
+    order = numpy.argsort(self.values, kind='mergesort')
+    self.simplex = self.simplex[order]
+    self.values = self.values[order]
+
+  def params(self):
+    """Best parameters so far, in the units of the cost function"""
+    return self.simplex[0] * self.scales
+
+  def value(self):
+    return self.values[0]
+
+  def size(self):
+    """Largest extent of the simplex around its best vertex, in units of scales"""
+    return numpy.abs(self.simplex[1:] - self.simplex[0]).max()
+
+  def iterate(self):
+    centroid = self.simplex[:-1].mean(axis=0)
+    candidates = centroid + self.COEFFICIENTS[:,numpy.newaxis] * (centroid - self.simplex[-1])
+    reflected, expanded, outside, inside = self.evaluate(candidates * self.scales)
+    self.evaluations += len(candidates)
+    if reflected < self.values[0]:
+      choice = 1 if expanded < reflected else 0
+    elif reflected < self.values[-2]:
+      choice = 0
+    elif reflected < self.values[-1]:
+      choice = 2 if outside <= reflected else None
+    else:
+      choice = 3 if inside < self.values[-1] else None
+    if choice is None:
+      # shrink towards the best vertex
+      self.simplex[1:] = self.simplex[0] + 0.5 * (self.simplex[1:] - self.simplex[0])
+      self.values[1:] = self.evaluate(self.simplex[1:] * self.scales)
+      self.evaluations += len(self.simplex) - 1
+    else:
+      self.simplex[-1] = candidates[choice]
+      self.values[-1] = (reflected, expanded, outside, inside)[choice]
+    self.order()
+
+def nelderMead(evaluate, scales, size=4., tolerance=0.05, maxEvaluations=600):
+  """
+  Minimize evaluate with a NelderMead search from zero parameters until
+  the simplex is smaller than tolerance (in units of scales).
+  Returns (params, value, evaluations).
+  """
+  search = NelderMead(evaluate, scales, size)
+  while search.size() > tolerance and search.evaluations < maxEvaluations:
+    search.iterate()
+  return search.params(), search.value(), search.evaluations
@@ -0,0 +1,116 @@
+"""
+Rigid pose helpers returning 4x4 numpy matrices.
+Rotations follow vtkTransform.RotateWXYZ: angles are in degrees and
+right handed, and a rotation about a center is T(center).R.T(-center).
+"""
+
+import numpy
+
+def translationMatrix(offset):
+  """Returns the 4x4 matrix translating by the 3-vector offset"""
+  matrix = numpy.eye(4)
+  matrix[:3,3] = offset
+  return matrix
+
+def rotationMatrices(axis, degrees, center=(0,0,0)):
+  """
+  Returns a (K,4,4) stack of rotations by each of the K angles in
+  degrees about the 3-vector axis passing through center.
+  """
+  axis = numpy.asarray(axis, dtype=numpy.float64)
+  axis = axis / numpy.linalg.norm(axis)
+  theta = numpy.radians(numpy.atleast_1d(numpy.asarray(degrees, dtype=numpy.float64)))
+  c, s = numpy.cos(theta), numpy.sin(theta)
+  x, y, z = axis
+  cross = numpy.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+  outer = numpy.outer(axis, axis)
+  rotations = (c[:,None,None] * numpy.eye(3) + s[:,None,None] * cross
+               + (1 - c)[:,None,None] * outer)
+  center = numpy.asarray(center, dtype=numpy.float64)
+  matrices = numpy.zeros((len(theta),4,4))
+  matrices[:,:3,:3] = rotations
+  matrices[:,:3,3] = center - numpy.dot(rotations, center)
+  matrices[:,3,3] = 1
+  return matrices
+
+def rotationMatrix(axis, degrees, center=(0,0,0)):
+  """Returns the 4x4 rotation by degrees about axis passing through center"""
+  return rotationMatrices(axis, [degrees], center)[0]
+
+def rigidMatrices(params, center=(0,0,0)):
+  """
+  Returns a (K,4,4) stack of rigid transforms for the (K,6) parameter
+  array params: a translation (tx,ty,tz) in mm followed by angles
+  (fi,theta,psi) in degrees about the X, Y and Z axes through center.
+  The rotations compose as in RegmaticLogic.rotate: Y, then Z, then X.
+  """
+  params = numpy.atleast_2d(numpy.asarray(params, dtype=numpy.float64))
+  rx = rotationMatrices((1,0,0), params[:,3], center)
+  ry = rotationMatrices((0,1,0), params[:,4], center)
+  rz = rotationMatrices((0,0,1), params[:,5], center)
+  matrices = numpy.einsum('kab,kbc,kcd->kad', ry, rz, rx)
+  matrices[:,:3,3] += params[:,:3]
+  return matrices
+
+def transformPoints(matrix, points):
+  """Returns the (N,3) points mapped by the 4x4 matrix"""
+  matrix = numpy.asarray(matrix, dtype=numpy.float64)
+  return numpy.dot(numpy.asarray(points, dtype=numpy.float64), matrix[:3,:3].T) + matrix[:3,3]
+
+def rigidFit(source, target):
+  """
+  Returns the 4x4 rigid transform mapping the (N,3) source points onto
+  the corresponding target points in the least squares sense (Kabsch).
+  Raises ValueError unless both hold the same number, at least 3, of points.
+  """
+  source = numpy.asarray(source, dtype=numpy.float64)
+  target = numpy.asarray(target, dtype=numpy.float64)
+  if source.shape != target.shape or len(source) < 3:
+    raise ValueError("a rigid fit needs at least 3 corresponding points, got %d and %d"
+                     % (len(source), len(target)))
+  sourceCenter = source.mean(axis=0)
+  targetCenter = target.mean(axis=0)
+  u, s, vt = numpy.linalg.svd(numpy.dot((source - sourceCenter).T, target - targetCenter))
+  # flip the least significant axis rather than return a reflection
+  signs = numpy.array([1., 1., numpy.sign(numpy.linalg.det(numpy.dot(vt.T, u.T))) or 1.])
+  rotation = numpy.dot(vt.T * signs, u.T)
+  matrix = numpy.eye(4)
+  matrix[:3,:3] = rotation
+  matrix[:3,3] = targetCenter - numpy.dot(rotation, sourceCenter)
+  return matrix
+
+def parameterScales(window, radius):
+  """
+  Returns comparable units of the six rigid parameters: window mm for
+  the translations and, for the rotations, the degrees that move points
+  at radius mm from the center by as much.
+  """
+  return [window]*3 + [numpy.degrees(window/max(radius, window))]*3
+
+class PoseState(object):
+  """
+  Rigid pose of the optimizers: six parameters (see rigidMatrices)
+  applied about center on top of a base matrix. Candidate matrices
+  are composed from it directly, so a search does not have to write
+  its intermediate poses anywhere.
+  """
+
+  def __init__(self, base, center=None):
+    self.base = numpy.array(base, dtype=numpy.float64)
+    if center is None:
+      center = self.base[:3,3]
+    self.center = numpy.array(center, dtype=numpy.float64)
+    self.params = numpy.zeros(6)
+
+  def matrix(self):
+    """Returns the 4x4 matrix of the current parameters"""
+    return self.candidates(numpy.zeros(6))[0]
+
+  def candidates(self, offsets):
+    """Returns the (K,4,4) matrices of the pose moved by each row of the (K,6) offsets"""
+    params = self.params + numpy.atleast_2d(offsets)
+    return numpy.einsum('kab,bc->kac', rigidMatrices(params, self.center), self.base)
+
+  def move(self, offset):
+    """Add the 6-vector offset to the parameters"""
+    self.params += offset
@@ -0,0 +1,79 @@
+"""
+Gaussian image pyramid for coarse-to-fine registration.
+Arrays are in (k,j,i) order; level 0 is the original volume and each
+level halves every axis still larger than the coarsest size.
+"""
+
+import numpy
+
+def gaussianKernel(sigma):
+  """Returns a normalized 1D gaussian kernel truncated at two sigma"""
+  radius = max(1, int(numpy.ceil(2*sigma)))
+  x = numpy.arange(-radius, radius+1, dtype=numpy.float64)
+  kernel = numpy.exp(-0.5*(x/sigma)**2)
+  return kernel / kernel.sum()
+
+def smoothAxis(array, kernel, axis):
+  """Convolve array with the 1D kernel along axis, replicating edge voxels"""
+  radius = len(kernel) // 2
+  padding = [(0,0)] * array.ndim
+  padding[axis] = (radius, radius)
+  padded = numpy.pad(array, padding, mode='edge')
+  result = numpy.zeros(array.shape, dtype=numpy.float32)
+  length = array.shape[axis]
+  for offset, weight in enumerate(kernel):
+    index = [slice(None)] * array.ndim
+    index[axis] = slice(offset, offset+length)
+    result += weight * padded[tuple(index)]
+  return result
+
+def downsample(array, factors):
+  """
+  Smooth and decimate array by the per-axis factors (1 or 2, in
+  (k,j,i) order). Returns a float32 array.
+  """
+  result = numpy.asarray(array, dtype=numpy.float32)
+  kernel = gaussianKernel(1.)
+  for axis, factor in enumerate(factors):
+    if factor > 1:
+      result = smoothAxis(result, kernel, axis)
+  return numpy.ascontiguousarray(result[tuple(slice(None, None, f) for f in factors)])
+
+class Pyramid(object):
+  """
+  Levels of a volume from full resolution (level 0) down to a
+  coarsest level whose axes are no larger than minSize.
+  """
+
+  def __init__(self, array, minSize=64):
+    self.arrays = [array]
+    self.scales = [numpy.ones(3)]
+    while max(self.arrays[-1].shape) > minSize:
+      factors = [2 if size > minSize else 1 for size in self.arrays[-1].shape]
+      self.arrays.append(downsample(self.arrays[-1], factors))
+      # scales are kept in (i,j,k) order to match IJK matrices
+      self.scales.append(self.scales[-1] * factors[::-1])
+
+  def __len__(self):
+    return len(self.arrays)
+
+  def array(self, level):
+    return self.arrays[level]
+
+  def copy(self):
+    """Returns a pyramid holding copies of the level arrays"""
+    result = Pyramid.__new__(Pyramid)
+    result.arrays = [numpy.array(array) for array in self.arrays]
+    result.scales = list(self.scales)
+    return result
+
+  def map(self, function):
+    """Returns a pyramid of the same levels holding function applied to each level array"""
+    result = Pyramid.__new__(Pyramid)
+    result.arrays = [function(array) for array in self.arrays]
+    result.scales = list(self.scales)
+    return result
+
+  def ijkScale(self, level):
+    """Returns the 4x4 matrix mapping level IJK indices to full resolution IJK"""
+    return numpy.diag(list(self.scales[level]) + [1.])
@@ -0,0 +1,101 @@
+"""
+Persistent cache of registration results.
+Results are keyed on the content of the two volumes, their IJK to RAS
+matrices and the registration parameters, and stored as one compressed
+.npz file per key in a local directory. The least recently used files
+are evicted once the directory grows beyond maxBytes.
+"""
+
+import hashlib, json, os, tempfile, zipfile
+
+import numpy
+
+def arrayDigest(array):
+  """Returns the hex digest of the shape, type and content of a numpy array"""
+  array = numpy.ascontiguousarray(array)
+  hasher = hashlib.sha1()
+  hasher.update(repr((array.shape, array.dtype.str)).encode('ascii'))
+  hasher.update(array.data)
+  return hasher.hexdigest()
+
+def resultKey(digests, matrices, parameters):
+  """
+  Returns the cache key of a registration from the arrayDigest of its
+  volumes, its 4x4 frame matrices and a dictionary of parameters.
+  """
+  hasher = hashlib.sha1()
+  for digest in digests:
+    hasher.update(digest.encode('ascii'))
+  for matrix in matrices:
+    hasher.update(numpy.ascontiguousarray(matrix, dtype=numpy.float64).data)
+  hasher.update(json.dumps(parameters, sort_keys=True).encode('ascii'))
+  return hasher.hexdigest()
+
+class ResultCache(object):
+  """Stores a final matrix, metric value and optimizer trace per key in directory"""
+
+  def __init__(self, directory, maxBytes=16*2**20):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+
+  def path(self, key):
+    return os.path.join(self.directory, key + '.npz')
+
+  def get(self, key):
+    """
+    Returns a dictionary of 'matrix' (4x4), 'value' and 'trace' (the
+    metric after each iteration) stored under key, or None.
+    """
+    path = self.path(key)
+    try:
+      with numpy.load(path) as stored:
+        result = {'matrix': stored['matrix'], 'value': float(stored['value']),
+                  'trace': stored['trace']}
+      # mark as recently used
+      os.utime(path, None)
+    except (IOError, OSError):
+      self.misses += 1
+      return None
+    except (KeyError, ValueError, zipfile.BadZipfile):
+      # left over by an interrupted or older writer
+      self.misses += 1
+      os.remove(path)
+      return None
+    self.hits += 1
+    return result
+
+  def put(self, key, matrix, value, trace=()):
+    """Store a result under key, then evict old results beyond maxBytes"""
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    handle, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+    with os.fdopen(handle, 'wb') as output:
+      numpy.savez_compressed(output, matrix=numpy.asarray(matrix, dtype=numpy.float64),
+                             value=numpy.float64(value),
+                             trace=numpy.asarray(trace, dtype=numpy.float64))
+    path = self.path(key)
+    if os.path.exists(path):
+      os.remove(path)
+    os.rename(temporary, path)
+    self.evict()
+
+  def evict(self):
+    """Remove the least recently used results until the directory holds at most maxBytes"""
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith('.npz'):
+        status = os.stat(os.path.join(self.directory, name))
+        entries.append((status.st_mtime, status.st_size, name))
+    total = sum(size for mtime, size, name in entries)
+    for mtime, size, name in sorted(entries):
+      if total <= self.maxBytes:
+        break
+      os.remove(os.path.join(self.directory, name))
+      total -= size
+
+  def clear(self):
+    for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+      if name.endswith('.npz'):
+        os.remove(os.path.join(self.directory, name))
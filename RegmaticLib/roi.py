@@ -0,0 +1,62 @@
+"""
+Regions of interest around fiducial points.
+A region is the union of boxes or spheres of one radius centered on
+each point, expressed in a RAS frame, so the metric only covers
+the anatomy near the landmarks.
+"""
+
+import numpy
+
+SHAPES = ('box', 'sphere')
+
+class RegionOfInterest(object):
+  """Box or sphere of radius mm around each of the (N,3) points"""
+
+  def __init__(self, points, radius, shape='box'):
+    if shape not in SHAPES:
+      raise ValueError("unknown region shape %s" % shape)
+    self.points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))[:,:3]
+    self.radius = float(radius)
+    self.shape = shape
+
+  def key(self):
+    return (self.shape, self.radius, tuple(self.points.ravel()))
+
+  def bounds(self):
+    """Returns the (lower, upper) RAS corners of the box enclosing the region"""
+    return self.points.min(axis=0) - self.radius, self.points.max(axis=0) + self.radius
+
+  def center(self):
+    lower, upper = self.bounds()
+    return 0.5 * (lower + upper)
+
+  def contains(self, points):
+    """Returns whether each of the (N,3) RAS points lies in the region"""
+    offsets = numpy.asarray(points)[:,numpy.newaxis,:3] - self.points
+    if self.shape == 'box':
+      inside = numpy.all(numpy.abs(offsets) <= self.radius, axis=2)
+    else:
+      inside = numpy.sum(offsets**2, axis=2) <= self.radius**2
+    return numpy.any(inside, axis=1)
+
+  def transformed(self, matrix):
+    """Returns the region around the points mapped by the 4x4 matrix"""
+    points = numpy.dot(self.points, numpy.asarray(matrix)[:3,:3].T) + numpy.asarray(matrix)[:3,3]
+    return RegionOfInterest(points, self.radius, self.shape)
+
+  def ijkBox(self, ijkToRAS, shape):
+    """
+    Returns the (lower, upper) inclusive (i,j,k) voxel indices of the
+    part of a volume of the given (k,j,i) shape covered by the region's
+    bounds. Raises ValueError when the region misses the volume.
+    """
+    lower, upper = self.bounds()
+    corners = numpy.array([[x, y, z, 1.] for x in (lower[0], upper[0])
+                           for y in (lower[1], upper[1]) for z in (lower[2], upper[2])])
+    ijk = numpy.dot(corners, numpy.linalg.inv(ijkToRAS).T)[:,:3]
+    dims = numpy.array(shape[::-1])
+    first = numpy.maximum(numpy.floor(ijk.min(axis=0)).astype(int), 0)
+    last = numpy.minimum(numpy.ceil(ijk.max(axis=0)).astype(int), dims - 1)
+    if numpy.any(last < first):
+      raise ValueError("region of interest is outside of the volume")
+    return first, last
@@ -0,0 +1,125 @@
+"""
+Sparse sample-point metric helpers.
+These work on plain numpy arrays in (k,j,i) order, as returned by
+vtk_to_numpy, and 4x4 numpy matrices, so they do not depend on slicer.
+"""
+
+import numpy
+
+from RegmaticLib import metrics
+
+def stratifiedIndices(shape, count, seed=0):
+  """
+  Returns an (N,3) integer array of (i,j,k) voxel indices spread over
+  a volume of the given (k,j,i) shape: the volume is divided into about
+  count cells and one jittered voxel is drawn from each.
+  """
+  dims = numpy.array(shape[::-1], dtype=numpy.float64)
+  count = max(1, int(count))
+  cellSize = (numpy.prod(dims) / count) ** (1/3.)
+  cells = numpy.maximum(numpy.round(dims / cellSize), 1).astype(int)
+  cellSpan = dims / cells
+  grid = numpy.indices(cells).reshape(3, -1).T
+  random = numpy.random.RandomState(seed)
+  points = (grid + random.uniform(size=grid.shape)) * cellSpan
+  indices = numpy.minimum(points.astype(int), dims.astype(int) - 1)
+  if len(indices) > count:
+    indices = indices[random.choice(len(indices), count, replace=False)]
+  return indices
+
+def trilinear(volume, ijk, background=0.):
+  """
+  Returns the values of volume at the continuous (i,j,k) positions of
+  the (N,3) array ijk, using trilinear interpolation.
+  Positions outside the volume get the background value.
+  """
+  dims = numpy.array(volume.shape[::-1])
+  values = numpy.empty(len(ijk))
+  values.fill(background)
+  inside = numpy.all((ijk >= 0) & (ijk <= dims - 1), axis=1)
+  p = ijk[inside]
+  base = numpy.minimum(numpy.floor(p).astype(int), dims - 1)
+  upper = numpy.minimum(base + 1, dims - 1)
+  f = p - base
+  g = 1 - f
+  flat = volume.ravel()
+  rowStride, sliceStride = dims[0], dims[0]*dims[1]
+  result = numpy.zeros(len(p))
+  for ci, wi in ((base[:,0], g[:,0]), (upper[:,0], f[:,0])):
+    for cj, wj in ((base[:,1], g[:,1]), (upper[:,1], f[:,1])):
+      for ck, wk in ((base[:,2], g[:,2]), (upper[:,2], f[:,2])):
+        result += wi*wj*wk * flat[ci + cj*rowStride + ck*sliceStride]
+  values[inside] = result
+  return values
+
+def homogeneous(points):
+  """Returns the (N,3) points as an (N,4) array of homogeneous coordinates"""
+  result = numpy.ones((len(points),4))
+  result[:,:3] = points
+  return result
+
+class SampleSet(object):
+  """
+  Fixed image sample points and intensities shared by every metric
+  evaluation of a search. Only the moving side is sampled per pose.
+  With a RegionOfInterest in world coordinates, at most count points are
+  drawn from the voxels of the region instead of the whole volume.
+  """
+
+  def __init__(self, fixedArray, fixedIJKToWorld, count, seed=0, roi=None):
+    shape, offset = fixedArray.shape, 0
+    if roi is not None:
+      first, last = roi.ijkBox(fixedIJKToWorld, fixedArray.shape)
+      shape, offset = tuple((last - first + 1)[::-1]), first
+      count = min(count, numpy.prod(shape))
+    ijk = stratifiedIndices(shape, count, seed) + offset
+    points = numpy.dot(homogeneous(ijk), numpy.asarray(fixedIJKToWorld).T)
+    if roi is not None:
+      inside = roi.contains(points)
+      ijk, points = ijk[inside], points[inside]
+    self.fixedValues = fixedArray[ijk[:,2], ijk[:,1], ijk[:,0]].astype(numpy.float64)
+    self.points = points
+
+  def __len__(self):
+    return len(self.points)
+
+  def movingValues(self, movingArray, worldToMovingIJK):
+    """Sample the moving volume at the fixed points mapped by the 4x4 worldToMovingIJK"""
+    ijk = numpy.dot(self.points, numpy.asarray(worldToMovingIJK).T)[:,:3]
+    return trilinear(movingArray, ijk)
+
+  def movingValuesBatch(self, movingArray, worldToMovingIJK):
+    """
+    Sample the moving volume for each matrix of the (K,4,4) stack
+    worldToMovingIJK, returning a (K,N) array of intensities.
+    """
+    ijk = numpy.einsum('kab,nb->kna', numpy.asarray(worldToMovingIJK), self.points)[...,:3]
+    return trilinear(movingArray, ijk.reshape(-1,3)).reshape(len(ijk), -1)
+
+class SampledMetric(object):
+  """
+  Similarity metric between the fixed samples of a SampleSet and a
+  moving volume, for stacks of moving-to-world matrices. metricName
+  picks one of the metrics registry, prepared once for the fixed samples.
+  It only holds numpy arrays, so it can be evaluated off the main thread.
+  """
+
+  def __init__(self, sampleSet, movingArray, movingIJKToRAS, metricName='SAD'):
+    self.sampleSet = sampleSet
+    self.movingArray = movingArray
+    self.movingIJKToRAS = numpy.asarray(movingIJKToRAS, dtype=numpy.float64)
+    self.kernel = metrics.create(metricName, sampleSet.fixedValues,
+                                 (numpy.min(movingArray), numpy.max(movingArray)))
+
+  def samples(self, movingToWorld):
+    """Returns the (K,N) moving intensities for the (K,4,4) stack movingToWorld"""
+    ijkToWorld = numpy.einsum('kab,bc->kac', movingToWorld, self.movingIJKToRAS)
+    return self.sampleSet.movingValuesBatch(self.movingArray, numpy.linalg.inv(ijkToWorld))
+
+  def evaluate(self, movingToWorld):
+    """Returns the metric of each matrix of the (K,4,4) stack movingToWorld"""
+    return self.kernel.evaluate(self.samples(movingToWorld))
+
+  def normalizer(self, movingToWorld):
+    """Returns the bound of the metric of each matrix of the (K,4,4) stack movingToWorld"""
+    return self.kernel.normalizer(self.samples(movingToWorld))
@@ -0,0 +1,90 @@
+"""
+Stopping criteria and time slicing for the timer-driven optimizers.
+An optimizer reports each iteration to a ConvergenceScheduler, which
+keeps the metric history, decides when the search has converged and
+tells the optimizer when the wall-clock budget of the current timer
+tick is spent, so each slice of work fits within a frame.
+"""
+
+import time
+
+class ConvergenceScheduler(object):
+  """
+  Converges when the step falls below stepTolerance (in the optimizer's
+  own units), when the metric improved by less than relativeTolerance
+  over the last patience iterations, or after maxIterations.
+  """
+
+  def __init__(self, stepTolerance=0., relativeTolerance=1e-3, patience=2,
+               maxIterations=500, tickBudget=0.04):
+    self.stepTolerance = stepTolerance
+    self.relativeTolerance = relativeTolerance
+    self.patience = patience
+    self.maxIterations = maxIterations
+    self.tickBudget = tickBudget
+    self.start()
+
+  def start(self, evaluations=0):
+    """Reset the history; evaluations is the caller's evaluation counter now"""
+    self.history = []
+    # metric of every iteration, across restarts
+    self.trace = []
+    self.iterations = 0
+    self.firstEvaluations = evaluations
+    self.evaluations = 0
+    self.startTime = time.time()
+    self.deadline = self.startTime + self.tickBudget
+    self.reason = None
+
+  def restart(self):
+    """Start over the history, e.g. on a finer pyramid level, keeping the totals"""
+    self.history = []
+    self.reason = None
+
+  def startTick(self):
+    self.deadline = time.time() + self.tickBudget
+
+  def expired(self):
+    """Whether the budget of the current tick is spent"""
+    return time.time() >= self.deadline
+
+  def update(self, value, step=None, evaluations=None):
+    """
+    Record one iteration ending at the metric value with the given step,
+    and the caller's evaluation counter. Returns whether it converged.
+    """
+    self.history.append(value)
+    self.trace.append(value)
+    self.iterations += 1
+    if evaluations is not None:
+      self.evaluations = evaluations - self.firstEvaluations
+    if step is not None and step < self.stepTolerance:
+      self.reason = 'step'
+    elif len(self.history) > self.patience and self.improvement() <= self.relativeTolerance:
+      self.reason = 'improvement'
+    elif self.iterations >= self.maxIterations:
+      self.reason = 'iterations'
+    return self.reason is not None
+
+  def finish(self, reason, value=None):
+    """Mark the search as stopped for reason, e.g. when its result was known beforehand"""
+    if value is not None:
+      self.history.append(value)
+    self.reason = reason
+
+  def improvement(self):
+    """Relative metric decrease over the last patience iterations"""
+    previous = self.history[-1-self.patience]
+    if previous == 0:
+      return 0.
+    return (previous - self.history[-1]) / abs(previous)
+
+  def report(self):
+    """Returns a dictionary of iterations, evaluations, final metric, elapsed seconds and stopping reason"""
+    return {'iterations': self.iterations, 'evaluations': self.evaluations,
+            'value': float(self.history[-1]) if self.history else None,
+            'seconds': time.time() - self.startTime, 'reason': self.reason}
+
+  def summary(self):
+    report = self.report()
+    return "%(reason)s after %(iterations)d iterations, %(evaluations)d evaluations, %(seconds).1f s: metric %(value).6g" % report
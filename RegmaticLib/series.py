@@ -0,0 +1,115 @@
+"""
+Registration of a series of moving volumes to one fixed volume.
+The fixed pyramid and its sample points are prepared once and shared by
+the engines of all moving volumes, which are registered concurrently on
+a thread pool; numpy releases the GIL during the metric evaluations.
+"""
+
+import threading, time
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from RegmaticLib import engine, pyramid, worker, workingcopy
+
+class SeriesRegistration(object):
+  """
+  Registers every (array, ijkToRAS) of movings to the fixed volume.
+  options are passed to each engine.RegistrationEngine. With initialize,
+  each moving volume starts from RegistrationEngine.momentMatrix unless
+  matrices gives its start. A precision option other than 'full' makes
+  working copies over the intensity range of the whole series, so the
+  shared fixed samples suit every moving volume.
+  """
+
+  def __init__(self, fixed, fixedIJKToRAS, movings, mode='gradient', matrices=None,
+               initialize=True, threads=None, **options):
+    if not isinstance(fixed, pyramid.Pyramid):
+      fixed = pyramid.Pyramid(fixed, options.get('pyramidSize', 64) or numpy.inf)
+    self.movings = list(movings)
+    self.precision = options.pop('precision', 'full')
+    if self.precision != 'full':
+      self.intensityRange = workingcopy.valueRange([fixed.array(0)] + [array for array, ijkToRAS in self.movings])
+      fixed = fixed.map(self.workingCopy)
+    self.fixedPyramid = fixed
+    self.fixedIJKToRAS = fixedIJKToRAS
+    self.mode = mode
+    self.matrices = matrices
+    self.initialize = initialize
+    self.threads = threads
+    self.options = options
+    self.cancelled = threading.Event()
+    self.sampleSets = {}
+    self.pool = None
+    self.pending = None
+
+  def prepare(self):
+    """Draw the fixed sample points of every level before the workers share them"""
+    if not self.movings:
+      return
+    first = self.engine(0)
+    for level in range(len(self.fixedPyramid)):
+      first.sampleSet(level)
+
+  def engine(self, index):
+    """RegistrationEngine of moving volume index, sharing the fixed pyramid and sample sets"""
+    movingArray, movingIJKToRAS = self.movings[index]
+    if self.precision != 'full':
+      movingArray = pyramid.Pyramid(movingArray, self.options.get('pyramidSize', 64) or numpy.inf)
+      movingArray = movingArray.map(self.workingCopy)
+    result = engine.RegistrationEngine(self.fixedPyramid, self.fixedIJKToRAS,
+                                       movingArray, movingIJKToRAS, **self.options)
+    result.precision = self.precision
+    result.sampleSets = self.sampleSets
+    return result
+
+  def workingCopy(self, array):
+    return workingcopy.workingCopy(array, self.precision, self.intensityRange)[0]
+
+  def register(self, index):
+    """Register moving volume index; returns its matrix and statistics"""
+    startTime = time.time()
+    registrationEngine = self.engine(index)
+    if self.matrices is not None:
+      matrix = self.matrices[index]
+    elif self.initialize:
+      matrix = registrationEngine.momentMatrix()
+    else:
+      matrix = None
+    prepared = time.time()
+    matrix, stats = registrationEngine.register(matrix, self.mode, self.offer)
+    stats.update({'index': index, 'prepareSeconds': prepared - startTime,
+                  'totalSeconds': time.time() - startTime})
+    return matrix, stats
+
+  def offer(self, candidates, values, level):
+    if self.cancelled.is_set():
+      raise worker.Cancelled()
+
+  def start(self):
+    """Prepare the fixed volume and start the registrations on the pool"""
+    self.prepare()
+    self.pool = ThreadPool(self.threads)
+    self.pending = self.pool.map_async(self.register, range(len(self.movings)), chunksize=1)
+    self.pool.close()
+
+  def done(self):
+    return self.pending.ready()
+
+  def results(self):
+    """
+    Wait for and return the (matrix, stats) of each moving volume, in
+    order; raises worker.Cancelled after cancel().
+    """
+    try:
+      return self.pending.get()
+    finally:
+      self.pool.join()
+
+  def cancel(self):
+    """Ask the registrations to stop before their next evaluation"""
+    self.cancelled.set()
+
+  def run(self):
+    self.start()
+    return self.results()
@@ -0,0 +1,47 @@
+"""
+Lightweight instrumentation: call counters and cumulative timers per
+named stage, which can be queried or dumped to JSON.
+"""
+
+import collections, contextlib, json, time
+
+class Stats(object):
+  """Counts calls and accumulates seconds per stage"""
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.calls = collections.defaultdict(int)
+    self.seconds = collections.defaultdict(float)
+
+  @contextlib.contextmanager
+  def timer(self, stage):
+    """Context manager timing one call of stage"""
+    startTime = time.time()
+    try:
+      yield
+    finally:
+      self.seconds[stage] += time.time() - startTime
+      self.calls[stage] += 1
+
+  def count(self, stage, amount=1):
+    """Add amount to the counter of an untimed stage"""
+    self.calls[stage] += amount
+
+  def get(self, stage):
+    calls = self.calls.get(stage, 0)
+    seconds = self.seconds.get(stage, 0.)
+    return {'calls': calls, 'seconds': seconds,
+            'meanSeconds': seconds / calls if calls and seconds else 0.}
+
+  def asDict(self):
+    return dict((stage, self.get(stage)) for stage in self.calls)
+
+  def dump(self, path=None):
+    """Returns the statistics as a JSON string, also written to path if given"""
+    text = json.dumps(self.asDict(), indent=2, sort_keys=True)
+    if path:
+      with open(path, 'w') as stream:
+        stream.write(text)
+    return text
@@ -0,0 +1,65 @@
+"""
+Background registration on a worker thread.
+The thread runs a RegistrationEngine snapshot, which only holds numpy
+copies of the volumes; the main thread polls it for the best transform
+found so far.
+"""
+
+import threading
+
+import numpy
+
+class Cancelled(Exception):
+  """Raised inside the worker when cancellation has been requested"""
+
+class RegistrationThread(threading.Thread):
+  """Runs engine.register(matrix, mode) and keeps the best candidate of the current level"""
+
+  def __init__(self, engine, matrix, mode):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.engine = engine
+    self.matrix = numpy.array(matrix, dtype=numpy.float64)
+    self.mode = mode
+    self.cancelled = threading.Event()
+    self.lock = threading.Lock()
+    self.best = None
+    self.bestValue = None
+    self.bestLevel = None
+    self.posted = True
+    self.evaluations = 0
+    self.stats = None
+    self.error = None
+
+  def cancel(self):
+    """Ask the worker to stop before its next candidate evaluation"""
+    self.cancelled.set()
+
+  def run(self):
+    try:
+      self.matrix, self.stats = self.engine.register(self.matrix, self.mode, self.offer)
+    except Cancelled:
+      pass
+    except Exception as error:
+      self.error = error
+
+  def offer(self, candidates, values, level):
+    if self.cancelled.is_set():
+      raise Cancelled()
+    self.evaluations += len(values)
+    best = numpy.argmin(values)
+    with self.lock:
+      # values of different levels are not comparable
+      if level != self.bestLevel or values[best] < self.bestValue:
+        self.best = candidates[best]
+        self.bestValue = values[best]
+        self.bestLevel = level
+        self.posted = False
+
+  def poll(self):
+    """Returns the best matrix found since the last poll, or None"""
+    with self.lock:
+      if self.posted:
+        return None
+      self.posted = True
+      return self.best
@@ -0,0 +1,42 @@
+"""
+Reduced-precision working copies of volumes.
+The sampled metrics are bound by reading moving voxels at scattered
+positions, so storing the volumes in 1 or 2 bytes per voxel instead of
+4 or 8 moves less memory per evaluation. Interpolation and the metric
+sums still accumulate in float64; only the stored voxels are rounded.
+"""
+
+import numpy
+
+PRECISIONS = ('full', 'float16', 'uint16', 'uint8')
+
+def valueRange(arrays):
+  """
+  Returns the (low, high) intensity range shared by the arrays, with
+  low no larger than zero so that zero, the value of samples outside
+  the moving volume, stays zero for non-negative images.
+  """
+  low = min(0., min(float(numpy.min(array)) for array in arrays))
+  high = max(float(numpy.max(array)) for array in arrays)
+  return low, max(high, low + 1e-6)
+
+def workingCopy(array, precision, intensityRange=None):
+  """
+  Returns (copy, scale, offset), copy being array stored in the type of
+  precision so that array is about copy*scale + offset. Integer types
+  map intensityRange, the array's own by default, onto their whole
+  range; float16 is only scaled down when its range would overflow.
+  Volumes compared by a metric must share one intensityRange.
+  """
+  if precision not in PRECISIONS:
+    raise ValueError("unknown precision %s" % precision)
+  if precision == 'full':
+    return array, 1., 0.
+  low, high = intensityRange or valueRange([array])
+  if precision == 'float16':
+    scale = max(1., max(abs(low), abs(high)) / 60000.)
+    return (numpy.asarray(array) / scale).astype(numpy.float16), scale, 0.
+  dtype = numpy.dtype(precision)
+  scale = (high - low) / float(numpy.iinfo(dtype).max)
+  copy = numpy.rint((numpy.asarray(array, dtype=numpy.float32) - low) / scale)
+  return numpy.clip(copy, 0, numpy.iinfo(dtype).max).astype(dtype), scale, low
@@ -0,0 +1,299 @@
+"""
+Registration benchmark on synthetic phantoms with known rigid transforms.
+
+  python Testing/Python/RegmaticBenchmark.py --output results.json
+  python Testing/Python/RegmaticBenchmark.py --output new.json --compare results.json
+
+Every optimizer path is run on every case and reports evaluations per
+second, time to converge, peak memory and the residual translation (mm,
+at the volume center) and rotation (degrees) error, as JSON that can be
+compared between commits. The RegmaticLib engine paths run anywhere numpy
+is available; when run from the Slicer python console, the timer-driven
+RegmaticLogic.registration, registrationRotation and registrationRigid paths
+are included. With --precisions, every path also runs on reduced
+precision working copies of the volumes, and the change of error from
+the full precision run is printed for each of them.
+"""
+
+import argparse, json, os, platform, subprocess, sys, time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from RegmaticLib import engine, metrics, multistart, pose, workingcopy
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+#
+# Synthetic data
+#
+
+def phantom(size, spacing, seed=0):
+  """
+  Returns a function of (N,3) RAS points giving the intensity of an
+  asymmetric phantom made of gaussian blobs, and the IJK to RAS matrix
+  of a size**3 grid centered on the origin.
+  """
+  random = numpy.random.RandomState(seed)
+  extent = size * spacing
+  centers = random.uniform(-0.3, 0.3, size=(12,3)) * extent
+  widths = random.uniform(0.04, 0.12, size=(12,3)) * extent
+  intensities = random.uniform(200, 1000, size=12)
+  def intensity(points):
+    values = numpy.zeros(len(points))
+    for center, width, peak in zip(centers, widths, intensities):
+      values += peak * numpy.exp(-0.5 * numpy.sum(((points - center) / width)**2, axis=1))
+    return values
+  ijkToRAS = numpy.diag([spacing, spacing, spacing, 1.])
+  ijkToRAS[:3,3] = -0.5 * (size - 1) * spacing
+  return intensity, ijkToRAS
+
+def sampleVolume(intensity, ijkToRAS, size, movingToFixed=None):
+  """
+  Returns the (k,j,i) int16 volume of intensity on the grid. With
+  movingToFixed, voxel x shows the phantom at movingToFixed.x, so
+  movingToFixed is the transform a registration has to recover.
+  """
+  k, j, i = numpy.indices((size,)*3)
+  ijk = numpy.vstack((i.ravel(), j.ravel(), k.ravel(), numpy.ones(i.size)))
+  ras = numpy.dot(ijkToRAS, ijk)
+  if movingToFixed is not None:
+    ras = numpy.dot(movingToFixed, ras)
+  return intensity(ras[:3].T).reshape((size,)*3).astype(numpy.int16)
+
+CASES = {
+  'translation': [6., -4., 5., 0., 0., 0.],
+  'rotation': [0., 0., 0., 6., -4., 5.],
+  'rigid': [4., -3., 5., 5., 3., -4.],
+}
+
+#
+# Measurements
+#
+
+def residual(matrix, truth):
+  """Translation error (mm, at the origin) and rotation error (degrees) of matrix against truth"""
+  error = numpy.dot(numpy.linalg.inv(truth), matrix)
+  cosine = numpy.clip((numpy.trace(error[:3,:3]) - 1) / 2., -1, 1)
+  return float(numpy.linalg.norm(error[:3,3])), float(numpy.degrees(numpy.arccos(cosine)))
+
+def measure(run):
+  """Call run() and return its result, elapsed seconds and peak traced memory in bytes"""
+  if tracemalloc:
+    tracemalloc.start()
+  startTime = time.time()
+  result = run()
+  seconds = time.time() - startTime
+  peak = None
+  if tracemalloc:
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  else:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+  return result, seconds, peak
+
+#
+# Optimizer paths
+#
+
+def enginePath(mode):
+  def run(fixed, moving, ijkToRAS, options, precision):
+    registrationEngine = engine.RegistrationEngine(
+        fixed, ijkToRAS, moving, ijkToRAS, sampleCount=options.sampleCount,
+        pyramidSize=options.pyramidSize, metricName=options.metric,
+        precision=precision)
+    matrix, stats = registrationEngine.register(mode=mode)
+    return matrix, stats['evaluations']
+  return run
+
+def momentsPath(fixed, moving, ijkToRAS, options, precision):
+  registrationEngine = engine.RegistrationEngine(
+      fixed, ijkToRAS, moving, ijkToRAS, sampleCount=options.sampleCount,
+      pyramidSize=options.pyramidSize, metricName=options.metric,
+      precision=precision)
+  # the initializer alone: one pass over each coarsest level, two evaluations
+  return registrationEngine.momentMatrix(), 2
+
+def multiStartPath(fixed, moving, ijkToRAS, options, precision):
+  registrationEngine = engine.RegistrationEngine(
+      fixed, ijkToRAS, moving, ijkToRAS, sampleCount=options.sampleCount,
+      pyramidSize=options.pyramidSize, metricName=options.metric,
+      precision=precision)
+  level = registrationEngine.levelCount()-1
+  matrix, scores = multistart.multiStartSearch(
+      *(registrationEngine.fixedLevel(level) + registrationEngine.movingLevel(level)),
+      matrix=numpy.eye(4), sampleCount=options.sampleCount, metricName=options.metric,
+      center=registrationEngine.center)
+  # the searches run in worker processes, which do not report their evaluations
+  return matrix, None
+
+def slicerPath(methodName, mode):
+  def run(fixed, moving, ijkToRAS, options, precision):
+    import slicer, vtk, Regmatic
+    nodes = [volumeNode(fixed, ijkToRAS, 'benchmarkFixed'),
+             volumeNode(moving, ijkToRAS, 'benchmarkMoving'),
+             slicer.vtkMRMLLinearTransformNode()]
+    slicer.mrmlScene.AddNode(nodes[2])
+    nodes[1].SetAndObserveTransformNodeID(nodes[2].GetID())
+    try:
+      logic = Regmatic.RegmaticLogic(nodes[0], nodes[1], nodes[2])
+      logic.sampleCount = options.sampleCount
+      logic.pyramidSize = options.pyramidSize
+      logic.metricName = options.metric
+      logic.precision = precision
+      logic.step = logic.stepSize
+      logic.level = logic.levelCount()-1
+      logic.scheduler = logic.newScheduler(mode)
+      method = getattr(logic, methodName)
+      for tick in range(options.ticks):
+        method()
+        if logic.scheduler.reason:
+          break
+      logic.commitPose(force=True)
+      matrix = Regmatic.arrayFromMatrix(nodes[2].GetMatrixTransformToParent())
+      return matrix, logic.evaluationCount()
+    finally:
+      for node in nodes:
+        slicer.mrmlScene.RemoveNode(node)
+  return run
+
+def volumeNode(array, ijkToRAS, name):
+  """Add a scalar volume node holding a copy of array to the slicer scene"""
+  import slicer, vtk
+  import vtk.util.numpy_support
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(array.shape[::-1])
+  scalars = vtk.util.numpy_support.numpy_to_vtk(numpy.ascontiguousarray(array).ravel(), deep=True)
+  imageData.GetPointData().SetScalars(scalars)
+  node = slicer.vtkMRMLScalarVolumeNode()
+  node.SetName(name)
+  matrix = vtk.vtkMatrix4x4()
+  for row in range(4):
+    for column in range(4):
+      matrix.SetElement(row, column, ijkToRAS[row][column])
+  node.SetIJKToRASMatrix(matrix)
+  node.SetAndObserveImageData(imageData)
+  slicer.mrmlScene.AddNode(node)
+  return node
+
+def paths():
+  result = [('engine.' + mode, enginePath(mode)) for mode in engine.MODES]
+  result.append(('moments', momentsPath))
+  result.append(('multistart', multiStartPath))
+  try:
+    import slicer
+  except ImportError:
+    return result
+  result += [('logic.registration', slicerPath('registration', 'translation')),
+             ('logic.registrationRotation', slicerPath('registrationRotation', 'rotation')),
+             ('logic.registrationRigid', slicerPath('registrationRigid', 'rigid'))]
+  return result
+
+#
+# Main
+#
+
+def environment():
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                     cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    commit = commit.decode('ascii')
+  except Exception:
+    commit = None
+  return {'commit': commit, 'python': platform.python_version(),
+          'numpy': numpy.__version__, 'machine': platform.machine()}
+
+def runBenchmark(options):
+  intensity, ijkToRAS = phantom(options.size, options.spacing)
+  fixed = sampleVolume(intensity, ijkToRAS, options.size)
+  results = []
+  for caseName in options.cases:
+    truth = pose.rigidMatrices([CASES[caseName]])[0]
+    moving = sampleVolume(intensity, ijkToRAS, options.size, truth)
+    for pathName, run in paths():
+      if options.paths and pathName not in options.paths:
+        continue
+      for precision in options.precisions:
+        (matrix, evaluations), seconds, peak = measure(lambda: run(fixed, moving, ijkToRAS, options, precision))
+        translationError, rotationError = residual(matrix, truth)
+        result = {'case': caseName, 'path': pathName, 'precision': precision,
+                  'seconds': seconds, 'evaluations': evaluations,
+                  'evaluationsPerSecond': evaluations / seconds if evaluations else None,
+                  'peakMemoryBytes': peak, 'translationError': translationError,
+                  'rotationError': rotationError}
+        results.append(result)
+        print("%-12s %-28s %-7s %7.2f s  %6.2f mm  %6.2f deg" % (
+            caseName, pathName, precision, seconds, translationError, rotationError))
+  return {'environment': environment(), 'options': vars(options), 'results': results}
+
+def resultKey(result):
+  # runs saved before the precision option are full precision
+  return result['case'], result['path'], result.get('precision', 'full')
+
+def precisionLoss(report):
+  """
+  Print and return, as a list of dictionaries, the ratio of time and the
+  change of error of each reduced precision result from full precision.
+  """
+  full = dict((resultKey(r)[:2], r) for r in report['results'] if resultKey(r)[2] == 'full')
+  losses = []
+  for result in report['results']:
+    reference = full.get(resultKey(result)[:2])
+    if result['precision'] == 'full' or not reference:
+      continue
+    loss = {'case': result['case'], 'path': result['path'], 'precision': result['precision'],
+            'timeRatio': result['seconds'] / reference['seconds'],
+            'translationLoss': result['translationError'] - reference['translationError'],
+            'rotationLoss': result['rotationError'] - reference['rotationError']}
+    losses.append(loss)
+    print("%-12s %-28s %-7s time x%5.2f  translation %+6.2f mm  rotation %+6.2f deg" % (
+        loss['case'], loss['path'], loss['precision'], loss['timeRatio'],
+        loss['translationLoss'], loss['rotationLoss']))
+  return losses
+
+def compare(current, previous):
+  """Print the ratio of time and the change of error for results present in both runs"""
+  before = dict((resultKey(r), r) for r in previous['results'])
+  for result in current['results']:
+    old = before.get(resultKey(result))
+    if not old:
+      continue
+    print("%-12s %-28s %-7s time x%5.2f  translation %+6.2f mm  rotation %+6.2f deg" % (
+        result['case'], result['path'], result['precision'], result['seconds'] / old['seconds'],
+        result['translationError'] - old['translationError'],
+        result['rotationError'] - old['rotationError']))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Regmatic registration benchmark.")
+  parser.add_argument('--output', help="JSON file receiving the results")
+  parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+  parser.add_argument('--size', type=int, default=64, help="phantom voxels per axis")
+  parser.add_argument('--spacing', type=float, default=2., help="phantom voxel spacing in mm")
+  parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=sorted(CASES))
+  parser.add_argument('--paths', nargs='+', help="only run these optimizer paths")
+  parser.add_argument('--metric', choices=metrics.names(), default='SAD')
+  parser.add_argument('--sample-count', dest='sampleCount', type=int, default=20000)
+  parser.add_argument('--pyramid-size', dest='pyramidSize', type=int, default=32)
+  parser.add_argument('--precisions', nargs='+', choices=workingcopy.PRECISIONS, default=['full'],
+                      help="working precisions of the volumes read by the metric")
+  parser.add_argument('--ticks', type=int, default=20,
+                      help="maximum timer ticks of the RegmaticLogic paths")
+  options = parser.parse_args(argv)
+
+  report = runBenchmark(options)
+  report['precisionLoss'] = precisionLoss(report)
+  if options.output:
+    with open(options.output, 'w') as stream:
+      json.dump(report, stream, indent=2)
+  if options.compare:
+    with open(options.compare) as stream:
+      compare(report, json.load(stream))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
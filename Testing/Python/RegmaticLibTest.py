@@ -0,0 +1,397 @@
+"""
+Unit tests of the headless RegmaticLib modules. They only need numpy:
+
+  python Testing/Python/RegmaticLibTest.py
+"""
+
+import gzip, io, json, os, shutil, sys, tempfile, unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from RegmaticLib import (batch, engine, metrics, moments, multistart, nrrdio, optimizers,
+                         phasecorrelation, pose, pyramid, resultcache, roi, sampling,
+                         scheduler, series, workingcopy)
+import RegmaticBenchmark
+
+def quadratic(minimum):
+  """Returns a vectorized cost of (K,6) parameters with its minimum at the 6-vector minimum"""
+  minimum = numpy.asarray(minimum, dtype=numpy.float64)
+  weights = numpy.array([1., 2., 3., 1., 2., 3.])
+  return lambda params: numpy.sum(weights * (numpy.atleast_2d(params) - minimum)**2, axis=1)
+
+class OptimizersTest(unittest.TestCase):
+
+  def test_gradientDescentConvergesBeforeItsBudget(self):
+    minimum = [3., -2., 1., 0.5, -1., 0.]
+    scales = numpy.ones(6)
+    params, value, evaluations = optimizers.gradientDescent(quadratic(minimum), scales)
+    # the step shrinks below its tolerance instead of running out of evaluations
+    budget = 1 + 4 * 6 * 13
+    self.assertLess(evaluations, budget)
+    numpy.testing.assert_allclose(params, minimum, atol=0.1)
+
+  def test_lineSearchRefinesBelowItsStep(self):
+    evaluate = lambda offsets: (numpy.asarray(offsets) - 7.3)**2
+    offset, value, evaluations = optimizers.lineSearch(evaluate, 1.5, tolerance=0.1, maxDistance=15.)
+    self.assertAlmostEqual(offset, 7.3, delta=0.1)
+    self.assertLess(evaluations, 20)
+
+  def test_lineSearchStaysAtAMinimum(self):
+    evaluate = lambda offsets: numpy.asarray(offsets)**2
+    offset, value, evaluations = optimizers.lineSearch(evaluate, 1.)
+    self.assertEqual(offset, 0.)
+
+  def test_coordinateSearch(self):
+    minimum = [2., -1., 0.5, 0., 0., 0.]
+    params, value, evaluations = optimizers.coordinateSearch(quadratic(minimum), (0,1,2), 1.)
+    numpy.testing.assert_allclose(params, minimum, atol=0.1)
+
+  def test_nelderMead(self):
+    minimum = [3., -2., 1., 0.5, -1., 0.]
+    params, value, evaluations = optimizers.nelderMead(quadratic(minimum), numpy.ones(6))
+    numpy.testing.assert_allclose(params, minimum, atol=0.1)
+
+class PoseTest(unittest.TestCase):
+
+  def test_zeroParametersAreIdentity(self):
+    numpy.testing.assert_allclose(pose.rigidMatrices(numpy.zeros((2,6)), (10., 20., 30.)),
+                                  [numpy.eye(4)]*2, atol=1e-12)
+
+  def test_rotationKeepsItsCenter(self):
+    center = [10., -5., 3.]
+    matrix = pose.rigidMatrices([0., 0., 0., 30., -20., 45.], center)[0]
+    numpy.testing.assert_allclose(pose.transformPoints(matrix, [center])[0], center, atol=1e-9)
+    numpy.testing.assert_allclose(numpy.dot(matrix[:3,:3], matrix[:3,:3].T), numpy.eye(3), atol=1e-12)
+
+  def test_rigidFitRecoversTheTransform(self):
+    matrix = pose.rigidMatrices([5., -3., 2., 10., 20., -15.], (1., 2., 3.))[0]
+    source = numpy.random.RandomState(0).uniform(-50, 50, size=(6,3))
+    fitted = pose.rigidFit(source, pose.transformPoints(matrix, source))
+    numpy.testing.assert_allclose(fitted, matrix, atol=1e-9)
+
+  def test_rigidFitNeedsThreePairs(self):
+    with self.assertRaises(ValueError):
+      pose.rigidFit(numpy.zeros((2,3)), numpy.zeros((2,3)))
+    with self.assertRaises(ValueError):
+      pose.rigidFit(numpy.zeros((4,3)), numpy.zeros((3,3)))
+
+  def test_poseStateCandidatesMatchMoves(self):
+    state = pose.PoseState(pose.translationMatrix([1., 2., 3.]), (5., 5., 5.))
+    state.move([2., 0., 0., 0., 10., 0.])
+    offset = numpy.array([0., 1., 0., 5., 0., 0.])
+    candidate = state.candidates(offset[numpy.newaxis])[0]
+    state.move(offset)
+    numpy.testing.assert_allclose(candidate, state.matrix(), atol=1e-12)
+
+class PhaseCorrelationTest(unittest.TestCase):
+
+  def test_phaseShiftFindsARollOfTheVolume(self):
+    random = numpy.random.RandomState(0)
+    moving = numpy.zeros((24, 28, 32))
+    for k, j, i in random.randint(4, 20, size=(12,3)):
+      moving[k-2:k+2, j-2:j+2, i-2:i+2] += random.uniform(1, 2)
+    # fixed(x) = moving(x - shift), shift in (i,j,k) order
+    shift = numpy.array([3, -2, 1])
+    fixed = numpy.roll(moving, tuple(shift[::-1]), axis=(0, 1, 2))
+    numpy.testing.assert_allclose(phasecorrelation.phaseShift(fixed, moving), shift, atol=0.5)
+
+class MetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    random = numpy.random.RandomState(0)
+    self.fixed = random.uniform(0, 100, size=5000)
+    self.moving = (0.8 * self.fixed + random.normal(0, 10, size=5000)).astype(numpy.float32)
+    self.movingRange = (float(self.moving.min()), float(self.moving.max()))
+    self.fixedRange = (float(self.fixed.min()), float(self.fixed.max()))
+
+  def test_metricPathsAgree(self):
+    for name in metrics.names():
+      metric = metrics.create(name, self.fixed, self.movingRange)
+      cost = metric.evaluate(self.moving[numpy.newaxis])[0]
+      normalizer = metric.normalizer(self.moving[numpy.newaxis])[0]
+      buffered = metric.evaluateBuffered(self.moving, metrics.WorkBuffers(len(self.moving)))
+      slabs = [(self.fixed[start:start+1000], self.moving[start:start+1000])
+               for start in range(0, len(self.fixed), 1000)]
+      accumulated = metrics.accumulate(name, slabs, self.fixedRange, self.movingRange)
+      for other in (buffered, accumulated):
+        self.assertAlmostEqual(other[0], cost, delta=1e-5 * max(1., abs(cost)), msg=name)
+        self.assertAlmostEqual(other[1], normalizer, delta=1e-5 * max(1., abs(normalizer)), msg=name)
+
+  def test_givenRangesSetTheBinsOfBothPaths(self):
+    fixedRange, movingRange = (-50., 150.), (-20., 120.)
+    metric = metrics.create('MI', self.fixed, movingRange, fixedRange)
+    buffered = metric.evaluateBuffered(self.moving, metrics.WorkBuffers(len(self.moving)))
+    accumulated = metrics.accumulate('MI', [(self.fixed, self.moving)], fixedRange, movingRange)
+    numpy.testing.assert_allclose(buffered, accumulated, rtol=1e-5)
+    self.assertNotAlmostEqual(buffered[0], metrics.create('MI', self.fixed, movingRange).evaluate(
+        self.moving[numpy.newaxis])[0])
+
+  def test_buffersAreAllocatedOnce(self):
+    buffers = metrics.WorkBuffers(len(self.moving))
+    for name in metrics.names():
+      metrics.create(name, self.fixed, self.movingRange).evaluateBuffered(self.moving, buffers)
+    allocatedBytes = buffers.allocatedBytes
+    for name in metrics.names():
+      metrics.create(name, self.fixed, self.movingRange).evaluateBuffered(self.moving, buffers)
+    self.assertEqual(buffers.allocatedBytes, allocatedBytes)
+
+  def test_identicalSamplesAreBest(self):
+    for name in metrics.names():
+      metric = metrics.create(name, self.fixed, self.movingRange)
+      costs = metric.evaluate(numpy.vstack((self.fixed, self.moving)))
+      self.assertLess(costs[0], costs[1], msg=name)
+
+  def test_unknownMetric(self):
+    with self.assertRaises(ValueError):
+      metrics.create('XYZ', self.fixed)
+
+def writeNrrd(path, array, header, encoding='raw', endian='little'):
+  """Write a 3D (k,j,i) array as a NRRD file with the extra header lines"""
+  dtype = array.dtype.newbyteorder('>' if endian == 'big' else '<')
+  data = array.astype(dtype).tobytes()
+  if encoding == 'gzip':
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as stream:
+      stream.write(data)
+    data = compressed.getvalue()
+  lines = ['NRRD0004', 'type: %s' % {'i2': 'short', 'f4': 'float', 'u1': 'uchar'}[array.dtype.str[1:]],
+           'dimension: 3', 'sizes: %d %d %d' % array.shape[::-1], 'encoding: %s' % encoding,
+           'endian: %s' % endian] + header
+  with open(path, 'wb') as stream:
+    stream.write(('\n'.join(lines) + '\n\n').encode('ascii'))
+    stream.write(data)
+
+class NrrdioTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='RegmaticLibTest')
+    self.array = numpy.arange(4*5*6).reshape(4, 5, 6)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_rawRoundTrip(self):
+    path = os.path.join(self.directory, 'raw.nrrd')
+    writeNrrd(path, self.array.astype(numpy.int16), [
+        'space: right-anterior-superior', 'space directions: (2,0,0) (0,3,0) (0,0,4)',
+        'space origin: (10,20,30)'])
+    array, ijkToRAS = nrrdio.readNrrd(path)
+    numpy.testing.assert_array_equal(array, self.array)
+    self.assertEqual(array.dtype, numpy.int16)
+    numpy.testing.assert_allclose(ijkToRAS, [[2,0,0,10], [0,3,0,20], [0,0,4,30], [0,0,0,1]])
+
+  def test_gzipBigEndianLPS(self):
+    path = os.path.join(self.directory, 'gzip.nrrd')
+    writeNrrd(path, self.array.astype(numpy.float32), [
+        'space: left-posterior-superior', 'space directions: (1,0,0) (0,1,0) (0,0,2)',
+        'space origin: (10,20,30)'], encoding='gzip', endian='big')
+    array, ijkToRAS = nrrdio.readNrrd(path)
+    numpy.testing.assert_array_equal(array, self.array)
+    numpy.testing.assert_allclose(ijkToRAS, [[-1,0,0,-10], [0,-1,0,-20], [0,0,2,30], [0,0,0,1]])
+
+  def test_notANrrdFile(self):
+    path = os.path.join(self.directory, 'text.nrrd')
+    with open(path, 'wb') as stream:
+      stream.write(b'hello\n')
+    with self.assertRaises(ValueError):
+      nrrdio.readNrrd(path)
+
+class SamplingTest(unittest.TestCase):
+
+  def test_trilinearIsExactOnLinearIntensities(self):
+    k, j, i = numpy.indices((6, 7, 8))
+    volume = 2.*i - 3.*j + 0.5*k
+    ijk = numpy.random.RandomState(0).uniform(0, 5, size=(50,3))
+    values = sampling.trilinear(volume, ijk)
+    numpy.testing.assert_allclose(values, 2.*ijk[:,0] - 3.*ijk[:,1] + 0.5*ijk[:,2], atol=1e-9)
+
+  def test_trilinearBackgroundOutside(self):
+    values = sampling.trilinear(numpy.ones((4, 4, 4)), numpy.array([[-1., 0., 0.], [1., 1., 1.]]), -5.)
+    numpy.testing.assert_allclose(values, [-5., 1.])
+
+  def test_sampleSetStaysInTheRegion(self):
+    region = roi.RegionOfInterest([[10., 10., 10.]], 5., 'sphere')
+    sampleSet = sampling.SampleSet(numpy.zeros((20, 20, 20)), numpy.diag([2., 2., 2., 1.]), 1000, roi=region)
+    self.assertTrue(len(sampleSet) > 0)
+    self.assertTrue(numpy.all(region.contains(sampleSet.points)))
+
+class RegionOfInterestTest(unittest.TestCase):
+
+  def test_shapes(self):
+    points = numpy.array([[4., 4., 4.], [5., 5., 5.]])
+    self.assertEqual(list(roi.RegionOfInterest([[0., 0., 0.]], 5., 'box').contains(points)), [True, True])
+    self.assertEqual(list(roi.RegionOfInterest([[0., 0., 0.]], 5., 'sphere').contains(points)), [False, False])
+    with self.assertRaises(ValueError):
+      roi.RegionOfInterest([[0., 0., 0.]], 5., 'cone')
+
+  def test_ijkBox(self):
+    region = roi.RegionOfInterest([[10., 10., 10.]], 4.)
+    first, last = region.ijkBox(numpy.diag([2., 2., 2., 1.]), (20, 20, 20))
+    self.assertEqual(list(first), [3, 3, 3])
+    self.assertEqual(list(last), [7, 7, 7])
+    with self.assertRaises(ValueError):
+      roi.RegionOfInterest([[500., 0., 0.]], 4.).ijkBox(numpy.eye(4), (20, 20, 20))
+
+class PyramidTest(unittest.TestCase):
+
+  def test_levels(self):
+    levels = pyramid.Pyramid(numpy.ones((40, 80, 100), dtype=numpy.int16), 32)
+    self.assertEqual([levels.array(level).shape for level in range(len(levels))],
+                     [(40, 80, 100), (20, 40, 50), (20, 20, 25)])
+    numpy.testing.assert_allclose(levels.ijkScale(2), numpy.diag([4., 4., 2., 1.]))
+    numpy.testing.assert_allclose(levels.array(2), 1.)
+    halves = levels.map(lambda array: array[:,:,:1])
+    self.assertEqual(halves.array(1).shape, (20, 40, 1))
+
+class WorkingCopyTest(unittest.TestCase):
+
+  def test_roundTrip(self):
+    array = numpy.random.RandomState(0).uniform(-100, 1000, size=(5, 6, 7))
+    for precision in workingcopy.PRECISIONS:
+      copy, scale, offset = workingcopy.workingCopy(array, precision)
+      self.assertLessEqual(numpy.abs(copy * scale + offset - array).max(), 0.5 * scale + 1e-3 * 1100,
+                           msg=precision)
+    with self.assertRaises(ValueError):
+      workingcopy.workingCopy(array, 'int4')
+
+  def test_zeroStaysZero(self):
+    copy, scale, offset = workingcopy.workingCopy(numpy.array([0., 5., 10.]), 'uint8')
+    self.assertEqual(offset, 0.)
+    self.assertEqual(copy[0], 0)
+
+class SchedulerTest(unittest.TestCase):
+
+  def test_stopReasons(self):
+    steps = scheduler.ConvergenceScheduler(stepTolerance=0.1)
+    self.assertFalse(steps.update(10., 1.))
+    self.assertTrue(steps.update(9., 0.05))
+    self.assertEqual(steps.reason, 'step')
+    stalled = scheduler.ConvergenceScheduler(relativeTolerance=1e-3, patience=2)
+    for value in (10., 5., 5., 5.):
+      converged = stalled.update(value, 1.)
+    self.assertTrue(converged)
+    self.assertEqual(stalled.reason, 'improvement')
+
+class ResultCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='RegmaticLibTest')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_putGetAndKeys(self):
+    digests = [resultcache.arrayDigest(numpy.arange(10)), resultcache.arrayDigest(numpy.ones(3))]
+    key = resultcache.resultKey(digests, [numpy.eye(4)], {'mode': 'rigid'})
+    self.assertNotEqual(key, resultcache.resultKey(digests, [numpy.eye(4)], {'mode': 'gradient'}))
+    cache = resultcache.ResultCache(self.directory)
+    self.assertIsNone(cache.get(key))
+    cache.put(key, 2*numpy.eye(4), 1.5, [3., 2., 1.5])
+    result = cache.get(key)
+    numpy.testing.assert_allclose(result['matrix'], 2*numpy.eye(4))
+    self.assertEqual(result['value'], 1.5)
+    numpy.testing.assert_allclose(result['trace'], [3., 2., 1.5])
+
+  def test_eviction(self):
+    cache = resultcache.ResultCache(self.directory, maxBytes=1)
+    cache.put('a', numpy.eye(4), 1.)
+    self.assertIsNone(cache.get('a'))
+
+class RegistrationTest(unittest.TestCase):
+  """Registrations of the benchmark phantom recover its known rigid transforms"""
+
+  size, spacing = 32, 3.
+
+  def setUp(self):
+    self.intensity, self.ijkToRAS = RegmaticBenchmark.phantom(self.size, self.spacing)
+    self.fixed = RegmaticBenchmark.sampleVolume(self.intensity, self.ijkToRAS, self.size)
+
+  def moving(self, params):
+    truth = pose.rigidMatrices([params])[0]
+    return RegmaticBenchmark.sampleVolume(self.intensity, self.ijkToRAS, self.size, truth), truth
+
+  def assertRecovered(self, matrix, truth, translation=0.5, rotation=1.):
+    translationError, rotationError = RegmaticBenchmark.residual(matrix, truth)
+    self.assertLess(translationError, translation)
+    self.assertLess(rotationError, rotation)
+
+  def test_engineRecoversARigidOffset(self):
+    moving, truth = self.moving(RegmaticBenchmark.CASES['rigid'])
+    for mode in ('gradient', 'rigid'):
+      registrationEngine = engine.RegistrationEngine(self.fixed, self.ijkToRAS, moving, self.ijkToRAS,
+                                                     sampleCount=10000, pyramidSize=16)
+      matrix, stats = registrationEngine.register(mode=mode)
+      self.assertRecovered(matrix, truth)
+      self.assertEqual(stats['mode'], mode)
+
+  def test_phaseRecoversATranslation(self):
+    moving, truth = self.moving(RegmaticBenchmark.CASES['translation'])
+    registrationEngine = engine.RegistrationEngine(self.fixed, self.ijkToRAS, moving, self.ijkToRAS,
+                                                   pyramidSize=16)
+    self.assertRecovered(registrationEngine.register(mode='phase')[0], truth)
+
+  def test_momentsAlignCenters(self):
+    moving, truth = self.moving([9., -6., 3., 0., 0., 0.])
+    alignment = moments.momentAlignment(moments.imageMoments(self.fixed, self.ijkToRAS),
+                                        moments.imageMoments(moving, self.ijkToRAS), rotate=False)
+    self.assertRecovered(alignment, truth, translation=1.5, rotation=0.01)
+
+  def test_seriesRecoversEachVolume(self):
+    movings = [self.moving(RegmaticBenchmark.CASES[name]) for name in ('translation', 'rigid')]
+    registration = series.SeriesRegistration(self.fixed, self.ijkToRAS,
+                                             [(moving, self.ijkToRAS) for moving, truth in movings],
+                                             'gradient', threads=2, sampleCount=10000, pyramidSize=16)
+    for (matrix, stats), (moving, truth) in zip(registration.run(), movings):
+      self.assertRecovered(matrix, truth)
+
+  def test_multiStartKeepsTheBestStart(self):
+    moving, truth = self.moving(RegmaticBenchmark.CASES['rotation'])
+    matrix, scores = multistart.multiStartSearch(self.fixed, self.ijkToRAS, moving, self.ijkToRAS,
+                                                 numpy.eye(4), starts=2, sampleCount=5000, processes=1)
+    self.assertEqual(len(scores), 2)
+    self.assertRecovered(matrix, truth, translation=2., rotation=2.)
+    threaded, threadedScores = multistart.multiStartSearch(
+        self.fixed, self.ijkToRAS, moving, self.ijkToRAS, numpy.eye(4), starts=2, sampleCount=5000,
+        processes=2, threads=True)
+    numpy.testing.assert_allclose(threadedScores, scores)
+    numpy.testing.assert_allclose(threaded, matrix)
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix='RegmaticLibTest')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_failedPairsAreRecorded(self):
+    fixedDirectory, movingDirectory, outputDirectory = [os.path.join(self.directory, name)
+                                                        for name in ('fixed', 'moving', 'output')]
+    os.makedirs(fixedDirectory)
+    os.makedirs(movingDirectory)
+    intensity, ijkToRAS = RegmaticBenchmark.phantom(16, 4.)
+    header = ['space: right-anterior-superior', 'space directions: (4,0,0) (0,4,0) (0,0,4)',
+              'space origin: (%g,%g,%g)' % tuple(ijkToRAS[:3,3])]
+    for name in ('good', 'bad'):
+      writeNrrd(os.path.join(fixedDirectory, name + '.nrrd'),
+                RegmaticBenchmark.sampleVolume(intensity, ijkToRAS, 16), header)
+    writeNrrd(os.path.join(movingDirectory, 'good.nrrd'),
+              RegmaticBenchmark.sampleVolume(intensity, ijkToRAS, 16, pose.translationMatrix([4., 0., 0.])),
+              header)
+    with open(os.path.join(movingDirectory, 'bad.nrrd'), 'wb') as stream:
+      stream.write(b'not a volume\n')
+    status = batch.main([fixedDirectory, movingDirectory, outputDirectory, '--processes', '1',
+                         '--pyramid-size', '8'])
+    self.assertEqual(status, 1)
+    with open(os.path.join(outputDirectory, 'stats.json')) as stream:
+      results = dict((os.path.basename(result['moving']), result)
+                     for result in json.load(stream)['pairs'])
+    self.assertIn('error', results['bad.nrrd'])
+    self.assertNotIn('error', results['good.nrrd'])
+    self.assertTrue(os.path.exists(os.path.join(outputDirectory, 'good.txt')))
+
+if __name__ == '__main__':
+  unittest.main()